@@ -1,8 +1,31 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
+from asgiref.wsgi import WsgiToAsgi
+from urllib.parse import parse_qs
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
-from collections import deque
+import math
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import zlib
+from themes import conversation_themes
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_futures
+from contextlib import aclosing
 
 app = Flask(__name__)
 
@@ -14,68 +37,1056 @@ if not OPENROUTER_API_KEY:
     print("警告: 環境変数 'OPENROUTER_API_KEY' が設定されていません。API呼び出しは失敗します。")
     # 必要に応じて、ここでプログラムを終了させるなどの処理を追加できます
     # raise ValueError("APIキーが設定されていません")
-OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+# 負荷試験では fake_openrouter.py の URL を指定して本物のAPIを呼ばずに動かす
+OPENROUTER_API_URL = os.environ.get("OPENROUTER_API_URL", "https://openrouter.ai/api/v1/chat/completions")
 
-# 明るく楽しい雑談テーマを生成する関数
-# 生成済みテーマを記録するセット
-generated_themes = set()
-# 直近の具体名を記録するdeque (最大7件)
-recent_specific_items = deque(maxlen=7)
+# HTTP接続プール設定 (環境変数で上書き可能)
+# 接続確立 (TCP+TLS) と応答待ちのタイムアウトを分けて設定する (秒)
+OPENROUTER_CONNECT_TIMEOUT = float(os.environ.get("OPENROUTER_CONNECT_TIMEOUT", "5"))
+OPENROUTER_READ_TIMEOUT = float(os.environ.get("OPENROUTER_READ_TIMEOUT", "30"))
+# 1ワーカープロセスあたりに保持するkeep-alive接続の最大数
+OPENROUTER_POOL_SIZE = int(os.environ.get("OPENROUTER_POOL_SIZE", "10"))
 
-# プロンプトを生成するヘルパー関数 (specific=False または keywordなし の場合のみ担当)
-def create_prompt(keyword=None, specific=False): # specific引数はgenerate_themeからの呼び出し整合性のために残す
-    base_prompt = """
-    形式は以下のJSON形式で**必ず**返してください。
-    {
-        "theme": "具体的な話題",
-        "hint": "会話のきっかけ"
-    }
-    例:
-    {
-        "theme": "夏の思い出",
-        "hint": "子供の頃の夏休みの思い出や、最近の夏の楽しみ方を話してみよう"
+# 残り時間 (秒) に合わせて (接続, 読み取り) タイムアウトを切り詰める。None なら既定値
+def budget_timeouts(timeout=None):
+    if timeout is None:
+        return OPENROUTER_CONNECT_TIMEOUT, OPENROUTER_READ_TIMEOUT
+    return min(OPENROUTER_CONNECT_TIMEOUT, timeout), min(OPENROUTER_READ_TIMEOUT, timeout)
+
+# --- 構造化ログ (JSON Lines) ---
+# スピン1回で何度も print すると、リクエストスレッドが標準出力への同期書き込みで止まる。
+# リクエストスレッドはレコードをキューに積むだけにし、整形と書き込みはバックグラウンドスレッドが行う。
+# info は LOG_SAMPLE_RATE の割合だけ残し、warning / error は常に残す。キューが溢れた分は捨てて数える。
+# キーワードはそのまま出さず、短いハッシュ (kw) にして同じキーワードのスピンを突き合わせられるようにする。
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "1"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_FILE = os.environ.get("LOG_FILE") # 未指定なら標準出力
+LOG_ALWAYS_KEEP = ("warning", "error")
+
+def keyword_hash(keyword):
+    if not keyword:
+        return None
+    return hashlib.blake2b(keyword.encode("utf-8"), digest_size=6).hexdigest()
+
+class EventLog:
+    def __init__(self, sample_rate=LOG_SAMPLE_RATE, maxsize=LOG_QUEUE_SIZE, path=LOG_FILE):
+        self.sample_rate = sample_rate
+        self.maxsize = maxsize
+        self.path = path
+        self._queue = queue.Queue(maxsize)
+        self._write_lock = threading.Lock()
+        self._out = None
+        self._pid = None
+        self.written = 0
+        self.sampled_out = 0
+        self.dropped = 0
+
+    # 書き込みスレッドはforkを越えて引き継がれないため、プロセスごとに起動する
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._write_loop, name="event-log", daemon=True).start()
+
+    def log(self, event, level="info", **fields):
+        if level not in LOG_ALWAYS_KEEP and self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((time.time(), level, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def _format(self, record):
+        ts, level, event, fields = record
+        entry = {"ts": round(ts, 3), "pid": os.getpid(), "level": level, "event": event}
+        entry.update((key, value) for key, value in fields.items() if value is not None)
+        return json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+
+    def _write(self, records):
+        lines = "".join(self._format(record) for record in records)
+        with self._write_lock:
+            if self._out is None:
+                self._out = open(self.path, "a", encoding="utf-8") if self.path else sys.stdout
+            self._out.write(lines)
+            self._out.flush()
+            self.written += len(records)
+
+    # 溜まっているレコードをまとめて書き出す (1行ごとにflushしない)
+    def _drain(self, first=None):
+        records = [] if first is None else [first]
+        while True:
+            try:
+                records.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if records:
+            self._write(records)
+
+    def _write_loop(self):
+        while True:
+            record = self._queue.get()
+            try:
+                self._drain(record)
+            except Exception as e:
+                # 書き込み先の異常でログスレッドを止めない
+                sys.stderr.write(f"ログの書き込みエラー: {e}\n")
+
+    # プロセス終了時に呼び出し側のスレッドで残りを書き出す
+    def flush(self):
+        try:
+            self._drain()
+        except Exception as e:
+            sys.stderr.write(f"ログの書き込みエラー: {e}\n")
+
+    def stats(self):
+        return {
+            "sample_rate": self.sample_rate,
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "sampled_out": self.sampled_out,
+            "dropped": self.dropped,
+        }
 
-        "theme": "映画館で頼む食べ物",
-        "hint": "楽しい映画には外せない,美味しいグルメについて語ろう"
+    # fork時に親のキュー (内部ロックを含む) と書き込み先を子プロセスに持ち込まない
+    def reset_after_fork(self):
+        self._queue = queue.Queue(self.maxsize)
+        self._write_lock = threading.Lock()
+        self._out = None
 
-        "theme": "学生時代の失敗談",
-        "hint": "思い出したくない黒歴史,今だから笑える失敗を思い出そう"
+event_log = EventLog()
+atexit.register(event_log.flush)
 
-        "theme": "異世界に行ったら何をしたい？",
-        "hint": "もし異世界に行ったら魔法使いとして旅に出る？街で商売して大儲け？"
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=event_log.reset_after_fork)
+
+def log_event(event, level="info", **fields):
+    event_log.log(event, level, **fields)
+
+# --- ワーカー単位の長寿命HTTPセッション ---
+# 毎回 requests.post を呼ぶとリトライのたびにTCP+TLSハンドシェイクが発生するため、
+# keep-alive接続をプールするセッションをワーカープロセスごとに1つだけ保持する。
+# gunicorn (--preload含む) でfork後に親の接続を共有しないよう、PIDで所有者を判定する。
+_http_session = None
+_http_adapter = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
+
+def _create_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=OPENROUTER_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session, adapter
+
+def get_http_session():
+    global _http_session, _http_adapter, _http_session_pid
+    pid = os.getpid()
+    if _http_session is None or _http_session_pid != pid:
+        with _http_session_lock:
+            if _http_session is None or _http_session_pid != pid:
+                _http_session, _http_adapter = _create_http_session()
+                _http_session_pid = pid
+    return _http_session
+
+# fork直後の子プロセスでは親のセッションとロックを破棄して作り直す
+def _reset_http_session_after_fork():
+    global _http_session, _http_adapter, _http_session_pid, _http_session_lock
+    _http_session = None
+    _http_adapter = None
+    _http_session_pid = None
+    _http_session_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_http_session_after_fork)
+
+# 接続再利用の統計を返す (requests: 送信数, connections: 新規接続数, reused: 再利用された回数)
+def get_http_pool_stats():
+    stats = {
+        "pid": os.getpid(),
+        "pool_size": OPENROUTER_POOL_SIZE,
+        "requests": 0,
+        "connections": 0,
+        "reused": 0,
+        "reuse_rate": 0.0,
     }
+    adapter = _http_adapter if _http_session_pid == os.getpid() else None
+    if adapter is None:
+        return stats
+    pools = adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        stats["requests"] += pool.num_requests
+        stats["connections"] += pool.num_connections
+    stats["reused"] = max(stats["requests"] - stats["connections"], 0)
+    if stats["requests"]:
+        stats["reuse_rate"] = round(stats["reused"] / stats["requests"], 3)
+    return stats
 
-    以下の条件を厳守してください:
-    - 楽しくて盛り上がる話題
-    - 現実的でリアルなお題含む
-    - 恋愛や仕事、学校に関する話題含む
-    - 想像が膨らみやすい話題含む
-    - ユーモアがあるお題含む
-    - 具体的で想像しやすいお題とヒント
-    """
-
-    # specific=True の場合のプロンプト生成は generate_theme 内の step1_prompt/step2_prompt で直接行うため、
-    # この関数では specific=False または keyword なしの場合のみを扱う。
-    if keyword:
-        # キーワードあり、かつ specific=False の場合
-        instruction = f"「{keyword}」というキーワードに必ず関連した、明るく楽しい雑談テーマを1つ考えてください。"
-        prompt = instruction + base_prompt
+# --- 生成済みテーマの重複排除ストア ---
+# setのままだと長時間動くワーカーで際限なく増えるため、容量とTTLで古いものから捨てる。
+# OrderedDictの先頭が最も古く使われたテーマなので、判定・追加・追い出しはすべてO(1)。
+THEME_DEDUP_CAPACITY = int(os.environ.get("THEME_DEDUP_CAPACITY", "10000"))
+THEME_DEDUP_TTL = float(os.environ.get("THEME_DEDUP_TTL", str(7 * 24 * 3600))) # 0以下ならTTLなし
+
+class ThemeStore:
+    def __init__(self, capacity=THEME_DEDUP_CAPACITY, ttl=THEME_DEDUP_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict() # テーマ -> 最後に使われた時刻
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _expired(self, touched, now):
+        return self.ttl > 0 and now - touched > self.ttl
+
+    def __contains__(self, theme):
+        now = time.monotonic()
+        with self._lock:
+            touched = self._entries.get(theme)
+            if touched is None:
+                return False
+            if self._expired(touched, now):
+                del self._entries[theme]
+                self.evictions += 1
+                return False
+            # 再び候補に挙がったテーマは最近使われたものとして扱う
+            self._entries[theme] = now
+            self._entries.move_to_end(theme)
+            return True
+
+    def add(self, theme):
+        now = time.monotonic()
+        with self._lock:
+            self._put(theme, now)
+
+    def _put(self, theme, now):
+        self._entries[theme] = now
+        self._entries.move_to_end(theme)
+        # 容量超過分とTTL切れを先頭 (最も古いもの) から捨てる
+        while self._entries:
+            oldest, touched = next(iter(self._entries.items()))
+            if len(self._entries) <= self.capacity and not self._expired(touched, now):
+                break
+            del self._entries[oldest]
+            self.evictions += 1
+
+    # 未登録なら登録して True、既出なら False を返す (判定と登録を1回で行い、同時に同じテーマを取らせない)
+    def claim(self, theme):
+        now = time.monotonic()
+        with self._lock:
+            touched = self._entries.get(theme)
+            fresh = touched is None or self._expired(touched, now)
+            self._put(theme, now)
+            return fresh
+
+    async def claim_async(self, theme):
+        return self.claim(theme)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"size": len(self._entries), "capacity": self.capacity, "ttl": self.ttl, "evictions": self.evictions}
+
+# 直近の具体名 (deque(maxlen=...) に、判定と追加を1回で行う claim を足したもの)
+class RecentItems(deque):
+    def __init__(self, maxlen):
+        super().__init__(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def claim(self, item):
+        with self._lock:
+            if item in self:
+                return False
+            self.append(item) # 古いものは自動で削除される
+            return True
+
+    async def claim_async(self, item):
+        return self.claim(item)
+
+# --- ワーカー間で共有する重複排除ストア (SQLite WALモード) ---
+# gunicornの各ワーカーが別々に重複判定していると、他のワーカーが出したテーマが再び出てしまう。
+# SHARED_STATE_DB にファイルパスを指定すると、同じマシン上のワーカー同士で
+# generated_themes と recent_specific_items をローカルのSQLiteファイル経由で共有する。
+# 未指定の場合は従来どおりプロセス内のストアを使う。
+SHARED_STATE_DB = os.environ.get("SHARED_STATE_DB")
+# 容量・TTLの掃除を何回の追加ごとに行うか (件数の数え上げを毎回の追加で行わないため)
+SHARED_STATE_SWEEP_INTERVAL = 256
+
+SHARED_STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS generated_themes (
+    theme TEXT PRIMARY KEY,
+    touched REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS generated_themes_touched ON generated_themes (touched);
+CREATE TABLE IF NOT EXISTS recent_specific_items (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    item TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS recent_specific_items_item ON recent_specific_items (item);
+CREATE TABLE IF NOT EXISTS theme_bank (
+    theme TEXT PRIMARY KEY,
+    hint TEXT NOT NULL,
+    keyword TEXT,
+    added REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS theme_bank_added ON theme_bank (added);
+CREATE TABLE IF NOT EXISTS outbound_bucket (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbound_leases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels)
+) WITHOUT ROWID;
+"""
+
+class SharedStateDB:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    # 接続はスレッドごと・プロセスごとに持つ (fork後に親の接続を使わない)
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SHARED_STATE_SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+# ThemeStore と同じ使い方 (in / add / claim) ができる共有版
+# 書き込みは他のワーカーが書き込み中だと busy timeout まで待つため、非同期の経路からは claim_async で
+# 別スレッドに逃がす。in は読み取りだけ (WALモードの読み取りは書き込みを待たない) なのでどこからでも呼べる。
+class SharedThemeStore:
+    def __init__(self, db, capacity=THEME_DEDUP_CAPACITY, ttl=THEME_DEDUP_TTL):
+        self.db = db
+        self.capacity = capacity
+        self.ttl = ttl
+        self._adds = 0
+        self.evictions = 0
+
+    def __contains__(self, theme):
+        row = self.db.connection().execute("SELECT touched FROM generated_themes WHERE theme = ?", (theme,)).fetchone()
+        return row is not None and not (self.ttl > 0 and time.time() - row[0] > self.ttl)
+
+    def add(self, theme):
+        conn = self.db.connection()
+        conn.execute(
+            "INSERT INTO generated_themes (theme, touched) VALUES (?, ?) "
+            "ON CONFLICT (theme) DO UPDATE SET touched = excluded.touched",
+            (theme, time.time()),
+        )
+        self._swept(conn)
+
+    # ワーカー間でも判定と登録を1文で行う。INSERT OR IGNORE で行を作れたワーカーだけがテーマを取れる
+    # (TTL切れの行は、touched を条件付きで更新できたワーカーが取る)。既出だった場合は最近使われたものとして扱う
+    def claim(self, theme):
+        conn = self.db.connection()
+        now = time.time()
+        claimed = conn.execute(
+            "INSERT OR IGNORE INTO generated_themes (theme, touched) VALUES (?, ?)", (theme, now)
+        ).rowcount == 1
+        if not claimed and self.ttl > 0:
+            claimed = conn.execute(
+                "UPDATE generated_themes SET touched = ? WHERE theme = ? AND touched < ?", (now, theme, now - self.ttl)
+            ).rowcount == 1
+        if not claimed:
+            conn.execute("UPDATE generated_themes SET touched = ? WHERE theme = ?", (now, theme))
+        self._swept(conn)
+        return claimed
+
+    async def claim_async(self, theme):
+        return await asyncio.to_thread(self.claim, theme)
+
+    def _swept(self, conn):
+        self._adds += 1
+        if self._adds % SHARED_STATE_SWEEP_INTERVAL == 0:
+            self.sweep()
+
+    # TTL切れと容量超過分を古い順に削除する
+    def sweep(self):
+        conn = self.db.connection()
+        removed = 0
+        if self.ttl > 0:
+            removed += conn.execute("DELETE FROM generated_themes WHERE touched < ?", (time.time() - self.ttl,)).rowcount
+        excess = len(self) - self.capacity
+        if excess > 0:
+            removed += conn.execute(
+                "DELETE FROM generated_themes WHERE theme IN "
+                "(SELECT theme FROM generated_themes ORDER BY touched LIMIT ?)",
+                (excess,),
+            ).rowcount
+        self.evictions += removed
+
+    def __len__(self):
+        return self.db.connection().execute("SELECT COUNT(*) FROM generated_themes").fetchone()[0]
+
+    def stats(self):
+        return {
+            "size": len(self),
+            "capacity": self.capacity,
+            "ttl": self.ttl,
+            "evictions": self.evictions,
+            "shared": self.db.path,
+        }
+
+# RecentItems と同じ使い方 (in / append / claim / list()) ができる共有版
+class SharedRecentItems:
+    def __init__(self, db, maxlen):
+        self.db = db
+        self.maxlen = maxlen
+
+    def __contains__(self, item):
+        row = self.db.connection().execute(
+            "SELECT 1 FROM recent_specific_items WHERE item = ? "
+            "AND seq > (SELECT COALESCE(MAX(seq), 0) FROM recent_specific_items) - ? LIMIT 1",
+            (item, self.maxlen),
+        ).fetchone()
+        return row is not None
+
+    def append(self, item):
+        conn = self.db.connection()
+        seq = conn.execute("INSERT INTO recent_specific_items (item) VALUES (?)", (item,)).lastrowid
+        conn.execute("DELETE FROM recent_specific_items WHERE seq <= ?", (seq - self.maxlen,))
+
+    # 直近に使われていなければ追加して True を返す。判定と追加の間に他のワーカーが割り込まないよう
+    # 1つの書き込みトランザクションで行う (非同期の経路からは claim_async で別スレッドに逃がす)
+    def claim(self, item):
+        conn = self.db.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if item in self:
+                conn.execute("COMMIT")
+                return False
+            self.append(item)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return True
+
+    async def claim_async(self, item):
+        return await asyncio.to_thread(self.claim, item)
+
+    def __iter__(self):
+        rows = self.db.connection().execute(
+            "SELECT item FROM recent_specific_items ORDER BY seq DESC LIMIT ?", (self.maxlen,)
+        ).fetchall()
+        return iter([row[0] for row in reversed(rows)])
+
+    def __len__(self):
+        count = self.db.connection().execute("SELECT COUNT(*) FROM recent_specific_items").fetchone()[0]
+        return min(count, self.maxlen)
+
+# --- 言い換えテーマの近似重複検出 (文字n-gram MinHash + LSH) ---
+# 完全一致の判定だけでは「学生時代の失敗談」と「学生時代のちょっとした失敗談」のような
+# 言い換えがすり抜けるため、形態素解析を使わずに文字bigramの集合をMinHashで要約し、
+# LSHのバケットで候補を絞ってから、上位の候補だけbigram集合を作り直して類似度を確かめる。
+# 最終判定はLSHのバンド設計と同じJaccard係数で行う。例の「学生時代のちょっとした失敗談」のように途中へ
+# 修飾語を挟んだ言い換えはJaccard係数が0.43まで下がるので、書き出しと結びの2文字が同じ場合に限り
+# 重なり係数 (短い方のbigramが含まれる割合) でも判定する。重なり係数だけでは「ラーメンの好きな味」と
+# 「ラーメンの好きなトッピング」のように同じキーワードを含む別の話題まで弾いてしまうが、結びが違うので弾かない。
+# bigramが NEAR_DUP_MIN_SHINGLES 個に満たない短いテーマは1語の違いで話題が変わるので近似判定しない。
+# 同じキーワードを含む別テーマ225組の誤判定は1組 (0.4%)、言い換え8組の検出は5組 (上の例を含む)、
+# 途中に修飾語を挟んだ言い換え4組の検出は3組 (残り1組は短いテーマ)。
+# Jaccard係数0.43の組でもLSHの候補に挙がる確率は 1 - (1 - 0.43^2)^16 ≒ 96%。
+# 署名は保存せずバケットにテーマ文字列への参照だけを持つ。実測で1テーマあたり約1.2KB (16バンド) で、
+# 既定の容量1万件なら約12MB、100万件では約1.2GBになるため、容量で上限を設けて古いものから捨てる。
+# 判定は1件あたり約0.2ms、登録は約0.1ms (20万件登録時)。
+NEAR_DUP_ENABLED = os.environ.get("NEAR_DUP_ENABLED", "1") != "0"
+NEAR_DUP_THRESHOLD = float(os.environ.get("NEAR_DUP_THRESHOLD", "0.6"))
+NEAR_DUP_CONTAINMENT = float(os.environ.get("NEAR_DUP_CONTAINMENT", "0.8")) # 書き出しと結びが同じテーマに使う重なり係数のしきい値
+NEAR_DUP_MIN_SHINGLES = int(os.environ.get("NEAR_DUP_MIN_SHINGLES", "6")) # これより短いテーマは完全一致だけで判定する
+NEAR_DUP_CAPACITY = int(os.environ.get("NEAR_DUP_CAPACITY", str(THEME_DEDUP_CAPACITY)))
+NEAR_DUP_BANDS = 16
+NEAR_DUP_ROWS = 2 # 1バンドあたりのハッシュ数 (NEAR_DUP_BANDS * NEAR_DUP_ROWS = 署名の長さ)
+NEAR_DUP_BUCKET_CAP = 64 # これ以上大きいバケット (ありふれた表現) は候補探索に使わない
+NEAR_DUP_MAX_VERIFY = 8 # 類似度を確かめる候補の最大数 (バンド一致数の多い順)
+
+_HASH_MASK = (1 << 64) - 1
+_minhash_rng = random.Random(20250411) # プロセス間で同じハッシュ関数を使うため固定シード
+_MINHASH_PARAMS = [
+    (_minhash_rng.getrandbits(64) | 1, _minhash_rng.getrandbits(64))
+    for _ in range(NEAR_DUP_BANDS * NEAR_DUP_ROWS)
+]
+_NEAR_DUP_STRIP = re.compile(r"[\s\W_]+")
+
+def _near_dup_text(theme):
+    return _NEAR_DUP_STRIP.sub("", unicodedata.normalize("NFKC", theme).lower())
+
+# 表記ゆれを吸収して文字bigramの集合 (crc32) にする
+def theme_shingles(theme):
+    text = _near_dup_text(theme)
+    if len(text) < 2:
+        return {zlib.crc32(text.encode("utf-8"))}
+    return {zlib.crc32(text[i:i + 2].encode("utf-8")) for i in range(len(text) - 1)}
+
+# multiply-shift ハッシュ族による MinHash 署名
+def minhash_signature(shingles):
+    rows = [[((a * x + b) & _HASH_MASK) >> 32 for a, b in _MINHASH_PARAMS] for x in shingles]
+    return [min(column) for column in zip(*rows)]
+
+def _band_keys(signature):
+    return [
+        hash((band,) + tuple(signature[band * NEAR_DUP_ROWS:(band + 1) * NEAR_DUP_ROWS]))
+        for band in range(NEAR_DUP_BANDS)
+    ]
+
+def shingle_jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+def shingle_overlap(a, b):
+    return len(a & b) / min(len(a), len(b))
+
+# テーマの書き出しと結びの2文字ずつ (日本語のテーマは結びが話題の中心になる語)
+def theme_ends(theme):
+    text = _near_dup_text(theme)
+    return text[:2], text[-2:]
+
+# 短いテーマは1語足すだけで別の話題になる (「好きな映画」と「好きな映画監督」) ので近似判定しない
+# Jaccard係数がしきい値以上か、途中に修飾語を挟んだだけの言い換え (短い方のbigramがほぼ含まれ、
+# 書き出しと結びが同じ) なら近似重複とみなす。ends は両テーマの theme_ends (省略時は後者を判定しない)
+def near_duplicate_match(a, b, threshold=None, ends=None):
+    if min(len(a), len(b)) < NEAR_DUP_MIN_SHINGLES:
+        return False
+    if shingle_jaccard(a, b) >= (NEAR_DUP_THRESHOLD if threshold is None else threshold):
+        return True
+    return ends is not None and ends[0] == ends[1] and shingle_overlap(a, b) >= NEAR_DUP_CONTAINMENT
+
+class NearDuplicateIndex:
+    def __init__(self, threshold=NEAR_DUP_THRESHOLD, capacity=NEAR_DUP_CAPACITY):
+        self.threshold = threshold
+        self.capacity = capacity
+        self._entries = OrderedDict() # 登録済みテーマ (先頭が最も古い)
+        self._buckets = {} # バンド値 -> テーマ (1件) またはテーマのリスト
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.matches = 0
+        self.query_seconds = 0.0
+
+    # しきい値以上に似た既存テーマがあればそれを返す (なければ None)
+    def find_similar(self, theme):
+        started = time.perf_counter()
+        shingles = theme_shingles(theme)
+        ends = theme_ends(theme)
+        keys = _band_keys(minhash_signature(shingles))
+        found = None
+        with self._lock:
+            hits = {}
+            for key in keys:
+                members = self._buckets.get(key)
+                if members is None:
+                    continue
+                if isinstance(members, str):
+                    members = (members,)
+                elif len(members) > NEAR_DUP_BUCKET_CAP:
+                    continue
+                for other in members:
+                    hits[other] = hits.get(other, 0) + 1
+            for other in sorted(hits, key=hits.get, reverse=True)[:NEAR_DUP_MAX_VERIFY]:
+                if near_duplicate_match(shingles, theme_shingles(other), self.threshold, (ends, theme_ends(other))):
+                    found = other
+                    break
+            self.queries += 1
+            if found is not None:
+                self.matches += 1
+            self.query_seconds += time.perf_counter() - started
+        return found
+
+    def add(self, theme):
+        keys = _band_keys(minhash_signature(theme_shingles(theme)))
+        with self._lock:
+            if theme in self._entries:
+                self._entries.move_to_end(theme)
+                return
+            self._entries[theme] = None
+            for key in keys:
+                members = self._buckets.get(key)
+                if members is None:
+                    self._buckets[key] = theme # 1件だけのバケットはリストを作らない
+                elif isinstance(members, str):
+                    self._buckets[key] = [members, theme]
+                elif len(members) <= NEAR_DUP_BUCKET_CAP:
+                    # 上限を超えたバケットは探索に使わないので、それ以上は追加しない
+                    members.append(theme)
+            while len(self._entries) > self.capacity:
+                self._remove_oldest()
+
+    def _remove_oldest(self):
+        theme, _ = self._entries.popitem(last=False)
+        for key in _band_keys(minhash_signature(theme_shingles(theme))):
+            members = self._buckets.get(key)
+            if members == theme:
+                del self._buckets[key]
+            elif isinstance(members, list) and theme in members:
+                members.remove(theme)
+                if len(members) == 1:
+                    self._buckets[key] = members[0]
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "threshold": self.threshold,
+            "queries": self.queries,
+            "near_duplicates": self.matches,
+            "avg_query_us": round(self.query_seconds / self.queries * 1e6, 1) if self.queries else None,
+        }
+
+# 完全一致のストアに近似重複の判定を重ねる (in / add / claim の使い方は同じ)
+class NearDuplicateThemeStore:
+    def __init__(self, exact, index):
+        self.exact = exact
+        self.index = index
+
+    def __contains__(self, theme):
+        return theme in self.exact or self._similar(theme)
+
+    def add(self, theme):
+        self.exact.add(theme)
+        self.index.add(theme)
+
+    # 言い換えが既に出ていれば取らず、そうでなければ完全一致のストアで取れたものだけ索引に加える
+    def claim(self, theme):
+        if self._similar(theme):
+            return False
+        if not self.exact.claim(theme):
+            return False
+        self.index.add(theme)
+        return True
+
+    async def claim_async(self, theme):
+        if self._similar(theme):
+            return False
+        if not await self.exact.claim_async(theme):
+            return False
+        self.index.add(theme)
+        return True
+
+    def _similar(self, theme):
+        similar = self.index.find_similar(theme)
+        if similar is not None:
+            log_event("near_duplicate", theme=theme, similar=similar)
+        return similar is not None
+
+    def __len__(self):
+        return len(self.exact)
+
+    def stats(self):
+        return dict(self.exact.stats(), near_duplicate=self.index.stats())
+
+# 明るく楽しい雑談テーマを生成する関数
+if SHARED_STATE_DB:
+    shared_state_db = SharedStateDB(SHARED_STATE_DB)
+    # 生成済みテーマを記録するストア (ワーカー間で共有)
+    generated_themes = SharedThemeStore(shared_state_db)
+    # 直近の具体名 (最大7件, ワーカー間で共有)
+    recent_specific_items = SharedRecentItems(shared_state_db, maxlen=7)
+else:
+    # 生成済みテーマを記録するストア (容量・TTL付き)
+    generated_themes = ThemeStore()
+    # 直近の具体名を記録するdeque (最大7件)
+    recent_specific_items = RecentItems(maxlen=7)
+if NEAR_DUP_ENABLED:
+    # 言い換えも重複として扱う (近似重複の索引はプロセスごと)
+    generated_themes = NearDuplicateThemeStore(generated_themes, NearDuplicateIndex())
+
+# --- メトリクス (Prometheus形式の /metrics) ---
+# 上流呼び出しのステップ別レイテンシ (ヒストグラム) と、試行・重複・解析失敗・エラー・ハズレなどの回数を数える。
+# 各ワーカーは増分をメモリに貯め、SHARED_STATE_DB 指定時は METRICS_FLUSH_INTERVAL 秒ごとにSQLiteの
+# 共有テーブルへ加算する。/metrics はどのワーカーが受けても全ワーカーの合計を返す
+# (他のワーカーの直近 METRICS_FLUSH_INTERVAL 秒分は次の加算まで反映されない)。
+# SHARED_STATE_DB を使わない構成でも、PROMETHEUS_MULTIPROC_DIR (prometheus_client の複数プロセスモードと同じ変数) を
+# 指定すればそのディレクトリのSQLiteファイルで同じように合計する。前回の起動の値を引き継がないよう、起動前に空にしておく。
+# どちらも未指定ならワーカー単位の値になるため、どのワーカーの値か分かるよう全サンプルに worker="<pid>" ラベルを付ける
+# (ラベルなしで返すと、スクレイプのたびに別のワーカーの値が同じ系列に入り、カウンタが減ったように見える)。
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+UPSTREAM_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0)
+SPIN_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0)
+
+def _format_labels(labels):
+    return ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in sorted(labels.items())
+    )
+
+# ヒストグラムのバケットは le を最後のラベルにして、同じ系列内で境界の昇順に並べる
+def _bucket_labels(labels, bound):
+    return ",".join(filter(None, (_format_labels(labels), 'le="%s"' % bound)))
+
+def _sample_order(item):
+    (sample, labels), _ = item
+    if sample.endswith("_bucket"):
+        series, _, bound = labels.rpartition('le="')
+        return series, float(bound.rstrip('"').replace("+Inf", "inf"))
+    return labels, 0.0
+
+class Metrics:
+    def __init__(self, db=None):
+        self.db = db
+        self._meta = {} # 名前 -> (種類, 説明, バケット)
+        self._values = {} # (サンプル名, ラベル) -> 値 (共有時はまだ加算していない増分)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def describe(self, name, kind, help_text, buckets=None):
+        self._meta[name] = (kind, help_text, buckets)
+
+    # 共有時の加算スレッドはforkを越えて引き継がれないため、プロセスごとに起動する
+    def _ensure_flusher(self):
+        if self.db is None or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def _add(self, key, amount):
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def inc(self, name, amount=1, **labels):
+        self._ensure_flusher()
+        with self._lock:
+            self._add((name, _format_labels(labels)), amount)
+
+    def observe(self, name, value, **labels):
+        self._ensure_flusher()
+        buckets = self._meta[name][2]
+        with self._lock:
+            # 該当しないバケットも0で出力されるように加算する
+            for bound in buckets:
+                self._add((name + "_bucket", _bucket_labels(labels, bound)), 1 if value <= bound else 0)
+            self._add((name + "_bucket", _bucket_labels(labels, "+Inf")), 1)
+            self._add((name + "_sum", _format_labels(labels)), value)
+            self._add((name + "_count", _format_labels(labels)), 1)
+
+    # 貯めた増分を共有テーブルへ加算する
+    def flush(self):
+        if self.db is None:
+            return
+        with self._lock:
+            pending, self._values = self._values, {}
+        if not pending:
+            return
+        try:
+            with self.db.connection() as conn:
+                conn.executemany(
+                    "INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+                    [(name, labels, value) for (name, labels), value in pending.items()],
+                )
+        except sqlite3.Error as e:
+            log_event("metrics_error", level="warning", op="flush", detail=str(e))
+            with self._lock:
+                for key, value in pending.items():
+                    self._add(key, value)
+
+    def snapshot(self):
+        if self.db is None:
+            with self._lock:
+                return dict(self._values)
+        self.flush()
+        try:
+            rows = self.db.connection().execute("SELECT name, labels, value FROM metrics").fetchall()
+        except sqlite3.Error as e:
+            log_event("metrics_error", level="warning", op="read", detail=str(e))
+            rows = []
+        return {(name, labels): value for name, labels, value in rows}
+
+    # テキスト形式で出力する。gauges は {名前: [(ラベル, 値), ...]} (取得時点の値)
+    def render(self, gauges=None):
+        samples = self.snapshot()
+        for name, values in (gauges or {}).items():
+            for labels, value in values:
+                samples[(name, _format_labels(labels))] = value
+        if self.db is None:
+            worker = _format_labels({"worker": os.getpid()})
+            samples = {(sample, ",".join(filter(None, (worker, labels)))): value for (sample, labels), value in samples.items()}
+        lines = []
+        for name, (kind, help_text, _) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            suffixes = ("_bucket", "_sum", "_count") if kind == "histogram" else ("",)
+            for suffix in suffixes:
+                for (sample, labels), value in sorted(samples.items(), key=_sample_order):
+                    if sample == name + suffix:
+                        value = int(value) if float(value).is_integer() else value
+                        lines.append(f"{sample}{{{labels}}} {value}" if labels else f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+# fork時に親のロックと未加算の増分を子プロセスに持ち込まない
+def _reset_metrics_after_fork():
+    metrics._lock = threading.Lock()
+    metrics._values = {}
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_metrics_after_fork)
+
+if SHARED_STATE_DB:
+    metrics = Metrics(shared_state_db)
+elif PROMETHEUS_MULTIPROC_DIR:
+    metrics = Metrics(SharedStateDB(os.path.join(PROMETHEUS_MULTIPROC_DIR, "gacha_metrics.db")))
+else:
+    metrics = Metrics()
+# ワーカーの終了時に未加算の増分を書き出す
+atexit.register(metrics.flush)
+metrics.describe("gacha_upstream_latency_seconds", "histogram", "OpenRouter call latency by pipeline step.", UPSTREAM_LATENCY_BUCKETS)
+metrics.describe("gacha_upstream_attempts_total", "counter", "OpenRouter calls by pipeline step.")
+metrics.describe("gacha_upstream_errors_total", "counter", "Failed OpenRouter calls by pipeline step and error kind.")
+metrics.describe("gacha_duplicates_total", "counter", "Generated themes or items rejected as duplicates, by pipeline step.")
+metrics.describe("gacha_parse_failures_total", "counter", "Responses with no usable JSON, by response kind.")
+metrics.describe("gacha_spins_total", "counter", "Spins by route and outcome (pooled, generated, hazure).")
+metrics.describe("gacha_offline_themes_total", "counter", "Themes served from the offline theme bank.")
+metrics.describe("gacha_spin_duration_seconds", "histogram", "Spin latency by route.", SPIN_LATENCY_BUCKETS)
+metrics.describe("gacha_dedup_store_size", "gauge", "Themes in the dedup store (as seen by the scraped worker).")
+metrics.describe("gacha_capsule_pool_size", "gauge", "Capsules waiting in the scraped worker's default pool.")
+metrics.describe("gacha_circuit_open", "gauge", "1 while the scraped worker's circuit breaker is not closed.")
+
+# 1回のスピンの結果と所要時間を記録する
+def record_spin(route, theme, started, pooled=False):
+    if pooled:
+        outcome = "pooled"
+    elif theme.get("theme") == "ハズレ":
+        outcome = "hazure"
     else:
-        # キーワードなしの場合 (specific=False)
-        instruction = "明るく楽しい雑談テーマを1つ考えてください。"
-        prompt = instruction + base_prompt
+        outcome = "generated"
+    metrics.inc("gacha_spins_total", route=route, outcome=outcome)
+    metrics.observe("gacha_spin_duration_seconds", time.monotonic() - started, route=route)
 
-    # 既存テーマをプロンプトに追加
-    existing_themes_str = ", ".join(generated_themes) if generated_themes else "なし"
-    full_prompt = prompt.replace("{existing_themes}", existing_themes_str)
-    return full_prompt
+# エラー文言をメトリクスのラベル用に分類する
+def classify_error(error):
+    if error == "タイムアウトエラー":
+        return "timeout"
+    if error in ("APIキー認証エラー", "APIキー未設定エラー"):
+        return "auth"
+    if error == "APIリクエストエラー (429)":
+        return "rate_limited"
+    if error == "APIリクエストエラー (None)":
+        return "connection"
+    if error.startswith("APIリクエストエラー"):
+        return "http"
+    if error == "API応答解析エラー":
+        return "parse"
+    if error == DUPLICATE_ABORT_ERROR:
+        return "duplicate"
+    if error == CIRCUIT_OPEN_ERROR:
+        return "circuit_open"
+    if error == DEADLINE_ERROR:
+        return "deadline"
+    if error in (LIMITER_TIMEOUT_ERROR, LIMITER_QUEUE_FULL_ERROR):
+        return "limiter"
+    if error == CASSETTE_MISS_ERROR:
+        return "cassette_miss"
+    return "other"
 
-# API呼び出しを行うヘルパー関数
-def call_openrouter_api(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150):
-    if not OPENROUTER_API_KEY:
-        print("エラー: APIキーが設定されていません。")
-        return None, "APIキー未設定エラー"
+# 1回の上流呼び出しの結果を記録する (重複による打ち切りは重複として数える)
+def record_upstream_call(step, error, latency, attempt=None, keyword=None, model=None):
+    metrics.inc("gacha_upstream_attempts_total", step=step)
+    metrics.observe("gacha_upstream_latency_seconds", latency, step=step)
+    outcome = classify_error(error) if error else "ok"
+    if error == DUPLICATE_ABORT_ERROR:
+        metrics.inc("gacha_duplicates_total", step=step)
+    elif error:
+        metrics.inc("gacha_upstream_errors_total", step=step, kind=outcome)
+    if model is not None:
+        model_router.record(step, model, error, latency)
+    log_event(
+        "upstream_call", level="warning" if error and outcome != "duplicate" else "info",
+        step=step, attempt=attempt, kw=keyword_hash(keyword), model=model, latency=round(latency, 3), outcome=outcome,
+    )
+
+# --- プロンプトテンプレート ---
+# 入力トークンは1スピンあたりのコストとプリフィルの待ち時間の大半を占める。
+# プロンプトは名前とバリエーション (full / compact) ごとにここへ登録し、起動時に1度だけ
+# 固定部分と差し込み箇所 (${name}) に分解しておく。スピンごとの組み立ては連結だけで済み、
+# 各バリエーションのおおよそのトークン数を /stats で比べられる。
+# 使うバリエーションは PROMPT_VARIANT (全体) と PROMPT_VARIANTS (例: "batch=compact,theme=full") で切り替える。
+PROMPT_VARIANT = os.environ.get("PROMPT_VARIANT", "full")
+PROMPT_VARIANTS = dict(
+    pair.split("=", 1) for pair in os.environ.get("PROMPT_VARIANTS", "").replace(" ", "").split(",") if "=" in pair
+)
+
+# おおよそのトークン数 (日本語は1文字≒1トークン、英数字・記号は4文字≒1トークンで見積もる)
+def estimate_tokens(text):
+    ascii_chars = sum(1 for char in text if ord(char) < 128)
+    return (len(text) - ascii_chars) + math.ceil(ascii_chars / 4)
+
+class PromptTemplate:
+    _FIELD = re.compile(r"\$\{(\w+)\}")
+
+    def __init__(self, name, variant, text):
+        self.name = name
+        self.variant = variant
+        # 偶数番目が固定の文字列、奇数番目が差し込む値の名前
+        self._parts = self._FIELD.split(text)
+        self.fields = self._parts[1::2]
+        self.static_tokens = estimate_tokens("".join(self._parts[0::2]))
+        self.renders = 0
+        self.rendered_tokens = 0
+
+    def render(self, **values):
+        parts = self._parts[:]
+        for i in range(1, len(parts), 2):
+            parts[i] = str(values[parts[i]])
+        prompt = "".join(parts)
+        self.renders += 1
+        self.rendered_tokens += estimate_tokens(prompt)
+        return prompt
+
+class PromptRegistry:
+    def __init__(self):
+        self._templates = {} # 名前 -> {バリエーション -> PromptTemplate}
+
+    def register(self, name, variant, text):
+        self._templates.setdefault(name, {})[variant] = PromptTemplate(name, variant, text)
+
+    # 設定されたバリエーションを返す (そのテンプレートに無ければ full)
+    def get(self, name):
+        variants = self._templates[name]
+        return variants.get(PROMPT_VARIANTS.get(name, PROMPT_VARIANT)) or variants["full"]
+
+    def render(self, name, **values):
+        return self.get(name).render(**values)
+
+    def stats(self):
+        stats = {}
+        for name, variants in self._templates.items():
+            stats[name] = {
+                "active": self.get(name).variant,
+                "variants": {
+                    variant: {
+                        "static_tokens": template.static_tokens,
+                        "renders": template.renders,
+                        "avg_tokens": round(template.rendered_tokens / template.renders, 1) if template.renders else None,
+                    }
+                    for variant, template in variants.items()
+                },
+            }
+        return stats
+
+prompts = PromptRegistry()
+
+# 各プロンプトで共通の部品
+THEME_CONDITIONS = """
+以下の条件を厳守してください:
+- 楽しくて盛り上がる話題
+- 現実的でリアルなお題含む
+- 恋愛や仕事、学校に関する話題含む
+- 想像が膨らみやすい話題含む
+- ユーモアがあるお題含む
+- 具体的で想像しやすいお題とヒント
+"""
+THEME_CONDITIONS_COMPACT = "条件: 楽しく盛り上がり、具体的で想像しやすいお題とヒント。現実的・恋愛/仕事/学校・空想・ユーモアの話題も含める。\n"
+THEME_FORMAT = """
+形式は以下のJSON形式で**必ず**返してください。JSON以外の文章は不要です。
+{"theme": "具体的な話題", "hint": "会話のきっかけ"}
+例:
+{"theme": "夏の思い出", "hint": "子供の頃の夏休みの思い出や、最近の夏の楽しみ方を話してみよう"}
+{"theme": "映画館で頼む食べ物", "hint": "楽しい映画には外せない,美味しいグルメについて語ろう"}
+{"theme": "学生時代の失敗談", "hint": "思い出したくない黒歴史,今だから笑える失敗を思い出そう"}
+{"theme": "異世界に行ったら何をしたい？", "hint": "もし異世界に行ったら魔法使いとして旅に出る？街で商売して大儲け？"}
+"""
+THEME_FORMAT_COMPACT = """
+JSONのみで返答: {"theme": "具体的な話題", "hint": "会話のきっかけ"}
+例: {"theme": "夏の思い出", "hint": "子供の頃の夏休みや最近の夏の楽しみ方を話してみよう"}
+"""
+
+# 通常生成 (キーワードなし / あり)
+prompts.register("theme", "full", "明るく楽しい雑談テーマを1つ考えてください。" + THEME_FORMAT + THEME_CONDITIONS)
+prompts.register("theme", "compact", "明るく楽しい雑談テーマを1つ考えてください。" + THEME_FORMAT_COMPACT + THEME_CONDITIONS_COMPACT)
+prompts.register("theme_keyword", "full", "「${keyword}」というキーワードに必ず関連した、明るく楽しい雑談テーマを1つ考えてください。" + THEME_FORMAT + THEME_CONDITIONS)
+prompts.register("theme_keyword", "compact", "「${keyword}」に必ず関連した明るく楽しい雑談テーマを1つ考えてください。" + THEME_FORMAT_COMPACT + THEME_CONDITIONS_COMPACT)
+# Step 2 (具体名から話題を作る)
+prompts.register("step2", "full", "「${item}」というキーワードに必ず関連した、明るく楽しい雑談テーマを1つ考えてください(${keyword}に関する)。" + THEME_FORMAT + THEME_CONDITIONS)
+prompts.register("step2", "compact", "「${item}」(${keyword})に必ず関連した明るく楽しい雑談テーマを1つ考えてください。" + THEME_FORMAT_COMPACT + THEME_CONDITIONS_COMPACT)
+# Step 1 の候補リスト
+prompts.register("candidates", "full", """
+キーワード「${keyword}」に属する**固有名詞またはキャラクター**を、互いに重複しないように**${count}個**挙げてください。
+例：
+- キーワードが「戦国武将」なら、「織田信長」「武田信玄」など具体的な武将名。
+- キーワードが「アニメ」なら、「鬼滅の刃」「呪術廻戦」など具体的な作品名。
+- キーワードが「動物」なら、「アライグマ」「キリン」など具体的な動物の名。
+出力は具体名の文字列だけを並べたJSON配列で返してください。例：["織田信長", "武田信玄"]
+""")
+prompts.register("candidates", "compact", """キーワード「${keyword}」に属する**固有名詞またはキャラクター**を重複なく**${count}個**、具体名の文字列だけを並べたJSON配列で返してください。例：["織田信長", "武田信玄"]
+""")
+# Step 1 (候補リストが得られなかった場合に具体名を1件ずつ問い合わせる)
+prompts.register("step1", "full", """
+キーワード「${keyword}」に属する**固有名詞またはキャラクター**を被りがないように**1つだけ**挙げてください。${avoid_instruction}
+例：
+- キーワードが「戦国武将」なら、「織田信長」や「武田信玄」など具体的な武将名を1つ。
+- キーワードが「アニメ」なら、「鬼滅の刃」や「呪術廻戦」など具体的な作品名を1つ。
+- キーワードが「ドラゴンボール」なら、「孫悟空」や「フリーザ」など具体的なキャラクター名を1つ。
+- キーワードが「動物」なら、「アライグマ」や「キリン」など具体的な動物の名を1つ。
+出力は、選んだ具体名の単語**だけ**をテキストで返してください。例：「織田信長」
+""")
+prompts.register("step1", "compact", """キーワード「${keyword}」に属する**固有名詞またはキャラクター**を**1つだけ**、その具体名の単語**だけ**をテキストで返してください。例：「織田信長」${avoid_instruction}
+""")
+# バッチ生成 (instruction と item_format は呼び出し側で決める)
+prompts.register("batch", "full", """${instruction}
+形式は以下のJSON配列で**必ず**返してください。配列以外の文章は不要です。
+[${item_format}, ...]
+例:
+[{"theme": "夏の思い出", "hint": "子供の頃の夏休みの思い出や、最近の夏の楽しみ方を話してみよう"}, {"theme": "学生時代の失敗談", "hint": "思い出したくない黒歴史,今だから笑える失敗を思い出そう"}]
+""" + THEME_CONDITIONS + "- 配列内で似た話題を繰り返さない\n")
+prompts.register("batch", "compact", """${instruction}
+JSON配列のみで返答: [${item_format}, ...]
+""" + THEME_CONDITIONS_COMPACT + "配列内で似た話題を繰り返さない。\n")
+# fused (具体名の選択とテーマ生成を1回で行う)
+prompts.register("fused", "full", """キーワード「${keyword}」に属する**固有名詞またはキャラクター**を被りがないように**1つだけ**選び、それに必ず関連した明るく楽しい雑談テーマを1つ考えてください。${avoid_instruction}
+形式は以下のJSON形式で**必ず**返してください。
+{"item": "選んだ固有名詞", "theme": "具体的な話題", "hint": "会話のきっかけ"}
+例:
+{"item": "織田信長", "theme": "もし織田信長が現代の上司だったら", "hint": "厳しい？頼もしい？一緒に働くならどんな職場になるか想像しよう"}
+""" + THEME_CONDITIONS)
+prompts.register("fused", "compact", """キーワード「${keyword}」に属する**固有名詞またはキャラクター**を**1つだけ**選び、それに必ず関連した明るく楽しい雑談テーマを1つ考えてください。${avoid_instruction}
+JSONのみで返答: {"item": "選んだ固有名詞", "theme": "具体的な話題", "hint": "会話のきっかけ"}
+""" + THEME_CONDITIONS_COMPACT)
 
+# 最近使った具体名を避けるよう指示する一文 (なければ空)
+def create_avoid_instruction():
+    avoid_list = list(recent_specific_items)
+    if not avoid_list:
+        return ""
+    return f"\n**ただし、以下のJSONリストに含まれる単語は避けてください: {json.dumps(avoid_list, ensure_ascii=False)}**"
+
+# プロンプトを生成するヘルパー関数 (specific=False または keywordなし の場合のみ担当)
+def create_prompt(keyword=None, specific=False): # specific引数はgenerate_themeからの呼び出し整合性のために残す
+    # 重複はプロンプトではなく generated_themes で判定するため、生成履歴はプロンプトに含めない
+    if keyword:
+        return prompts.render("theme_keyword", keyword=keyword)
+    return prompts.render("theme")
+
+# Step 2 のプロンプトを生成するヘルパー関数 (具体名から話題を作る)
+def create_step2_prompt(specific_item, keyword):
+    return prompts.render("step2", item=specific_item, keyword=keyword)
+
+# API呼び出しのヘッダーとペイロードを組み立てる (同期版・非同期版で共通)
+# JSONモード (response_format) に対応しているモデル (前方一致, カンマ区切り)
+OPENROUTER_JSON_MODE_MODELS = tuple(
+    prefix.strip() for prefix in os.environ.get("OPENROUTER_JSON_MODE_MODELS", "openai/").split(",") if prefix.strip()
+)
+
+# json_mode=True なら、対応モデルではJSONオブジェクトだけを返すよう指定する
+def build_api_request(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, json_mode=False):
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json"
@@ -89,180 +1100,2702 @@ def call_openrouter_api(prompt, model="openai/gpt-4.1-nano", temperature=0.9, ma
         "temperature": temperature,
         "max_tokens": max_tokens
     }
+    if json_mode and model.startswith(OPENROUTER_JSON_MODE_MODELS):
+        payload["response_format"] = {"type": "json_object"}
+    return headers, payload
+
+# API呼び出しを1回だけ行うヘルパー関数 (ヘッジなどの制御は call_openrouter_api 側で行う)
+def send_openrouter_request(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, timeout=None, json_mode=False):
+    if not OPENROUTER_API_KEY:
+        log_event("api_error", level="error", error="APIキー未設定エラー")
+        return None, "APIキー未設定エラー"
+
+    headers, payload = build_api_request(prompt, model, temperature, max_tokens, json_mode)
 
     try:
-        response = requests.post(OPENROUTER_API_URL, headers=headers, json=payload, timeout=30) # タイムアウト設定
+        # プール済みのkeep-alive接続を再利用する (接続/読み取りタイムアウトは個別指定)
+        response = get_http_session().post(
+            OPENROUTER_API_URL, headers=headers, json=payload,
+            timeout=budget_timeouts(timeout),
+        )
         response.raise_for_status()
         result = response.json()
         content = result['choices'][0]['message']['content']
         return content, None # 成功時はコンテンツとNone(エラーなし)を返す
     except requests.exceptions.Timeout:
-        print("APIリクエストがタイムアウトしました。")
+        log_event("api_error", level="warning", error="タイムアウトエラー")
         return None, "タイムアウトエラー"
     except requests.exceptions.RequestException as e:
-        print(f"APIリクエストエラー: {e}")
+        log_event("api_error", level="warning", error="APIリクエストエラー", detail=str(e))
+        # 接続エラーの場合は応答オブジェクトが存在しない
+        status_code = e.response.status_code if e.response is not None else None
+        if status_code == 429:
+            note_rate_limit(e.response.headers)
         # 401エラーの場合は特別なメッセージを出すなど、詳細なハンドリングも可能
-        if response.status_code == 401:
+        if status_code == 401:
              return None, "APIキー認証エラー"
-        return None, f"APIリクエストエラー ({response.status_code})"
+        return None, f"APIリクエストエラー ({status_code})"
+    except (KeyError, IndexError, json.JSONDecodeError) as e:
+        log_event("api_error", level="warning", error="API応答解析エラー", detail=str(e))
+        return None, "API応答解析エラー"
+    except Exception as e:
+        log_event("api_error", level="error", error="予期せぬAPIエラー", detail=str(e))
+        return None, "予期せぬAPIエラー"
+
+# --- 非同期HTTPクライアント (ASGI用) ---
+# イベントループ上で待機するため、応答待ちの間もワーカーは他のスピンを処理できる。
+# 同時に待機できるスピン数の上限 = 1ワーカーあたりの最大同時接続数
+OPENROUTER_ASYNC_MAX_CONNECTIONS = int(os.environ.get("OPENROUTER_ASYNC_MAX_CONNECTIONS", "200"))
+_async_client = None
+_async_client_owner = None # (PID, イベントループ) の組
+
+def get_async_http_client():
+    global _async_client, _async_client_owner
+    owner = (os.getpid(), asyncio.get_running_loop())
+    if _async_client is None or _async_client_owner != owner:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(OPENROUTER_READ_TIMEOUT, connect=OPENROUTER_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=OPENROUTER_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENROUTER_POOL_SIZE,
+            ),
+        )
+        _async_client_owner = owner
+    return _async_client
+
+async def close_async_http_client():
+    global _async_client, _async_client_owner
+    if _async_client is not None and _async_client_owner == (os.getpid(), asyncio.get_running_loop()):
+        await _async_client.aclose()
+    _async_client = None
+    _async_client_owner = None
+
+# API呼び出しを1回だけ行うヘルパー関数 (非同期版, 戻り値とエラー文言は同期版と同じ)
+async def send_openrouter_request_async(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, timeout=None, json_mode=False):
+    if not OPENROUTER_API_KEY:
+        log_event("api_error", level="error", error="APIキー未設定エラー")
+        return None, "APIキー未設定エラー"
+
+    headers, payload = build_api_request(prompt, model, temperature, max_tokens, json_mode)
+
+    try:
+        connect_timeout, read_timeout = budget_timeouts(timeout)
+        response = await get_async_http_client().post(
+            OPENROUTER_API_URL, headers=headers, json=payload,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        response.raise_for_status()
+        result = response.json()
+        content = result['choices'][0]['message']['content']
+        return content, None
+    except httpx.TimeoutException:
+        log_event("api_error", level="warning", error="タイムアウトエラー")
+        return None, "タイムアウトエラー"
+    except httpx.HTTPStatusError as e:
+        log_event("api_error", level="warning", error="APIリクエストエラー", detail=str(e))
+        if e.response.status_code == 429:
+            note_rate_limit(e.response.headers)
+        if e.response.status_code == 401:
+            return None, "APIキー認証エラー"
+        return None, f"APIリクエストエラー ({e.response.status_code})"
+    except httpx.HTTPError as e:
+        log_event("api_error", level="warning", error="APIリクエストエラー", detail=str(e))
+        return None, "APIリクエストエラー (None)"
     except (KeyError, IndexError, json.JSONDecodeError) as e:
-        print(f"API応答の解析エラー: {e}")
+        log_event("api_error", level="warning", error="API応答解析エラー", detail=str(e))
         return None, "API応答解析エラー"
     except Exception as e:
-        print(f"予期せぬAPI関連エラー: {e}")
+        log_event("api_error", level="error", error="予期せぬAPIエラー", detail=str(e))
         return None, "予期せぬAPIエラー"
 
-# テーマ生成関数（2ステップ対応版）
-def generate_theme(keyword=None, specific=False):
+# --- ストリーミング応答と重複テーマの早期打ち切り ---
+# 重複したテーマでも従来は応答を最後まで待って (料金を払って) から再試行していた。
+# ストリーミングで受け取り、"theme" の値が閉じた時点で generated_themes と照合し、
+# 重複ならその場で接続を閉じて hint 部分を生成させずに再試行へ移る。
+EARLY_ABORT_ENABLED = os.environ.get("EARLY_ABORT_ENABLED", "1") != "0"
+DUPLICATE_ABORT_ERROR = "重複テーマ (生成中断)"
+# 途中経過の通知先 (SSEのスピンが設定する)。設定されていれば "theme" / "hint" が閉じた時点で
+# listener(受信の識別子, "theme" | "hint", データ) を呼ぶ (下の「ストリーミング生成 (SSE)」を参照)
+stream_listener = contextvars.ContextVar("stream_listener", default=None)
+
+# API呼び出しをストリーミングで行うヘルパー関数
+# 受信したテキスト片を (delta, None) でyieldし、失敗時は (None, error) をyieldして終わる
+def stream_openrouter_api(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, timeout=None, json_mode=False):
+    if cassette.replaying:
+        # カセットの再生中は記録された応答を1つの断片として返す
+        content, error, delay = cassette.replay(prompt, model, max_tokens, False, timeout, json_mode)
+        time.sleep(delay)
+        yield content, error
+        return
+    if not OPENROUTER_API_KEY:
+        log_event("api_error", level="error", error="APIキー未設定エラー")
+        yield None, "APIキー未設定エラー"
+        return
+
+    headers, payload = build_api_request(prompt, model, temperature, max_tokens, json_mode)
+    payload["stream"] = True
+    # 読み取りタイムアウトは受信ごとなので、少しずつ届き続ける応答は受信全体の締め切りで打ち切る
+    deadline = None if timeout is None else time.monotonic() + timeout
+    try:
+        with get_http_session().post(
+            OPENROUTER_API_URL, headers=headers, json=payload, stream=True,
+            timeout=budget_timeouts(timeout),
+        ) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=False):
+                if deadline is not None and time.monotonic() > deadline:
+                    raise requests.exceptions.ReadTimeout("stream deadline exceeded")
+                # SSEのコメント行 (": OPENROUTER PROCESSING") や空行は読み飛ばす
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                chunk = json.loads(data)
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta, None
+    except requests.exceptions.Timeout:
+        log_event("api_error", level="warning", error="タイムアウトエラー")
+        yield None, "タイムアウトエラー"
+    except requests.exceptions.RequestException as e:
+        log_event("api_error", level="warning", error="APIリクエストエラー", detail=str(e))
+        status_code = e.response.status_code if e.response is not None else None
+        if status_code == 429:
+            note_rate_limit(e.response.headers)
+        if status_code == 401:
+            yield None, "APIキー認証エラー"
+        else:
+            yield None, f"APIリクエストエラー ({status_code})"
+    except (KeyError, IndexError, json.JSONDecodeError) as e:
+        log_event("api_error", level="warning", error="API応答解析エラー", detail=str(e))
+        yield None, "API応答解析エラー"
+
+_JSON_FIELD_PATTERNS = {}
+
+# 受信途中のJSONテキストから文字列フィールドを取り出す (値の閉じ引用符がまだなら None)
+def extract_partial_json_field(buffer, field):
+    pattern = _JSON_FIELD_PATTERNS.get(field)
+    if pattern is None:
+        pattern = _JSON_FIELD_PATTERNS[field] = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+    match = pattern.search(buffer)
+    if not match:
+        return None
+    i = match.end()
+    while i < len(buffer):
+        char = buffer[i]
+        if char == "\\":
+            i += 2
+            continue
+        if char == '"':
+            try:
+                return json.loads('"' + buffer[match.end():i] + '"')
+            except json.JSONDecodeError:
+                return None
+        i += 1
+    return None
+
+# API呼び出しをストリーミングで行うヘルパー関数 (非同期版)
+async def stream_openrouter_api_async(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, timeout=None, json_mode=False):
+    if cassette.replaying:
+        content, error, delay = cassette.replay(prompt, model, max_tokens, False, timeout, json_mode)
+        await asyncio.sleep(delay)
+        yield content, error
+        return
+    if not OPENROUTER_API_KEY:
+        log_event("api_error", level="error", error="APIキー未設定エラー")
+        yield None, "APIキー未設定エラー"
+        return
+
+    headers, payload = build_api_request(prompt, model, temperature, max_tokens, json_mode)
+    payload["stream"] = True
+    try:
+        connect_timeout, read_timeout = budget_timeouts(timeout)
+        async with get_async_http_client().stream(
+            "POST", OPENROUTER_API_URL, headers=headers, json=payload,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta, None
+    except httpx.TimeoutException:
+        log_event("api_error", level="warning", error="タイムアウトエラー")
+        yield None, "タイムアウトエラー"
+    except httpx.HTTPStatusError as e:
+        log_event("api_error", level="warning", error="APIリクエストエラー", detail=str(e))
+        if e.response.status_code == 429:
+            note_rate_limit(e.response.headers)
+        if e.response.status_code == 401:
+            yield None, "APIキー認証エラー"
+        else:
+            yield None, f"APIリクエストエラー ({e.response.status_code})"
+    except httpx.HTTPError as e:
+        log_event("api_error", level="warning", error="APIリクエストエラー", detail=str(e))
+        yield None, "APIリクエストエラー (None)"
+    except (KeyError, IndexError, json.JSONDecodeError) as e:
+        log_event("api_error", level="warning", error="API応答解析エラー", detail=str(e))
+        yield None, "API応答解析エラー"
+
+# 早期打ち切りで節約できた時間とトークンの集計
+# 打ち切らなかった場合の所要時間・出力量は、最後まで受信できた応答の移動平均で見積もる
+# (ストリーミングでは1つの差分がおおむね1トークンに相当する)
+class StreamAbortStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.aborted = 0
+        self.avg_seconds = None
+        self.avg_tokens = None
+        self.saved_seconds = 0.0
+        self.saved_tokens = 0
+
+    def record_completed(self, seconds, tokens):
+        with self._lock:
+            self.completed += 1
+            if self.avg_seconds is None:
+                self.avg_seconds, self.avg_tokens = seconds, tokens
+            else:
+                self.avg_seconds += (seconds - self.avg_seconds) * 0.1
+                self.avg_tokens += (tokens - self.avg_tokens) * 0.1
+
+    def record_aborted(self, seconds, tokens):
+        with self._lock:
+            self.aborted += 1
+            if self.avg_seconds is not None:
+                self.saved_seconds += max(0.0, self.avg_seconds - seconds)
+                self.saved_tokens += max(0, round(self.avg_tokens - tokens))
+
+    def stats(self):
+        return {
+            "enabled": EARLY_ABORT_ENABLED,
+            "completed": self.completed,
+            "aborted": self.aborted,
+            "saved_seconds": round(self.saved_seconds, 3),
+            "saved_tokens": self.saved_tokens,
+        }
+
+stream_abort_stats = StreamAbortStats()
+
+# ストリーミングで受信中のテキストを見張り、"theme" が閉じたら重複を確かめる (同期版・非同期版で共有する)
+class StreamWatcher:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.listener = stream_listener.get()
+        self.buffer = ""
+        self.tokens = 0
+        self.theme = None
+        self.hint = None
+
+    # 受信した断片を加える。重複テーマで打ち切るべきなら True を返す
+    def feed(self, delta):
+        self.buffer += delta
+        self.tokens += 1
+        if self.theme is None:
+            self.theme = extract_partial_json_field(self.buffer, "theme")
+            if self.theme is None:
+                return False
+            if self.theme in generated_themes:
+                if EARLY_ABORT_ENABLED:
+                    log_event("stream_aborted", outcome="duplicate", theme=self.theme)
+                    stream_abort_stats.record_aborted(time.monotonic() - self.started, self.tokens)
+                    return True
+                self.listener = None # 打ち切らない場合も重複したテーマは画面に出さない
+            elif self.listener:
+                self.listener(self, "theme", {"theme": self.theme})
+        elif self.hint is None and self.listener:
+            self.hint = extract_partial_json_field(self.buffer, "hint")
+            if self.hint is not None:
+                self.listener(self, "hint", {"hint": self.hint})
+        return False
+
+    def completed(self):
+        stream_abort_stats.record_completed(time.monotonic() - self.started, self.tokens)
+
+# ストリーミングで受信し、受信中のテーマが重複していれば打ち切る。戻り値は send_openrouter_request と同じ形
+# (打ち切った場合はカセットに記録できるよう、受信済みの部分を DUPLICATE_ABORT_ERROR と一緒に返す)
+def send_openrouter_request_abortable(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, timeout=None, json_mode=False):
+    watcher = StreamWatcher()
+    stream = stream_openrouter_api(prompt, model, temperature, max_tokens, timeout, json_mode)
+    try:
+        for delta, error in stream:
+            if error:
+                return None, error
+            if watcher.feed(delta):
+                return watcher.buffer, DUPLICATE_ABORT_ERROR
+    finally:
+        stream.close() # 打ち切り時はここで接続を閉じる
+    watcher.completed()
+    return watcher.buffer, None
+
+async def send_openrouter_request_abortable_async(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, timeout=None, json_mode=False):
+    watcher = StreamWatcher()
+    stream = stream_openrouter_api_async(prompt, model, temperature, max_tokens, timeout, json_mode)
+    try:
+        async for delta, error in stream:
+            if error:
+                return None, error
+            if watcher.feed(delta):
+                return watcher.buffer, DUPLICATE_ABORT_ERROR
+    finally:
+        await stream.aclose()
+    watcher.completed()
+    return watcher.buffer, None
+
+# 重複の早期打ち切りか途中経過の通知に使う場合はストリーミングで受信する
+def use_streaming_send(abort_on_duplicate):
+    return abort_on_duplicate and (EARLY_ABORT_ENABLED or stream_listener.get() is not None)
+
+# --- 締め切り (デッドライン) とバックオフ ---
+# 1回のスピンに使える時間の上限を決め、各API呼び出しには残り時間だけをタイムアウトとして渡す。
+# 一時的なエラー (タイムアウト・429・5xx・接続エラー) の後はジッター付きの指数バックオフを挟み、
+# 429 の Retry-After / X-RateLimit-Reset が示す時刻まではこのワーカーから呼び出さない。
+# 残り時間では呼び出しが間に合わない場合は、最後まで粘らずに早めにフォールバックする。
+SPIN_DEADLINE_SECONDS = float(os.environ.get("SPIN_DEADLINE_SECONDS", "8")) # 0以下なら締め切りなし
+RETRY_BACKOFF_BASE = float(os.environ.get("RETRY_BACKOFF_BASE", "0.25"))
+RETRY_BACKOFF_MAX = float(os.environ.get("RETRY_BACKOFF_MAX", "2"))
+DEADLINE_MIN_CALL_SECONDS = 1.0 # 残り時間がこれを切ったら新しい呼び出しはしない
+RATE_LIMIT_MAX_WAIT = 60.0 # ヘッダーの値が大きすぎる場合の上限
+DEADLINE_ERROR = "締め切り超過"
+
+_rate_limited_until = 0.0
+_retry_stats_lock = threading.Lock()
+retry_stats = {"backoffs": 0, "backoff_seconds": 0.0, "rate_limited": 0, "deadline_exceeded": 0}
+
+# 429応答のヘッダーから待つべき秒数を読み取る (指定がなければ None)
+def parse_rate_limit_wait(headers):
+    value = headers.get("Retry-After")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            try:
+                return parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get("X-RateLimit-Reset")
+    if reset:
+        try:
+            reset = float(reset)
+        except ValueError:
+            return None
+        if reset > 1e12: # OpenRouterはミリ秒単位のUNIX時刻を返す
+            reset /= 1000
+        return reset - time.time()
+    return None
+
+def note_rate_limit(headers):
+    global _rate_limited_until
+    wait = parse_rate_limit_wait(headers)
+    with _retry_stats_lock:
+        retry_stats["rate_limited"] += 1
+        if wait is None:
+            return # ヘッダーがなければ通常の指数バックオフにまかせる
+        wait = min(max(wait, 0.0), RATE_LIMIT_MAX_WAIT)
+        _rate_limited_until = max(_rate_limited_until, time.monotonic() + wait)
+    log_event("rate_limited", level="warning", wait=round(wait, 1))
+
+def rate_limit_wait():
+    return max(0.0, _rate_limited_until - time.monotonic())
+
+# 待てば成功しうるエラーか (タイムアウト・接続エラー・429・5xx)
+def is_transient_error(error):
+    if error == "タイムアウトエラー":
+        return True
+    match = re.fullmatch(r"APIリクエストエラー \((\w+)\)", error or "")
+    return match is not None and (match.group(1) in ("None", "429") or match.group(1).startswith("5"))
+
+# 1回のスピン (または補充1回分) の締め切りと再試行の間隔を管理する
+class RetrySchedule:
+    def __init__(self, timeout=None):
+        self.deadline = time.monotonic() + timeout if timeout and timeout > 0 else None
+        self.failures = 0 # 連続した一時的エラーの回数
+        self.expired = False
+        self.overloaded = False # 送信待ちで溢れた (流量制御の枠が取れなかった)
+
+    # 残り秒数 (締め切りなしなら None)
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    # 次の呼び出しまでに待つ秒数。締め切りに間に合わないなら None
+    def next_wait(self):
+        wait = rate_limit_wait()
+        if self.failures:
+            wait = max(wait, random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (self.failures - 1))))
+        remaining = self.remaining()
+        if remaining is not None and remaining - wait < DEADLINE_MIN_CALL_SECONDS:
+            if not self.expired:
+                self.expired = True
+                with _retry_stats_lock:
+                    retry_stats["deadline_exceeded"] += 1
+            return None
+        if wait:
+            with _retry_stats_lock:
+                retry_stats["backoffs"] += 1
+                retry_stats["backoff_seconds"] += wait
+        return wait
+
+    def record(self, error):
+        self.failures = self.failures + 1 if is_transient_error(error) else 0
+        if error in (LIMITER_TIMEOUT_ERROR, LIMITER_QUEUE_FULL_ERROR):
+            self.overloaded = True
+
+    # 締め切りや混雑で生成を諦めたか (その場合はテーマバンクで代替する)
+    # 最後の試行で時間を使い切った場合は next_wait が呼ばれず expired にならないので、残り時間も見る
+    def gave_up(self):
+        remaining = self.remaining()
+        return self.expired or self.overloaded or (remaining is not None and remaining < DEADLINE_MIN_CALL_SECONDS)
+
+def get_retry_stats():
+    with _retry_stats_lock:
+        stats = dict(retry_stats)
+    stats["backoff_seconds"] = round(stats["backoff_seconds"], 3)
+    stats["deadline_seconds"] = SPIN_DEADLINE_SECONDS
+    stats["rate_limited_for"] = round(rate_limit_wait(), 3)
+    return stats
+
+# --- 送信の流量制御 (同時実行数の上限とトークンバケット) ---
+# 混雑時に全ワーカーが一斉にOpenRouterへ送ると429が返り、それがさらにリトライを呼ぶ。
+# 1リクエストごとに「同時実行の枠」と「トークンバケットのトークン」を1つずつ取ってから送る。
+# SHARED_STATE_DB 指定時はSQLiteで同じマシン上のワーカー全体の上限とし、未指定ならワーカーごとの上限。
+# 空きがなければ待ち行列 (長さに上限あり) で待ち、待ちきれなければ送らずに失敗させる。
+# カプセルの補充などバックグラウンドの生成と対話的なスピンが同時に枠を待っている間は、直近 LIMITER_SHARE_WINDOW 回の
+# 取得のうちバックグラウンドの分が OPENROUTER_BACKGROUND_SHARE の割合に収まるよう、多い側が順番を譲る。
+# 対話的なスピンは混雑時も (1 - OPENROUTER_BACKGROUND_SHARE) 以上を使え、空いている分はどちらも制限なく使える
+# (補充を止めきるとカプセルのプールが空になり、1回で5件生成する補充の代わりに1件ずつの生成で枠を使うため)。
+OPENROUTER_MAX_IN_FLIGHT = int(os.environ.get("OPENROUTER_MAX_IN_FLIGHT", "16")) # 0なら無制限
+OPENROUTER_MAX_RPS = float(os.environ.get("OPENROUTER_MAX_RPS", "10")) # 0なら無制限
+OPENROUTER_LIMITER_QUEUE = int(os.environ.get("OPENROUTER_LIMITER_QUEUE", "64")) # 1ワーカーあたりの待ち行列の長さ
+OPENROUTER_LIMITER_MAX_WAIT = float(os.environ.get("OPENROUTER_LIMITER_MAX_WAIT", "5"))
+LIMITER_POLL_INTERVAL = 0.05 # 同時実行の枠が空くのを確かめる間隔 (秒)
+LIMITER_LEASE_SECONDS = 120 # 解放されないまま落ちたワーカーの枠を回収するまでの秒数
+OPENROUTER_BACKGROUND_SHARE = float(os.environ.get("OPENROUTER_BACKGROUND_SHARE", "0.25"))
+LIMITER_SHARE_WINDOW = 100
+LIMITER_TIMEOUT_ERROR = "送信待ちタイムアウト"
+LIMITER_QUEUE_FULL_ERROR = "送信待ち行列が満杯"
+
+# 補充スレッドなどバックグラウンドで生成している間は True (流量制御で対話的なスピンに譲る)
+background_work = contextvars.ContextVar("background_work", default=False)
+
+# ワーカー内で数える枠とトークン
+class LocalPermits:
+    def __init__(self, max_in_flight=OPENROUTER_MAX_IN_FLIGHT, rate=OPENROUTER_MAX_RPS):
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self._in_flight = 0
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # 枠を取れたら (permit, 0)、取れなければ (None, 次に試すまでの目安秒数) を返す
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.rate > 0:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+            if self.max_in_flight > 0 and self._in_flight >= self.max_in_flight:
+                return None, LIMITER_POLL_INTERVAL
+            if self.rate > 0:
+                if self._tokens < 1:
+                    return None, (1 - self._tokens) / self.rate
+                self._tokens -= 1
+            self._in_flight += 1
+            return True, 0.0
+
+    def release(self, permit):
+        with self._lock:
+            self._in_flight -= 1
+
+    # メモリ上の操作だけなのでイベントループ上でそのまま行う
+    async def try_acquire_async(self):
+        return self.try_acquire()
+
+    async def release_async(self, permit):
+        self.release(permit)
+
+    def in_flight(self):
+        return self._in_flight
+
+# SQLiteで数える、同じマシン上のワーカー全体で共有の枠とトークン
+# 枠は期限付きのリース行として持ち、解放前にワーカーが落ちても期限切れで回収される
+class SharedPermits:
+    def __init__(self, db, max_in_flight=OPENROUTER_MAX_IN_FLIGHT, rate=OPENROUTER_MAX_RPS):
+        self.db = db
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = max(1.0, rate)
+
+    def try_acquire(self):
+        conn = self.db.connection()
+        now = time.time()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM outbound_leases WHERE expires < ?", (now,))
+                in_flight = conn.execute("SELECT COUNT(*) FROM outbound_leases").fetchone()[0]
+                row = conn.execute("SELECT tokens, updated FROM outbound_bucket WHERE id = 1").fetchone()
+                tokens = self.burst if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+                permit, wait = None, 0.0
+                if self.max_in_flight > 0 and in_flight >= self.max_in_flight:
+                    wait = LIMITER_POLL_INTERVAL
+                elif self.rate > 0 and tokens < 1:
+                    wait = (1 - tokens) / self.rate
+                else:
+                    tokens -= 1 if self.rate > 0 else 0
+                    permit = conn.execute(
+                        "INSERT INTO outbound_leases (expires) VALUES (?)", (now + LIMITER_LEASE_SECONDS,)
+                    ).lastrowid
+                conn.execute("INSERT OR REPLACE INTO outbound_bucket (id, tokens, updated) VALUES (1, ?, ?)", (tokens, now))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            # 共有の状態が使えない場合は流量制御より生成を優先して通す
+            log_event("limiter_error", level="warning", op="acquire", detail=str(e))
+            return -1, 0.0
+        return permit, wait
+
+    def release(self, permit):
+        if permit < 0:
+            return
+        try:
+            self.db.connection().execute("DELETE FROM outbound_leases WHERE id = ?", (permit,))
+        except sqlite3.Error as e:
+            log_event("limiter_error", level="warning", op="release", detail=str(e))
+
+    # BEGIN IMMEDIATE は他のワーカーが書き込み中だと busy timeout まで待つため、イベントループを止めないよう別スレッドで行う
+    async def try_acquire_async(self):
+        attempt = asyncio.ensure_future(asyncio.to_thread(self.try_acquire))
+        try:
+            return await asyncio.shield(attempt)
+        except asyncio.CancelledError:
+            # 待っている間にキャンセルされても、スレッド側で取れた枠はリースの期限を待たずに返す
+            attempt.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, attempt):
+        if attempt.cancelled() or attempt.exception() is not None:
+            return
+        permit, _ = attempt.result()
+        if permit is not None and permit >= 0:
+            asyncio.get_running_loop().run_in_executor(None, self.release, permit)
+
+    async def release_async(self, permit):
+        if permit >= 0:
+            await asyncio.to_thread(self.release, permit)
+
+    def in_flight(self):
+        try:
+            return self.db.connection().execute(
+                "SELECT COUNT(*) FROM outbound_leases WHERE expires >= ?", (time.time(),)
+            ).fetchone()[0]
+        except sqlite3.Error:
+            return None
+
+class OutboundLimiter:
+    def __init__(self, permits, queue_size=OPENROUTER_LIMITER_QUEUE, max_wait=OPENROUTER_LIMITER_MAX_WAIT):
+        self.permits = permits
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self._waiting = 0
+        self._waiting_interactive = 0 # 待ち行列のうち対話的なスピンの数
+        self._waiting_background = 0
+        self._recent = deque(maxlen=LIMITER_SHARE_WINDOW) # 直近の取得がバックグラウンドだったか
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.background_acquired = 0
+        self.queued = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    # 待つ秒数をyieldし、待った後に permits.try_acquire() の結果を送り返してもらう。最後に (permit, error) を返す
+    # (同期版・非同期版で共有する手順。枠の取得そのものは呼び出し側がそれぞれの方法で行う)
+    # timeout は呼び出し側の残り時間。送信に使う時間を残すため、その分だけ早めに諦める
+    def _acquire_steps(self, timeout, background=False):
+        permit, wait = yield 0.0
+        if permit is not None:
+            self._count_acquired(background)
+            return permit, None
+        with self._lock:
+            if self._waiting >= self.queue_size:
+                self.rejected += 1
+                return None, LIMITER_QUEUE_FULL_ERROR
+            self._waiting += 1
+            if background:
+                self._waiting_background += 1
+            else:
+                self._waiting_interactive += 1
+            self.queued += 1
+        started = time.monotonic()
+        max_wait = self.max_wait if timeout is None else min(self.max_wait, timeout - DEADLINE_MIN_CALL_SECONDS)
+        try:
+            while True:
+                left = max_wait - (time.monotonic() - started)
+                if left <= 0:
+                    self.timed_out += 1
+                    return None, LIMITER_TIMEOUT_ERROR
+                # 待機中のワーカーが同時に取りに行かないよう少しずらす
+                permit, wait = yield min(left, max(wait, LIMITER_POLL_INTERVAL) * random.uniform(1.0, 1.5))
+                if permit is not None:
+                    self._count_acquired(background)
+                    return permit, None
+        finally:
+            with self._lock:
+                self._waiting -= 1
+                if background:
+                    self._waiting_background -= 1
+                else:
+                    self._waiting_interactive -= 1
+                self.wait_seconds += time.monotonic() - started
+
+    def _count_acquired(self, background):
+        with self._lock:
+            self.acquired += 1
+            self.background_acquired += 1 if background else 0
+            self._recent.append(background)
+
+    # 相手側も枠を待っていて、直近の取得で自分の側が取り分を超えていれば順番を譲る
+    def _yields(self, background):
+        with self._lock:
+            share = self._recent.count(True) / len(self._recent) if self._recent else 0.0
+            if background:
+                return self._waiting_interactive > 0 and share >= OPENROUTER_BACKGROUND_SHARE
+            return self._waiting_background > 0 and share < OPENROUTER_BACKGROUND_SHARE
+
+    def _try_acquire(self, background):
+        if self._yields(background):
+            return None, LIMITER_POLL_INTERVAL
+        return self.permits.try_acquire()
+
+    async def _try_acquire_async(self, background):
+        if self._yields(background):
+            return None, LIMITER_POLL_INTERVAL
+        return await self.permits.try_acquire_async()
+
+    def acquire(self, timeout=None):
+        background = background_work.get()
+        steps = self._acquire_steps(timeout, background)
+        try:
+            wait = next(steps)
+            while True:
+                if wait:
+                    time.sleep(wait)
+                wait = steps.send(self._try_acquire(background))
+        except StopIteration as stop:
+            return stop.value
+
+    async def acquire_async(self, timeout=None):
+        background = background_work.get()
+        steps = self._acquire_steps(timeout, background)
+        try:
+            wait = next(steps)
+            while True:
+                if wait:
+                    await asyncio.sleep(wait)
+                wait = steps.send(await self._try_acquire_async(background))
+        except StopIteration as stop:
+            return stop.value
+        finally:
+            steps.close() # キャンセルされた場合も待ち行列から抜ける
+
+    def release(self, permit):
+        self.permits.release(permit)
+
+    async def release_async(self, permit):
+        await self.permits.release_async(permit)
+
+    def stats(self):
+        return {
+            "max_in_flight": OPENROUTER_MAX_IN_FLIGHT,
+            "max_rps": OPENROUTER_MAX_RPS,
+            "background_share": OPENROUTER_BACKGROUND_SHARE,
+            "shared": isinstance(self.permits, SharedPermits),
+            "in_flight": self.permits.in_flight(),
+            "waiting": self._waiting,
+            "acquired": self.acquired,
+            "background_acquired": self.background_acquired,
+            "queued": self.queued,
+            "timed_out": self.timed_out,
+            "rejected": self.rejected,
+            "wait_seconds": round(self.wait_seconds, 3),
+        }
+
+outbound_limiter = OutboundLimiter(SharedPermits(shared_state_db) if SHARED_STATE_DB else LocalPermits())
+
+# 流量制御の枠を取ってから送り、送り終えたら返す。待った分だけ残り時間を減らして渡す
+def send_with_permit(send, prompt, model, temperature, max_tokens, timeout=None, json_mode=False):
+    started = time.monotonic()
+    permit, error = outbound_limiter.acquire(timeout)
+    if error:
+        return None, error
+    try:
+        if timeout is not None:
+            timeout -= time.monotonic() - started
+        return send(prompt, model, temperature, max_tokens, timeout, json_mode)
+    finally:
+        outbound_limiter.release(permit)
+
+async def send_with_permit_async(send, prompt, model, temperature, max_tokens, timeout=None, json_mode=False):
+    started = time.monotonic()
+    permit, error = await outbound_limiter.acquire_async(timeout)
+    if error:
+        return None, error
+    try:
+        if timeout is not None:
+            timeout -= time.monotonic() - started
+        return await send(prompt, model, temperature, max_tokens, timeout, json_mode)
+    finally:
+        await outbound_limiter.release_async(permit)
+
+# --- ヘッジリクエスト ---
+# 応答時間のロングテール対策。最初のリクエストが直近の応答時間のパーセンタイル値を
+# 過ぎても返らなければ同じリクエストをもう1本送り、先に成功した方を採用して他方は取り消す。
+# 追加コストを抑えるため、ヘッジの発行数はトークンバケットで1秒あたりの上限を設ける。
+OPENROUTER_HEDGE_ENABLED = os.environ.get("OPENROUTER_HEDGE_ENABLED", "0") == "1"
+OPENROUTER_HEDGE_PERCENTILE = float(os.environ.get("OPENROUTER_HEDGE_PERCENTILE", "95"))
+OPENROUTER_HEDGE_MIN_DELAY = float(os.environ.get("OPENROUTER_HEDGE_MIN_DELAY", "0.5"))
+OPENROUTER_HEDGE_MAX_PER_SECOND = float(os.environ.get("OPENROUTER_HEDGE_MAX_PER_SECOND", "2"))
+HEDGE_SAMPLE_SIZE = 200 # パーセンタイル計算に使う直近の応答時間の件数
+HEDGE_MIN_SAMPLES = 20 # これより少ない間はヘッジしない
+
+class HedgePolicy:
+    def __init__(self, percentile, min_delay, max_per_second):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_per_second = max_per_second
+        self._latencies = {} # max_tokens -> 直近の成功時の応答時間 (出力長で応答時間の分布が違うため分ける)
+        self._tokens = max(1.0, max_per_second)
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.fired = 0
+        self.wins = 0
+        self.skipped = 0
+
+    def record(self, key, latency):
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None:
+                samples = self._latencies[key] = deque(maxlen=HEDGE_SAMPLE_SIZE)
+            samples.append(latency)
+
+    # ヘッジを送るまでの待ち時間 (サンプル不足なら None = ヘッジしない)
+    def delay(self, key):
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None or len(samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))
+        return max(self.min_delay, ordered[index])
+
+    # 1秒あたりの上限内ならヘッジ1本分の枠を消費して True を返す
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(max(1.0, self.max_per_second), self._tokens + (now - self._refilled_at) * self.max_per_second)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.fired += 1
+                return True
+            self.skipped += 1
+            return False
+
+    def stats(self):
+        return {
+            "enabled": OPENROUTER_HEDGE_ENABLED,
+            "fired": self.fired,
+            "wins": self.wins,
+            "skipped_by_budget": self.skipped,
+            "delays": {str(key): self.delay(key) for key in list(self._latencies)},
+        }
+
+hedge_policy = HedgePolicy(OPENROUTER_HEDGE_PERCENTILE, OPENROUTER_HEDGE_MIN_DELAY, OPENROUTER_HEDGE_MAX_PER_SECOND)
+
+# 同期版のヘッジはスレッドで並行に送る (実行中のrequestsは中断できないため、負けた方は結果を捨てる)
+_hedge_executor = None
+_hedge_executor_pid = None
+
+def get_hedge_executor():
+    global _hedge_executor, _hedge_executor_pid
+    if _hedge_executor is None or _hedge_executor_pid != os.getpid():
+        # 締め切りのある同期版の送信はここで行う (送信枠を待っている分も含めて足りるようにする。スレッドは必要になってから作られる)
+        _hedge_executor = ThreadPoolExecutor(max_workers=OPENROUTER_POOL_SIZE * 2 + OPENROUTER_LIMITER_QUEUE, thread_name_prefix="hedge")
+        _hedge_executor_pid = os.getpid()
+    return _hedge_executor
+
+def _timed_send(prompt, model, temperature, max_tokens, abort_on_duplicate=False, timeout=None, json_mode=False):
+    send = send_openrouter_request_abortable if use_streaming_send(abort_on_duplicate) else send_openrouter_request
+    started = time.monotonic()
+    content, error = send_with_permit(send, prompt, model, temperature, max_tokens, timeout, json_mode)
+    if error is None:
+        hedge_policy.record(max_tokens, time.monotonic() - started)
+    return content, error
+
+async def _timed_send_async(prompt, model, temperature, max_tokens, abort_on_duplicate=False, timeout=None, json_mode=False):
+    send = send_openrouter_request_abortable_async if use_streaming_send(abort_on_duplicate) else send_openrouter_request_async
+    started = time.monotonic()
+    content, error = await send_with_permit_async(send, prompt, model, temperature, max_tokens, timeout, json_mode)
+    if error is None:
+        hedge_policy.record(max_tokens, time.monotonic() - started)
+    return content, error
+
+# ヘッジ付きでAPIを呼び出す (サーキットブレーカーの内側)
+# timeout は呼び出し全体の上限でもある。読み取りタイムアウトは受信ごとにしか効かないため、送信は
+# スレッドで行い、締め切りまでに返らなければ待つのをやめてタイムアウトとする (送信中のスレッドは
+# 受信全体の締め切りで自ら終わり、送信枠を返す)
+def _hedged_call(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, abort_on_duplicate=False, timeout=None, json_mode=False):
+    delay = hedge_policy.delay(max_tokens) if OPENROUTER_HEDGE_ENABLED else None
+    if delay is None and timeout is None:
+        return _timed_send(prompt, model, temperature, max_tokens, abort_on_duplicate, timeout, json_mode)
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    left = lambda: None if deadline is None else max(deadline - time.monotonic(), 0.0)
+    # 途中経過の通知先 (stream_listener) を引き継ぐため、呼び出し元のコンテキストの写しで実行する
+    executor = get_hedge_executor()
+    primary = executor.submit(contextvars.copy_context().run, _timed_send, prompt, model, temperature, max_tokens, abort_on_duplicate, timeout, json_mode)
+    pending = {primary}
+    hedge = None
+    if delay is not None:
+        done, _ = wait_futures(pending, timeout=delay if deadline is None else min(delay, left()))
+        if not done and left() != 0.0 and hedge_policy.try_acquire():
+            log_event("hedge_sent", delay=round(delay, 3))
+            hedge = executor.submit(contextvars.copy_context().run, _timed_send, prompt, model, temperature, max_tokens, abort_on_duplicate, left(), json_mode)
+            pending.add(hedge)
+    failed = None
+    while pending:
+        done, pending = wait_futures(pending, timeout=left(), return_when=FIRST_COMPLETED)
+        if not done:
+            for other in pending:
+                other.cancel() # まだ始まっていなければ送らない
+            log_event("api_error", level="warning", error="タイムアウトエラー")
+            return None, "タイムアウトエラー"
+        for future in done:
+            content, error = future.result()
+            if error is None:
+                if future is hedge:
+                    hedge_policy.wins += 1
+                for other in pending:
+                    other.cancel()
+                return content, error
+            failed = (content, error)
+    return failed
+
+# ヘッジ付きでAPIを呼び出す (非同期版, 負けた方のリクエストはキャンセルする)
+async def _hedged_call_async(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, abort_on_duplicate=False, timeout=None, json_mode=False):
+    delay = hedge_policy.delay(max_tokens) if OPENROUTER_HEDGE_ENABLED else None
+    if delay is None:
+        return await _timed_send_async(prompt, model, temperature, max_tokens, abort_on_duplicate, timeout, json_mode)
+
+    primary = asyncio.ensure_future(_timed_send_async(prompt, model, temperature, max_tokens, abort_on_duplicate, timeout, json_mode))
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not hedge_policy.try_acquire():
+        return await primary
+
+    log_event("hedge_sent", delay=round(delay, 3))
+    hedge = asyncio.ensure_future(_timed_send_async(prompt, model, temperature, max_tokens, abort_on_duplicate, timeout, json_mode))
+    pending = {primary, hedge}
+    failed = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                content, error = task.result()
+                if error is None:
+                    if task is hedge:
+                        hedge_policy.wins += 1
+                    return content, error
+                failed = (content, error)
+        return failed
+    finally:
+        for task in pending:
+            task.cancel()
+
+# --- サーキットブレーカー ---
+# OpenRouterが落ちている・極端に遅いときに、スピンのたびに全リトライを使い切ってから
+# ハズレを返すのを避ける。直近の呼び出しのエラー率か遅延率がしきい値を超えたら回路を開き (open)、
+# 一定時間は呼び出さずに即座に失敗させる。時間が過ぎたら1本だけ試験的に通し (half_open)、
+# 成功すれば閉じて (closed) 通常運転に戻る。開いている間のスピンはローカルのテーマバンクから返す。
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "1") != "0"
+CIRCUIT_WINDOW_SECONDS = float(os.environ.get("CIRCUIT_WINDOW_SECONDS", "60")) # 判定に使う直近の期間
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", "10")) # これより少ない間は開かない
+CIRCUIT_FAILURE_RATE = float(os.environ.get("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_SLOW_CALL_SECONDS = float(os.environ.get("CIRCUIT_SLOW_CALL_SECONDS", "5")) # SPIN_DEADLINE_SECONDS より短くしないと遅延として数えられない
+CIRCUIT_SLOW_RATE = float(os.environ.get("CIRCUIT_SLOW_RATE", "0.5"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30")) # 開いてから試験呼び出しまでの秒数
+CIRCUIT_OPEN_ERROR = "サーキットブレーカー作動中"
+CIRCUIT_CANCELLED = "呼び出し中断"
+CASSETTE_MISS_ERROR = "カセットに記録なし" # 再生中に該当する記録がない (下の「カセット」を参照)
+# 上流の健全性とは関係のない結果 (設定ミス・重複による打ち切り・呼び出し側の中断) は判定に含めない
+CIRCUIT_IGNORED_ERRORS = {
+    "APIキー未設定エラー", "APIキー認証エラー", DUPLICATE_ABORT_ERROR, CIRCUIT_CANCELLED,
+    LIMITER_TIMEOUT_ERROR, LIMITER_QUEUE_FULL_ERROR, CASSETTE_MISS_ERROR,
+}
+# リトライしても結果が変わらないエラー (送信待ちで溢れた場合も、すぐ並び直さずにフォールバックする)
+NON_RETRYABLE_ERRORS = {"APIキー認証エラー", CIRCUIT_OPEN_ERROR, DEADLINE_ERROR, LIMITER_TIMEOUT_ERROR, LIMITER_QUEUE_FULL_ERROR, CASSETTE_MISS_ERROR}
+
+class CircuitBreaker:
+    def __init__(self):
+        self.state = "closed"
+        self._outcomes = deque() # (時刻, 失敗したか, 遅かったか)
+        self._opened_at = 0.0
+        self._probe_started = None # half_open中の試験呼び出しの開始時刻
+        self._lock = threading.Lock()
+        self.trips = 0
+        self.rejected = 0
+
+    def _prune(self, now):
+        while self._outcomes and now - self._outcomes[0][0] > CIRCUIT_WINDOW_SECONDS:
+            self._outcomes.popleft()
+
+    # 試験呼び出しが返ってこないまま (キャンセル等) 詰まらないよう、古い試験は無効とみなす
+    def _probe_pending(self, now):
+        return self._probe_started is not None and now - self._probe_started < CIRCUIT_OPEN_SECONDS
+
+    # 呼び出しを拒否している最中か (状態は変えない)
+    def rejecting(self):
+        if not CIRCUIT_BREAKER_ENABLED:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "open":
+                return now - self._opened_at < CIRCUIT_OPEN_SECONDS
+            if self.state == "half_open":
+                return self._probe_pending(now)
+            return False
+
+    # 呼び出してよいか (half_openで試験呼び出しを1本だけ許可する)
+    def allow(self):
+        if not CIRCUIT_BREAKER_ENABLED:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "open" and now - self._opened_at >= CIRCUIT_OPEN_SECONDS:
+                self.state = "half_open"
+                log_event("circuit", level="warning", state="half_open")
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self._probe_pending(now):
+                self._probe_started = now
+                return True
+            self.rejected += 1
+            return False
+
+    def _open(self, now):
+        self.state = "open"
+        self._opened_at = now
+        self._probe_started = None
+        self.trips += 1
+
+    def record(self, error, latency):
+        if not CIRCUIT_BREAKER_ENABLED:
+            return
+        now = time.monotonic()
+        ignored = error in CIRCUIT_IGNORED_ERRORS
+        failed = error is not None and not ignored
+        slow = latency >= CIRCUIT_SLOW_CALL_SECONDS
+        with self._lock:
+            if self.state == "half_open":
+                if ignored:
+                    self._probe_started = None
+                elif failed or slow:
+                    log_event("circuit", level="warning", state="open", reason="probe_failed")
+                    self._open(now)
+                else:
+                    log_event("circuit", level="warning", state="closed")
+                    self.state = "closed"
+                    self._probe_started = None
+                    self._outcomes.clear()
+                return
+            if self.state != "closed" or ignored:
+                return
+            self._outcomes.append((now, failed, slow))
+            self._prune(now)
+            count = len(self._outcomes)
+            if count < CIRCUIT_MIN_CALLS or not (failed or slow):
+                return
+            failure_rate = sum(1 for _, f, _ in self._outcomes if f) / count
+            slow_rate = sum(1 for _, _, w in self._outcomes if w) / count
+            if failure_rate >= CIRCUIT_FAILURE_RATE or slow_rate >= CIRCUIT_SLOW_RATE:
+                log_event("circuit", level="warning", state="open", failure_rate=round(failure_rate, 3), slow_rate=round(slow_rate, 3))
+                self._open(now)
+                self._outcomes.clear()
+
+    def stats(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            count = len(self._outcomes)
+            return {
+                "enabled": CIRCUIT_BREAKER_ENABLED,
+                "state": self.state,
+                "trips": self.trips,
+                "rejected": self.rejected,
+                "window_calls": count,
+                "window_failure_rate": round(sum(1 for _, f, _ in self._outcomes if f) / count, 3) if count else None,
+            }
+
+circuit_breaker = CircuitBreaker()
+
+# API呼び出しを行うヘルパー関数 (サーキットブレーカーを通し、必要に応じてヘッジする)
+# abort_on_duplicate=True の場合はストリーミングで受信し、重複テーマなら途中で打ち切る
+def call_openrouter_api(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, abort_on_duplicate=False, timeout=None, json_mode=False):
+    if not circuit_breaker.allow():
+        return None, CIRCUIT_OPEN_ERROR
+    started = time.monotonic()
+    error = CIRCUIT_CANCELLED
+    try:
+        if cassette.replaying:
+            content, error, delay = cassette.replay(prompt, model, max_tokens, abort_on_duplicate, timeout, json_mode)
+            time.sleep(delay)
+            return content, error
+        content, error = _hedged_call(prompt, model, temperature, max_tokens, abort_on_duplicate, timeout, json_mode)
+        cassette.record(prompt, model, temperature, max_tokens, json_mode, content, error, time.monotonic() - started)
+        return content, error
+    finally:
+        circuit_breaker.record(error, time.monotonic() - started)
+
+async def call_openrouter_api_async(prompt, model="openai/gpt-4.1-nano", temperature=0.9, max_tokens=150, abort_on_duplicate=False, timeout=None, json_mode=False):
+    if not circuit_breaker.allow():
+        return None, CIRCUIT_OPEN_ERROR
+    started = time.monotonic()
+    error = CIRCUIT_CANCELLED
+    try:
+        if cassette.replaying:
+            content, error, delay = cassette.replay(prompt, model, max_tokens, abort_on_duplicate, timeout, json_mode)
+            await asyncio.sleep(delay)
+            return content, error
+        try:
+            # 読み取りタイムアウトは受信ごとなので、呼び出し全体にも残り時間の上限をかける。
+            # 外側で打ち切るとキャンセル扱いになりブレーカーに数えられないため、ここでタイムアウトとして記録する
+            content, error = await asyncio.wait_for(
+                _hedged_call_async(prompt, model, temperature, max_tokens, abort_on_duplicate, timeout, json_mode), timeout
+            )
+        except asyncio.TimeoutError:
+            log_event("api_error", level="warning", error="タイムアウトエラー")
+            content, error = None, "タイムアウトエラー"
+        cassette.record(prompt, model, temperature, max_tokens, json_mode, content, error, time.monotonic() - started)
+        return content, error
+    finally:
+        circuit_breaker.record(error, time.monotonic() - started)
+
+# --- 上流の応答の記録と再生 (カセット) ---
+# CASSETTE_MODE=record では call_openrouter_api の要求と応答 (所要時間つき) を追記専用のJSONLに書き出し、
+# CASSETTE_MODE=replay ではAPIを呼ばずにそのファイルから応答を返す。本物のモデル出力を使って
+# 重複排除・解析・再試行まわりの変更をトークンを使わずに比べるためのもの。
+# 再生はプロンプトのハッシュで引き、同じプロンプトの記録は記録順に繰り返し返す (同じ順序で呼べば同じ結果)。
+# 直近の具体名などでプロンプトが変わって一致しない場合は、同じ呼び出しの形 (モデル・最大トークン数・
+# JSONモード) の記録から順に返す。CASSETTE_SPEED は再生の速さ (1で記録どおり、10で10倍速、0で待たない)。
+CASSETTE_MODE = os.environ.get("CASSETTE_MODE", "off")
+CASSETTE_PATH = os.environ.get("CASSETTE_PATH", "cassette.jsonl")
+CASSETTE_SPEED = float(os.environ.get("CASSETTE_SPEED", "1"))
+# ローカルで決まった結果 (上流の応答ではない) は記録しない。重複による打ち切りは受信済みの部分を記録し、
+# 再生時も打ち切りとして返す (続きは生成されていないため)。これで再生しても重複率が再現される
+CASSETTE_SKIPPED_ERRORS = {
+    CIRCUIT_OPEN_ERROR, CIRCUIT_CANCELLED, DEADLINE_ERROR,
+    LIMITER_TIMEOUT_ERROR, LIMITER_QUEUE_FULL_ERROR, "APIキー未設定エラー",
+}
+
+def prompt_hash(prompt, model):
+    return hashlib.blake2b(f"{model}\0{prompt}".encode("utf-8"), digest_size=16).hexdigest()
+
+class Cassette:
+    def __init__(self, mode=CASSETTE_MODE, path=CASSETTE_PATH, speed=CASSETTE_SPEED):
+        self.mode = mode
+        self.path = path
+        self.speed = speed
+        self.replaying = mode == "replay"
+        self._writer = EventLog(sample_rate=1, path=path) if mode == "record" else None
+        self._by_prompt = {} # プロンプトのハッシュ -> 記録の一覧
+        self._by_shape = {} # (モデル, 最大トークン数, JSONモード) -> 記録の一覧
+        self._cursors = {}
+        self._lock = threading.Lock()
+        self.recorded = 0
+        self.hits = 0
+        self.shape_hits = 0
+        self.misses = 0
+        if self.replaying:
+            self.load()
+
+    def load(self):
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue # 書き込み途中で止まった最後の行など
+                if entry.get("event") != "call":
+                    continue
+                response = (entry.get("content"), entry.get("error"), float(entry.get("latency") or 0.0))
+                self._by_prompt.setdefault(entry["key"], []).append(response)
+                shape = (entry.get("model"), entry.get("max_tokens"), bool(entry.get("json_mode")))
+                self._by_shape.setdefault(shape, []).append(response)
+
+    def record(self, prompt, model, temperature, max_tokens, json_mode, content, error, latency):
+        if self._writer is None or error in CASSETTE_SKIPPED_ERRORS:
+            return
+        self.recorded += 1
+        self._writer.log(
+            "call", key=prompt_hash(prompt, model), model=model, temperature=temperature, max_tokens=max_tokens,
+            json_mode=json_mode, prompt=prompt, content=content, error=error, latency=round(latency, 4),
+        )
+
+    def _next(self, index, key):
+        entries = index.get(key)
+        if not entries:
+            return None
+        cursor = self._cursors.get((id(index), key), 0)
+        self._cursors[(id(index), key)] = cursor + 1
+        return entries[cursor % len(entries)]
+
+    # (content, error, 待つ秒数) を返す。待つのは呼び出し側 (同期/非同期で待ち方が違うため)
+    def replay(self, prompt, model, max_tokens, abort_on_duplicate=False, timeout=None, json_mode=False):
+        with self._lock:
+            response = self._next(self._by_prompt, prompt_hash(prompt, model))
+            if response is not None:
+                self.hits += 1
+            else:
+                response = self._next(self._by_shape, (model, max_tokens, bool(json_mode)))
+                if response is None:
+                    self.misses += 1
+                    return None, CASSETTE_MISS_ERROR, 0.0
+                self.shape_hits += 1
+        content, error, latency = response
+        delay = latency / self.speed if self.speed > 0 else 0.0
+        if timeout is not None and delay > timeout:
+            return None, "タイムアウトエラー", max(timeout, 0.0)
+        # ストリーミングの早期打ち切りと同じく、既出のテーマなら打ち切ったものとして返す
+        if abort_on_duplicate and EARLY_ABORT_ENABLED and content:
+            theme = extract_partial_json_field(content, "theme")
+            if theme is not None and theme in generated_themes:
+                return content, DUPLICATE_ABORT_ERROR, delay
+        return content, error, delay
+
+    def flush(self):
+        if self._writer is not None:
+            self._writer.flush()
+
+    def reset_after_fork(self):
+        if self._writer is not None:
+            self._writer.reset_after_fork()
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "path": self.path,
+            "speed": self.speed,
+            "recorded": self.recorded,
+            "prompts": len(self._by_prompt),
+            "hits": self.hits,
+            "shape_hits": self.shape_hits,
+            "misses": self.misses,
+        }
+
+cassette = Cassette()
+atexit.register(cassette.flush)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=cassette.reset_after_fork)
+
+# --- オフラインのテーマバンク ---
+# 回路が開いている間のスピンに即座に返すローカルのテーマ集。同梱のテーマ (themes.py) に加えて、
+# 生成に成功したテーマをキーワード付きで蓄える (SHARED_STATE_DB 指定時はSQLiteに保存し再起動後も使う)。
+# キーワードでの絞り込みは文字・文字バイグラムの転置インデックスで行う。
+# SQLiteへの保存は他のワーカーが書き込み中だと busy timeout まで待つため、スピンの経路 (イベントループ) では
+# キューに積むだけにし、書き込みスレッドがまとめて保存する。
+THEME_BANK_CAPACITY = int(os.environ.get("THEME_BANK_CAPACITY", "5000"))
+THEME_BANK_RECENT = 20 # 直近に出したテーマはなるべく続けて出さない
+
+# 1文字のキーワードでも引けるよう、文字単体とバイグラムの両方を索引に使う
+def bank_grams(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return set(text.replace(" ", "")) | {text[i:i + 2] for i in range(len(text) - 1) if " " not in text[i:i + 2]}
+
+class ThemeBank:
+    def __init__(self, bundled, capacity=THEME_BANK_CAPACITY, db=None):
+        self.capacity = capacity
+        self.db = db
+        self._entries = {} # テーマ -> {"theme", "hint", "keyword"}
+        self._learned = OrderedDict() # 生成から蓄えたテーマ (先頭が最も古い。同梱分は追い出さない)
+        self._index = {} # バイグラム -> テーマの集合
+        self._recent = deque(maxlen=THEME_BANK_RECENT)
+        self._lock = threading.Lock()
+        self._pending = queue.Queue() # 保存待ちの (テーマ, ヒント, キーワード, 時刻)
+        self._pid = None
+        self.served = 0
+        for entry in bundled:
+            self._insert(entry["theme"], entry["hint"], entry.get("keyword"))
+        if db is not None:
+            rows = db.connection().execute(
+                "SELECT theme, hint, keyword FROM theme_bank ORDER BY added DESC LIMIT ?", (capacity,)
+            ).fetchall()
+            for theme, hint, keyword in reversed(rows):
+                self._learn(theme, hint, keyword)
+
+    def _insert(self, theme, hint, keyword):
+        entry = {"theme": theme, "hint": hint, "keyword": keyword}
+        self._entries[theme] = entry
+        for gram in bank_grams(f"{theme} {hint} {keyword or ''}"):
+            self._index.setdefault(gram, set()).add(theme)
+
+    def _remove(self, theme):
+        entry = self._entries.pop(theme)
+        for gram in bank_grams(f"{theme} {entry['hint']} {entry['keyword'] or ''}"):
+            themes = self._index.get(gram)
+            if themes is not None:
+                themes.discard(theme)
+                if not themes:
+                    del self._index[gram]
+
+    def _learn(self, theme, hint, keyword):
+        if theme in self._entries and theme not in self._learned:
+            return # 同梱のテーマ
+        if theme in self._learned:
+            self._remove(theme)
+            del self._learned[theme]
+        self._insert(theme, hint, keyword)
+        self._learned[theme] = True
+        while len(self._learned) > self.capacity:
+            oldest, _ = self._learned.popitem(last=False)
+            self._remove(oldest)
+
+    # 生成に成功したテーマを蓄える
+    def add(self, theme, keyword=None):
+        if not theme.get("theme") or theme["theme"] == "ハズレ":
+            return
+        with self._lock:
+            self._learn(theme["theme"], theme.get("hint", ""), keyword)
+        if self.db is not None:
+            self._ensure_writer()
+            self._pending.put((theme["theme"], theme.get("hint", ""), keyword, time.time()))
+
+    # 書き込みスレッドはforkを越えて引き継がれないため、プロセスごとに起動する
+    def _ensure_writer(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._write_loop, name="theme-bank-writer", daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            self.flush(self._pending.get())
+
+    # 溜まっている保存待ちをまとめて書き出す (プロセス終了時は呼び出し側のスレッドで残りを書き出す)
+    def flush(self, first=None):
+        rows = [] if first is None else [first]
+        while True:
+            try:
+                rows.append(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        if not rows or self.db is None:
+            return
+        try:
+            self.db.connection().executemany(
+                "INSERT OR REPLACE INTO theme_bank (theme, hint, keyword, added) VALUES (?, ?, ?, ?)", rows
+            )
+        except sqlite3.Error as e:
+            log_event("theme_bank_error", level="warning", detail=str(e))
+
+    # fork時に親のキュー (内部ロックを含む) を子プロセスに持ち込まない
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._pending = queue.Queue()
+
+    # キーワードを含むテーマを1つ選ぶ (該当がなければキーワードなしで選ぶ)
+    def draw(self, keyword=None):
+        with self._lock:
+            candidates = None
+            if keyword:
+                for gram in bank_grams(keyword):
+                    themes = self._index.get(gram, set())
+                    candidates = themes if candidates is None else candidates & themes
+                    if not candidates:
+                        break
+            pool = list(candidates) if candidates else list(self._entries)
+            if not pool:
+                return None
+            fresh = [theme for theme in pool if theme not in self._recent]
+            theme = random.choice(fresh or pool)
+            self._recent.append(theme)
+            self.served += 1
+            entry = self._entries[theme]
+        return {"theme": entry["theme"], "hint": entry["hint"]}
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "learned": len(self._learned),
+            "capacity": self.capacity,
+            "served": self.served,
+            "pending_writes": self._pending.qsize(),
+        }
+
+theme_bank = ThemeBank(conversation_themes, db=shared_state_db if SHARED_STATE_DB else None)
+atexit.register(theme_bank.flush)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=theme_bank.reset_after_fork)
+
+# 回路が開いている間はテーマバンクから返す
+def draw_offline_theme(keyword=None):
+    theme = theme_bank.draw(keyword)
+    if theme is None:
+        return {"theme": "ハズレ", "hint": "空のカプセルが出てきちゃった！もう一度回そう"}
+    log_event("offline_theme", kw=keyword_hash(keyword), theme=theme["theme"])
+    metrics.inc("gacha_offline_themes_total")
+    return theme
+
+# --- ステップ別のモデル振り分け ---
+# ステップごとに候補モデルの一覧を持ち、モデルごとの遅延・成功率・解析成功率を指数移動平均で追う。
+# 呼び出しごとに、まだ計測していない健全なモデルがあればそれを、なければ目標遅延を満たす健全なモデルのうち
+# 設定順で最初のもの (満たすものがなければ最速のもの) を選ぶ。
+# 50トークンの具体名取得 (step1) のように目標を短くすれば最速のモデルに寄る。
+# 成功率か解析成功率が下限を割ったモデルは MODEL_DEMOTE_SECONDS 秒間外し、その後は評価をやり直して戻す。
+# 計測値が古くならないよう、MODEL_EXPLORE_RATE の割合で他の健全なモデルも試す。
+# 例: MODEL_ROUTES="step1=google/gemini-2.0-flash-lite,openai/gpt-4.1-nano;normal=openai/gpt-4.1-nano,openai/gpt-4o-mini"
+DEFAULT_MODEL = "openai/gpt-4.1-nano"
+MODEL_ROUTE_STEPS = ("step1", "step2", "normal", "batch", "fused")
+MODEL_LATENCY_TARGETS = {"step1": 1.0, "step2": 3.0, "normal": 3.0, "batch": 6.0, "fused": 4.0}
+MODEL_EWMA_ALPHA = 0.2
+MODEL_MIN_SAMPLES = int(os.environ.get("MODEL_MIN_SAMPLES", "5")) # 外すかどうか判定するまでの呼び出し数
+MODEL_MIN_SUCCESS = float(os.environ.get("MODEL_MIN_SUCCESS", "0.6"))
+MODEL_MIN_PARSE = float(os.environ.get("MODEL_MIN_PARSE", "0.6"))
+MODEL_DEMOTE_SECONDS = float(os.environ.get("MODEL_DEMOTE_SECONDS", "60"))
+MODEL_EXPLORE_RATE = float(os.environ.get("MODEL_EXPLORE_RATE", "0.05"))
+
+# "step=モデル,モデル;step=秒" 形式の環境変数を読む
+def parse_step_setting(spec, convert):
+    settings = {}
+    for part in filter(None, (p.strip() for p in (spec or "").split(";"))):
+        step, _, value = part.partition("=")
+        if step.strip() in MODEL_ROUTE_STEPS and value.strip():
+            settings[step.strip()] = convert(value.strip())
+    return settings
+
+MODEL_ROUTES = parse_step_setting(
+    os.environ.get("MODEL_ROUTES"), lambda v: [m.strip() for m in v.split(",") if m.strip()]
+)
+MODEL_LATENCY_TARGETS.update(parse_step_setting(os.environ.get("MODEL_LATENCY_TARGETS"), float))
+
+class ModelScore:
+    def __init__(self):
+        self.calls = 0
+        self.latency = None
+        self.success = 1.0
+        self.parse = 1.0
+        self.demoted_until = 0.0
+        self.demotions = 0
+
+    def healthy(self, now):
+        return now >= self.demoted_until
+
+    def stats(self, now):
+        return {
+            "calls": self.calls,
+            "latency": None if self.latency is None else round(self.latency, 3),
+            "success": round(self.success, 3),
+            "parse": round(self.parse, 3),
+            "demoted": not self.healthy(now),
+            "demotions": self.demotions,
+        }
+
+class ModelRouter:
+    def __init__(self, routes=MODEL_ROUTES, targets=MODEL_LATENCY_TARGETS):
+        self.routes = {step: routes.get(step) or [DEFAULT_MODEL] for step in MODEL_ROUTE_STEPS}
+        self.targets = targets
+        self._scores = {(step, model): ModelScore() for step, models in self.routes.items() for model in models}
+        self._lock = threading.Lock()
+        self.explored = 0
+
+    def choose(self, step):
+        models = self.routes.get(step) or [DEFAULT_MODEL]
+        if len(models) == 1:
+            return models[0]
+        now = time.monotonic()
+        with self._lock:
+            scores = [(model, self._scores[(step, model)]) for model in models]
+            healthy = [(model, score) for model, score in scores if score.healthy(now)]
+            if not healthy:
+                # 全部外れているなら最も早く戻るものを使う
+                return min(scores, key=lambda item: item[1].demoted_until)[0]
+            if len(healthy) > 1 and random.random() < MODEL_EXPLORE_RATE:
+                self.explored += 1
+                return random.choice(healthy)[0]
+            # 計測前のモデルは設定順に関係なく先に一度試す (探索頼みだと後ろのモデルがなかなか計測されない)
+            for model, score in healthy:
+                if score.latency is None:
+                    return model
+            target = self.targets.get(step)
+            for model, score in healthy:
+                if target is not None and score.latency <= target:
+                    return model
+            return min(healthy, key=lambda item: item[1].latency)[0]
+
+    def _update(self, score, now):
+        if score.calls >= MODEL_MIN_SAMPLES and (score.success < MODEL_MIN_SUCCESS or score.parse < MODEL_MIN_PARSE):
+            score.demoted_until = now + MODEL_DEMOTE_SECONDS
+            score.demotions += 1
+            # 戻ったときは評価をやり直す
+            score.calls = 0
+            score.success = score.parse = 1.0
+            return True
+        return False
+
+    # 上流の呼び出し結果を記録する。呼び出し側の都合で決まった結果 (遮断中・送信待ち・締め切り・重複による打ち切り) は数えない
+    def record(self, step, model, error, latency):
+        if error in CIRCUIT_IGNORED_ERRORS or error in (CIRCUIT_OPEN_ERROR, DEADLINE_ERROR):
+            return
+        score = self._scores.get((step, model))
+        if score is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            score.calls += 1
+            score.latency = latency if score.latency is None else score.latency + MODEL_EWMA_ALPHA * (latency - score.latency)
+            score.success += MODEL_EWMA_ALPHA * ((0.0 if error else 1.0) - score.success)
+            demoted = self._update(score, now)
+        if demoted:
+            log_event("model_demoted", level="warning", step=step, model=model, reason="errors")
+
+    def record_parse(self, step, model, ok):
+        score = self._scores.get((step, model))
+        if score is None:
+            return
+        with self._lock:
+            score.parse += MODEL_EWMA_ALPHA * ((1.0 if ok else 0.0) - score.parse)
+            demoted = self._update(score, time.monotonic())
+        if demoted:
+            log_event("model_demoted", level="warning", step=step, model=model, reason="parse")
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "explored": self.explored,
+                "steps": {
+                    step: {
+                        "target": self.targets.get(step),
+                        "models": {model: self._scores[(step, model)].stats(now) for model in models},
+                    }
+                    for step, models in self.routes.items()
+                },
+            }
+
+model_router = ModelRouter()
+# 応答を解析している呼び出しのステップとモデル (解析成功率をモデルに帰属させるため、ドライバが設定する)
+routed_call = contextvars.ContextVar("routed_call", default=None)
+
+# --- 応答からの構造化データの取り出し ---
+# モデルの応答は前置きの文章・```json の囲み・末尾の補足・途中で切れた出力・複数のオブジェクトなどを含むことがある。
+# JSONとしてそのまま読めないだけで再試行すると1往復分を無駄にするため、応答全体を1回走査して
+# 最初に見つかった有効な値を取り出す。途中で切れたオブジェクトも "theme" が読めれば救済する。
+# 解析の成否は種類ごとに数え、/stats で失敗率を確認できるようにする。
+_json_decoder = json.JSONDecoder()
+_parse_stats_lock = threading.Lock()
+parse_stats = {} # 種類 -> {"parsed", "salvaged", "failed"}
+
+def record_parse(kind, outcome):
+    with _parse_stats_lock:
+        counts = parse_stats.setdefault(kind, {"parsed": 0, "salvaged": 0, "failed": 0})
+        counts[outcome] += 1
+    if outcome == "failed":
+        metrics.inc("gacha_parse_failures_total", kind=kind)
+    routed = routed_call.get()
+    if routed is not None:
+        model_router.record_parse(*routed, outcome != "failed")
+
+def get_parse_stats():
+    with _parse_stats_lock:
+        stats = {kind: dict(counts) for kind, counts in parse_stats.items()}
+    for counts in stats.values():
+        total = counts["parsed"] + counts["salvaged"] + counts["failed"]
+        counts["failure_rate"] = round(counts["failed"] / total, 3) if total else None
+    return stats
+
+# テキスト中に現れるJSONの値 (オブジェクト・配列) を先頭から順にyieldする
+# 読めた値の内側は読み飛ばし、読めなかった位置はその次の { / [ から探し直す
+def iter_json_values(text):
+    i = 0
+    while True:
+        starts = [pos for pos in (text.find("{", i), text.find("[", i)) if pos >= 0]
+        if not starts:
+            return
+        start = min(starts)
+        try:
+            value, end = _json_decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            i = start + 1
+            continue
+        yield value
+        i = end
+
+# theme と hint がどちらも空でない文字列のものだけをテーマとして扱う (hint のないカプセルは出さない)
+def _is_theme_object(value):
+    return (
+        isinstance(value, dict)
+        and isinstance(value.get("theme"), str) and value["theme"].strip()
+        and isinstance(value.get("hint"), str) and value["hint"].strip()
+    )
+
+# 閉じていない文字列フィールドの値を、途中までで取り出す (途中で切れた出力の救済用)
+def extract_truncated_json_field(text, field):
+    value = extract_partial_json_field(text, field)
+    if value is not None:
+        return value
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(field), text)
+    if not match:
+        return None
+    rest = text[match.end():]
+    if rest.endswith("\\") and not rest.endswith("\\\\"):
+        rest = rest[:-1]
+    try:
+        return json.loads('"' + rest + '"').strip()
+    except json.JSONDecodeError:
+        return None
+
+# 応答から {"theme", "hint", ...} のオブジェクトを1つ取り出す。見つからなければ ValueError
+def parse_theme_object(content, kind="theme"):
+    for value in iter_json_values(content):
+        if isinstance(value, list):
+            value = next((v for v in value if _is_theme_object(v)), None)
+        if _is_theme_object(value):
+            record_parse(kind, "parsed")
+            return value
+    # 途中で切れた出力: theme が閉じていて hint が書き始められていれば、hint は途中までを使う
+    # (hint がまだ始まっていない・空の場合は救済せず、失敗として再試行させる)
+    theme = extract_partial_json_field(content, "theme")
+    hint = extract_truncated_json_field(content, "hint")
+    if theme and theme.strip() and hint:
+        salvaged = {"theme": theme, "hint": hint}
+        item = extract_partial_json_field(content, "item")
+        if item is not None:
+            salvaged["item"] = item
+        log_event("parse_salvaged", theme=theme)
+        record_parse(kind, "salvaged")
+        return salvaged
+    record_parse(kind, "failed")
+    raise ValueError("テーマのJSONが見つかりません")
+
+# 応答からテーマの配列を取り出す (配列・{"themes": [...]}・オブジェクトの羅列・途中で切れた配列を受け付ける)
+def parse_theme_list(content, kind="batch"):
+    objects = []
+    for value in iter_json_values(content):
+        if isinstance(value, dict) and isinstance(value.get("themes"), list):
+            value = value["themes"]
+        if isinstance(value, list) and any(_is_theme_object(v) for v in value):
+            record_parse(kind, "parsed" if not objects else "salvaged")
+            return objects + value
+        if _is_theme_object(value):
+            objects.append(value)
+    if objects:
+        # 配列が途中で切れていても、閉じている要素だけは使う
+        record_parse(kind, "salvaged" if len(objects) > 1 or content.lstrip().startswith("[") else "parsed")
+        return objects
+    record_parse(kind, "failed")
+    raise ValueError("テーマの配列が見つかりません")
+
+# 応答から文字列の配列を取り出す。途中で切れた配列も閉じている要素までを使う
+def parse_string_list(content, kind="candidates"):
+    for value in iter_json_values(content):
+        if isinstance(value, dict):
+            value = next((v for v in value.values() if isinstance(v, list)), None)
+        if isinstance(value, list) and any(isinstance(v, str) for v in value):
+            record_parse(kind, "parsed")
+            return value
+    start = content.find("[")
+    if start >= 0:
+        items = re.findall(r'"((?:[^"\\]|\\.)*)"\s*[,\]]', content[start:])
+        if items:
+            record_parse(kind, "salvaged")
+            return [json.loads('"' + item + '"') for item in items]
+    record_parse(kind, "failed")
+    raise ValueError("配列が見つかりません")
+
+# --- Step 1 候補リストのキャッシュ ---
+# 具体名を1件ずつ問い合わせると重複のたびに往復が増えるため、キーワードごとに候補を
+# まとめて取得してTTL付きでキャッシュし、以降のスピンはローカルで非復元抽出する。
+SPECIFIC_CANDIDATE_COUNT = int(os.environ.get("SPECIFIC_CANDIDATE_COUNT", "30"))
+SPECIFIC_CANDIDATE_TTL = float(os.environ.get("SPECIFIC_CANDIDATE_TTL", "3600"))
+SPECIFIC_CANDIDATE_MAX_KEYWORDS = int(os.environ.get("SPECIFIC_CANDIDATE_MAX_KEYWORDS", "500"))
+SPECIFIC_CANDIDATE_TOKENS_PER_ITEM = 15
+
+specific_candidate_cache = OrderedDict() # keyword -> {"items": 未使用の候補(シャッフル済み), "expires": 期限}
+specific_candidate_lock = threading.Lock()
+
+def create_candidate_list_prompt(keyword, count=SPECIFIC_CANDIDATE_COUNT):
+    return prompts.render("candidates", keyword=keyword, count=count)
+
+# 候補リストの応答を解析して、使える具体名のリストを返す
+def parse_candidate_list(content):
+    data = parse_string_list(content, "candidates")
+    items = []
+    for value in data:
+        if not isinstance(value, str):
+            continue
+        item = value.strip().replace("\"", "").replace("「", "").replace("」", "")
+        if 0 < len(item) < 50 and item not in items:
+            items.append(item)
+    return items
+
+def store_specific_candidates(keyword, items):
+    items = list(items)
+    random.shuffle(items)
+    with specific_candidate_lock:
+        specific_candidate_cache[keyword] = {"items": items, "expires": time.monotonic() + SPECIFIC_CANDIDATE_TTL}
+        specific_candidate_cache.move_to_end(keyword)
+        while len(specific_candidate_cache) > SPECIFIC_CANDIDATE_MAX_KEYWORDS:
+            specific_candidate_cache.popitem(last=False)
+
+# キャッシュから具体名を1つ取り出す (非復元抽出)。なければ None
+def take_specific_candidate(keyword):
+    with specific_candidate_lock:
+        entry = specific_candidate_cache.get(keyword)
+        if entry is None:
+            return None
+        if entry["expires"] < time.monotonic():
+            del specific_candidate_cache[keyword]
+            return None
+        specific_candidate_cache.move_to_end(keyword)
+        items = entry["items"]
+        return items.pop() if items else None
+
+# キャッシュから最近使っていない具体名を取り出す (使われていないかの判定と登録は claim としてyieldする)
+def claim_specific_candidate(keyword):
+    while True:
+        item = take_specific_candidate(keyword)
+        if item is None or (yield {"claim": item, "store": recent_specific_items}):
+            return item
+
+# Step 1 の候補リスト経由の取得手順 (API呼び出しが必要な場合はyieldする)
+def draw_specific_item(keyword):
+    kw = keyword_hash(keyword)
+    specific_item = yield from claim_specific_candidate(keyword)
+    if specific_item is None:
+        content, error = yield {
+            "step": "step1",
+            "attempt": 1,
+            "keyword": keyword,
+            "prompt": create_candidate_list_prompt(keyword),
+            "max_tokens": SPECIFIC_CANDIDATE_TOKENS_PER_ITEM * SPECIFIC_CANDIDATE_COUNT + 20,
+        }
+        if error:
+            return None
+        try:
+            candidates = parse_candidate_list(content or "")
+        except ValueError:
+            log_event("theme_result", step="step1", attempt=1, kw=kw, outcome="parse_error")
+            return None
+        store_specific_candidates(keyword, candidates)
+        specific_item = yield from claim_specific_candidate(keyword)
+    if specific_item:
+        log_event("theme_result", step="step1", kw=kw, outcome="ok", source="candidates", item=specific_item)
+    return specific_item
+
+# テーマ生成の手順 (2ステップ対応版)
+# API呼び出しは自分では行わず、call_openrouter_api の引数をyieldして (content, error) を受け取る。
+# 同期版 generate_theme と非同期版 generate_theme_async が同じ手順を共有するための形。
+# 重複の判定と登録も {"claim": 値, "store": ストア} をyieldして取れたかどうか (bool) を受け取る
+# (共有ストアの書き込みを非同期版ではイベントループの外で行うため)。
+def two_step_theme_pipeline(keyword=None, specific=False):
     MAX_RETRIES = 3 # Step2 と 通常生成 の最大リトライ回数
     MAX_STEP1_RETRIES = 7 # Step1 (具体名取得) の最大リトライ回数
 
+    kw = keyword_hash(keyword)
+
     if specific and keyword:
         # --- Step 1: 具体名を取得 ---
-        specific_item = None
-        for attempt in range(MAX_STEP1_RETRIES): # Step1専用のリトライ回数を使用
-            print(f"Step 1: 具体名取得試行 {attempt + 1}/{MAX_STEP1_RETRIES}")
-
-            # --- プロンプトでの回避指示 (JSON形式) を追加 ---
-            avoid_list = list(recent_specific_items) # dequeをリストに変換
-            avoid_list_json = json.dumps(avoid_list, ensure_ascii=False) # リストをJSON文字列に変換 (日本語対応)
-            avoid_instruction = f"\n**ただし、以下のJSONリストに含まれる単語は避けてください: {avoid_list_json}**" if avoid_list else "" # リストが空でなければ指示を追加
-            # --- ここまで追加 ---
-
-            step1_prompt = f"""
-キーワード「{keyword}」に属する**固有名詞またはキャラクター**を被りがないように**1つだけ**挙げてください。{avoid_instruction}
-例：
-- キーワードが「戦国武将」なら、「織田信長」や「武田信玄」など具体的な武将名を1つ。
-- キーワードが「アニメ」なら、「鬼滅の刃」や「呪術廻戦」など具体的な作品名を1つ。
-- キーワードが「ドラゴンボール」なら、「孫悟空」や「フリーザ」など具体的なキャラクター名を1つ。
-- キーワードが「動物」なら、「アライグマ」や「キリン」など具体的な動物の名を1つ。
-出力は、選んだ具体名の単語**だけ**をテキストで返してください。例：「織田信長」
-"""
-            content, error = call_openrouter_api(step1_prompt, max_tokens=50) # 具体名なので短いトークンで十分
+        # まずキャッシュ済みの候補リストから引き、尽きていれば候補リストを1回の呼び出しでまとめて取得する
+        specific_item = yield from draw_specific_item(keyword)
+        if specific_item is None:
+            # 候補リストが得られなかった場合は従来どおり1件ずつ問い合わせる
+            for attempt in range(MAX_STEP1_RETRIES): # Step1専用のリトライ回数を使用
+                # 最近使った具体名は避けるよう指示する (JSON形式)
+                step1_prompt = prompts.render("step1", keyword=keyword, avoid_instruction=create_avoid_instruction())
+                content, error = yield {"step": "step1", "attempt": attempt + 1, "keyword": keyword, "prompt": step1_prompt, "max_tokens": 50} # 具体名なので短いトークンで十分
 
-            if error:
-                print(f"Step 1 エラー: {error}")
-                if error == "APIキー認証エラー": break # 認証エラーならリトライしない
-                continue # 他のエラーならリトライ
-
-            # content が返ってきたらバリデーションと重複チェック
-            potential_item = content.strip().replace("\"", "").replace("「", "").replace("」", "") # 不要な文字を除去
-            if 0 < len(potential_item) < 50:
-                if potential_item in recent_specific_items:
-                    print(f"Step 1 重複検出: 具体名「{potential_item}」は最近使用されました。再試行します。")
-                    continue # 重複している場合は再試行
+                if error:
+                    if error in NON_RETRYABLE_ERRORS: break # 認証エラー・遮断中ならリトライしない
+                    continue # 他のエラーならリトライ
+
+                # content が返ってきたらバリデーションと重複チェック
+                potential_item = content.strip().replace("\"", "").replace("「", "").replace("」", "") # 不要な文字を除去
+                if 0 < len(potential_item) < 50:
+                    if not (yield {"claim": potential_item, "store": recent_specific_items}):
+                        log_event("theme_result", step="step1", attempt=attempt + 1, kw=kw, outcome="duplicate", item=potential_item)
+                        metrics.inc("gacha_duplicates_total", step="step1")
+                        specific_mode_stats["two_step"]["duplicates"] += 1
+                        continue # 重複している場合は再試行
+                    else:
+                        specific_item = potential_item # 新しい具体名は claim で直近の具体名に追加済み
+                        log_event("theme_result", step="step1", attempt=attempt + 1, kw=kw, outcome="ok", item=specific_item)
+                        break # 有効で重複しない具体名が見つかったのでループを抜ける
                 else:
-                    specific_item = potential_item
-                    recent_specific_items.append(specific_item) # 新しい具体名をdequeに追加 (古いものは自動で削除される)
-                    print(f"Step 1 成功: 具体名「{specific_item}」を取得 (最近の具体名: {list(recent_specific_items)})")
-                    break # 有効で重複しない具体名が見つかったのでループを抜ける
-            else:
-                print(f"Step 1 取得内容が不適切: {content}")
+                    log_event("theme_result", step="step1", attempt=attempt + 1, kw=kw, outcome="invalid")
 
         if not specific_item:
-            print("Step 1: 最大試行回数でも具体名を取得できませんでした。")
+            log_event("pipeline_failed", level="warning", step="step1", kw=kw)
             return {"theme": "ハズレ", "hint": "具体名が取得できませんでした。"}
 
         # --- Step 2: 具体名から話題を生成 ---
         for attempt in range(MAX_RETRIES):
-            print(f"Step 2: 話題生成試行 {attempt + 1}/{MAX_RETRIES} (具体名: {specific_item})")
-            instruction = f"「{specific_item}」というキーワードに必ず関連した、明るく楽しい雑談テーマを1つ考えてください({keyword}に関する)。"
-            base_prompt = """
-    形式は以下のJSON形式で返してください。
-    {
-        "theme": "具体的な話題",
-        "hint": "会話のきっかけ"
-    }
-    例:
-    {
-        "theme": "夏の思い出",
-        "hint": "子供の頃の夏休みの思い出や、最近の夏の楽しみ方を話してみよう"
-
-        "theme": "映画館で頼む食べ物",
-        "hint": "楽しい映画には外せない,美味しいグルメについて語ろう"
-
-        "theme": "学生時代の失敗談",
-        "hint": "思い出したくない黒歴史,今だから笑える失敗を思い出そう"
-
-        "theme": "異世界に行ったら何をしたい？",
-        "hint": "もし異世界に行ったら魔法使いとして旅に出る？街で商売して大儲け？"
-    }
-
-    以下の条件を厳守してください:
-    - 楽しくて盛り上がる話題
-    - 現実的でリアルなお題含む
-    - 恋愛や仕事、学校に関する話題含む
-    - 想像が膨らみやすい話題含む
-    - ユーモアがあるお題含む
-    - 具体的で想像しやすいお題とヒント
-    """
-            step2_prompt = instruction + base_prompt
-            content, error = call_openrouter_api(step2_prompt) 
+            step2_prompt = create_step2_prompt(specific_item, keyword)
+            content, error = yield {"step": "step2", "attempt": attempt + 1, "keyword": keyword, "prompt": step2_prompt, "abort_on_duplicate": True, "json_mode": True}
+            if error == DUPLICATE_ABORT_ERROR:
+                # 受信途中で重複と分かり打ち切った場合も、方式の比較のため重複として数える
+                specific_mode_stats["two_step"]["duplicates"] += 1
             if error:
-                print(f"Step 2 エラー: {error}")
-                if error == "APIキー認証エラー":
+                if error in NON_RETRYABLE_ERRORS:
                     break
                 continue
 
             if content:
                 try:
-                    cleaned = content.strip().removeprefix("```json").removesuffix("```").strip()
-                    data  = json.loads(cleaned)
+                    data  = parse_theme_object(content)
                     theme = data.get("theme")
                     hint  = data.get("hint")
 
                     # 重複チェック (Step2)
-                    if theme in generated_themes:
-                        print(f"重複検出 (Step2): {theme} → 再生成")
+                    if not (yield {"claim": theme, "store": generated_themes}):
+                        log_event("theme_result", step="step2", attempt=attempt + 1, kw=kw, outcome="duplicate", theme=theme)
+                        metrics.inc("gacha_duplicates_total", step="step2")
+                        specific_mode_stats["two_step"]["duplicates"] += 1
                         continue
 
-                    generated_themes.add(theme)
-                    print(f"Step2 成功: {theme}")
+                    log_event("theme_result", step="step2", attempt=attempt + 1, kw=kw, outcome="ok", theme=theme)
                     return {"theme": theme, "hint": hint}
-                except json.JSONDecodeError:
-                    print("Step2 JSONパースエラー")
+                except ValueError:
+                    log_event("theme_result", step="step2", attempt=attempt + 1, kw=kw, outcome="parse_error")
             else:
-                print("Step 2 応答が空でした。")
+                log_event("theme_result", step="step2", attempt=attempt + 1, kw=kw, outcome="empty")
 
-        print(f"Step 2: 最大試行回数でも話題生成に失敗 (具体名: {specific_item})。")
+        log_event("pipeline_failed", level="warning", step="step2", kw=kw, item=specific_item)
         return {"theme": "ハズレ", "hint": "話題生成に失敗しました。"}
 
     else:
         # --- specific=False または keywordなし の場合 (通常生成) ---
         for attempt in range(MAX_RETRIES):
-            print(f"通常生成試行 {attempt + 1}/{MAX_RETRIES}")
             full_prompt = create_prompt(keyword, specific=False)
-            content, error = call_openrouter_api(full_prompt)
+            content, error = yield {"step": "normal", "attempt": attempt + 1, "keyword": keyword, "prompt": full_prompt, "abort_on_duplicate": True, "json_mode": True}
 
             if error:
-                print(f"通常生成エラー: {error}")
-                if error == "APIキー認証エラー":
+                if error in NON_RETRYABLE_ERRORS:
                     break
                 continue
 
             if content:
                 try:
-                    cleaned = content.strip().removeprefix("```json").removesuffix("```").strip()
-                    data  = json.loads(cleaned)
+                    data  = parse_theme_object(content)
                     theme = data.get("theme")
                     hint  = data.get("hint")
 
                     # 重複チェック (通常生成)
-                    if theme in generated_themes:
-                        print(f"重複検出 (通常生成): {theme} → 再生成")
+                    if not (yield {"claim": theme, "store": generated_themes}):
+                        log_event("theme_result", step="normal", attempt=attempt + 1, kw=kw, outcome="duplicate", theme=theme)
+                        metrics.inc("gacha_duplicates_total", step="normal")
                         continue
 
-                    generated_themes.add(theme)
-                    print(f"通常生成 成功: {theme}")
+                    log_event("theme_result", step="normal", attempt=attempt + 1, kw=kw, outcome="ok", theme=theme)
                     return {"theme": theme, "hint": hint}
-                except json.JSONDecodeError:
-                    print("通常生成 JSONパースエラー")
+                except ValueError:
+                    log_event("theme_result", step="normal", attempt=attempt + 1, kw=kw, outcome="parse_error")
             else:
-                print("通常生成 応答が空でした。")
+                log_event("theme_result", step="normal", attempt=attempt + 1, kw=kw, outcome="empty")
 
-        print("通常生成: 最大試行回数でもユニークなテーマを取得できませんでした。")
+        log_event("pipeline_failed", level="warning", step="normal", kw=kw)
         return {"theme": "ハズレ", "hint": "空のカプセルが出てきちゃった！もう一度回そう"}
 
+# --- バッチ生成: 1回のAPI呼び出しで複数テーマを得る ---
+# 1件ずつ生成すると長いベースプロンプトとリクエストのオーバーヘッドを毎回払うため、
+# N件をJSON配列で返させ、各要素を検証・重複排除して使えるものをすべて返す。
+THEME_BATCH_SIZE = int(os.environ.get("THEME_BATCH_SIZE", "5"))
+THEME_BATCH_MAX_SIZE = 20
+THEME_BATCH_TOKENS_PER_ITEM = 80 # 1テーマあたりの出力トークン見積もり
+
+# 複数テーマ用のプロンプトを生成するヘルパー関数
+def create_batch_prompt(keyword=None, specific=False, count=THEME_BATCH_SIZE):
+    if specific and keyword:
+        instruction = (
+            f"キーワード「{keyword}」に属する**互いに異なる固有名詞またはキャラクター**を{count}個選び、"
+            f"それぞれに必ず関連した明るく楽しい雑談テーマを1つずつ考えてください。{create_avoid_instruction()}"
+        )
+        item_format = '{"item": "選んだ固有名詞", "theme": "具体的な話題", "hint": "会話のきっかけ"}'
+    elif keyword:
+        instruction = f"「{keyword}」というキーワードに必ず関連した、明るく楽しい雑談テーマを{count}個考えてください。"
+        item_format = '{"theme": "具体的な話題", "hint": "会話のきっかけ"}'
+    else:
+        instruction = f"明るく楽しい雑談テーマを{count}個考えてください。"
+        item_format = '{"theme": "具体的な話題", "hint": "会話のきっかけ"}'
+    return prompts.render("batch", instruction=instruction, item_format=item_format)
+
+# 応答からテーマの配列を取り出す (```json で囲まれた配列や {"themes": [...]} も受け付ける)
+def parse_theme_batch(content):
+    return parse_theme_list(content, "batch")
+
+# 複数テーマ生成の手順 (theme_pipeline と同じくAPI呼び出しはyieldで委譲する)
+def theme_batch_pipeline(keyword=None, specific=False, count=THEME_BATCH_SIZE):
+    MAX_RETRIES = 3
+    count = max(1, min(count, THEME_BATCH_MAX_SIZE))
+    specific = bool(specific and keyword)
+    kw = keyword_hash(keyword)
+    results = []
+
+    for attempt in range(MAX_RETRIES):
+        remaining = count - len(results)
+        if remaining <= 0:
+            break
+        prompt = create_batch_prompt(keyword, specific, remaining)
+        content, error = yield {"step": "batch", "attempt": attempt + 1, "keyword": keyword, "prompt": prompt, "max_tokens": THEME_BATCH_TOKENS_PER_ITEM * remaining + 50}
+
+        if error:
+            if error in NON_RETRYABLE_ERRORS:
+                break
+            continue
+        if not content:
+            log_event("theme_result", step="batch", attempt=attempt + 1, kw=kw, outcome="empty")
+            continue
+
+        try:
+            items = parse_theme_batch(content)
+        except ValueError:
+            log_event("theme_result", step="batch", attempt=attempt + 1, kw=kw, outcome="parse_error")
+            continue
+
+        duplicates = 0
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            theme = item.get("theme")
+            hint  = item.get("hint")
+            if not isinstance(theme, str) or not theme.strip() or not isinstance(hint, str) or not hint.strip():
+                continue
+            if specific:
+                specific_item = item.get("item")
+                if not isinstance(specific_item, str) or not 0 < len(specific_item.strip()) < 50:
+                    continue
+                if not (yield {"claim": specific_item.strip(), "store": recent_specific_items}):
+                    duplicates += 1
+                    continue
+            if not (yield {"claim": theme, "store": generated_themes}):
+                duplicates += 1
+                metrics.inc("gacha_duplicates_total", step="batch")
+                continue
+            results.append({"theme": theme, "hint": hint})
+            if len(results) >= count:
+                break
+        log_event("theme_result", step="batch", attempt=attempt + 1, kw=kw, outcome="ok", count=len(results), requested=count, duplicates=duplicates)
+
+    return results
+
+# --- specific の1回呼び出しモード (fused) ---
+# 2ステップ方式は具体名の取得と話題生成で最低2往復かかるため、1つのプロンプトで
+# {"item", "theme", "hint"} を返させ、具体名の重複はローカルで判定する。
+# SPECIFIC_MODE で two_step (既定) / fused をデプロイ単位で切り替える。
+SPECIFIC_MODE = os.environ.get("SPECIFIC_MODE", "two_step")
+
+# モード別の計測値 (スピン数, 成功数, API呼び出し数, 重複による再試行数, 合計所要時間)
+specific_mode_stats = {
+    mode: {"spins": 0, "successes": 0, "calls": 0, "duplicates": 0, "total_seconds": 0.0}
+    for mode in ("two_step", "fused")
+}
+
+def create_fused_prompt(keyword):
+    return prompts.render("fused", keyword=keyword, avoid_instruction=create_avoid_instruction())
+
+def fused_specific_pipeline(keyword):
+    MAX_FUSED_RETRIES = 5
+    stats = specific_mode_stats["fused"]
+    kw = keyword_hash(keyword)
+
+    for attempt in range(MAX_FUSED_RETRIES):
+        content, error = yield {"step": "fused", "attempt": attempt + 1, "keyword": keyword, "prompt": create_fused_prompt(keyword), "max_tokens": 200, "abort_on_duplicate": True, "json_mode": True}
+        if error == DUPLICATE_ABORT_ERROR:
+            stats["duplicates"] += 1
+        if error:
+            if error in NON_RETRYABLE_ERRORS:
+                break
+            continue
+        if not content:
+            log_event("theme_result", step="fused", attempt=attempt + 1, kw=kw, outcome="empty")
+            continue
+
+        try:
+            data = parse_theme_object(content, "fused")
+        except ValueError:
+            log_event("theme_result", step="fused", attempt=attempt + 1, kw=kw, outcome="parse_error")
+            continue
+        if not isinstance(data, dict):
+            continue
+        item  = str(data.get("item") or "").strip().replace("「", "").replace("」", "")
+        theme = data.get("theme")
+        hint  = data.get("hint")
+        if not 0 < len(item) < 50 or not theme:
+            log_event("theme_result", step="fused", attempt=attempt + 1, kw=kw, outcome="invalid")
+            continue
+
+        # 具体名とテーマの重複チェック (ローカル)
+        if not (yield {"claim": item, "store": recent_specific_items}):
+            log_event("theme_result", step="fused", attempt=attempt + 1, kw=kw, outcome="duplicate", item=item)
+            metrics.inc("gacha_duplicates_total", step="fused")
+            stats["duplicates"] += 1
+            continue
+        if not (yield {"claim": theme, "store": generated_themes}):
+            log_event("theme_result", step="fused", attempt=attempt + 1, kw=kw, outcome="duplicate", theme=theme)
+            metrics.inc("gacha_duplicates_total", step="fused")
+            stats["duplicates"] += 1
+            continue
+
+        log_event("theme_result", step="fused", attempt=attempt + 1, kw=kw, outcome="ok", theme=theme, item=item)
+        return {"theme": theme, "hint": hint}
+
+    log_event("pipeline_failed", level="warning", step="fused", kw=kw)
+    return {"theme": "ハズレ", "hint": "話題生成に失敗しました。"}
+
+# specific の手順を包み、スピン単位の所要時間とAPI呼び出し数をモード別に記録する
+def measure_specific_pipeline(mode, pipeline):
+    stats = specific_mode_stats[mode]
+    started = time.monotonic()
+    result = None
+    try:
+        call = next(pipeline)
+        while True:
+            if "claim" not in call:
+                stats["calls"] += 1
+            call = pipeline.send((yield call))
+    except StopIteration as stop:
+        result = stop.value
+    stats["spins"] += 1
+    stats["total_seconds"] += time.monotonic() - started
+    if result and result.get("theme") != "ハズレ":
+        stats["successes"] += 1
+    return result
+
+def get_specific_mode_stats():
+    summary = {"mode": SPECIFIC_MODE}
+    for mode, stats in specific_mode_stats.items():
+        spins = stats["spins"]
+        summary[mode] = dict(
+            stats,
+            avg_seconds=round(stats["total_seconds"] / spins, 3) if spins else None,
+            calls_per_spin=round(stats["calls"] / spins, 2) if spins else None,
+            duplicate_rate=round(stats["duplicates"] / stats["calls"], 3) if stats["calls"] else None,
+        )
+    return summary
+
+# テーマ生成の手順 (specific の場合は SPECIFIC_MODE に応じて方式を選び、計測を挟む)
+def theme_pipeline(keyword=None, specific=False):
+    if specific and keyword:
+        if SPECIFIC_MODE == "fused":
+            return (yield from measure_specific_pipeline("fused", fused_specific_pipeline(keyword)))
+        return (yield from measure_specific_pipeline("two_step", two_step_theme_pipeline(keyword, specific)))
+    return (yield from two_step_theme_pipeline(keyword, specific))
+
+# パイプラインを同期的に実行する (API呼び出しは call_openrouter_api)
+# 呼び出しの間隔と締め切りは schedule に従い、間に合わない呼び出しは DEADLINE_ERROR を返す
+def run_pipeline(pipeline, schedule=None):
+    schedule = schedule or RetrySchedule()
+    try:
+        call = next(pipeline)
+        while True:
+            if "claim" in call:
+                call = pipeline.send(call["store"].claim(call["claim"]))
+                continue
+            step = call.pop("step", "other")
+            attempt = call.pop("attempt", None)
+            keyword = call.pop("keyword", None)
+            call.setdefault("model", model_router.choose(step))
+            wait = schedule.next_wait()
+            if wait is None:
+                result = (None, DEADLINE_ERROR)
+                metrics.inc("gacha_upstream_errors_total", step=step, kind="deadline")
+                log_event("upstream_call", level="warning", step=step, attempt=attempt, kw=keyword_hash(keyword), outcome="deadline")
+            else:
+                if wait:
+                    time.sleep(wait)
+                started = time.monotonic()
+                result = call_openrouter_api(**call, timeout=schedule.remaining())
+                record_upstream_call(step, result[1], time.monotonic() - started, attempt, keyword, call["model"])
+                schedule.record(result[1])
+            token = routed_call.set((step, call["model"]))
+            try:
+                call = pipeline.send(result)
+            finally:
+                routed_call.reset(token)
+    except StopIteration as stop:
+        return stop.value
+
+# パイプラインを非同期に実行する (応答待ちの間イベントループを解放する)
+# 重複の判定と登録は claim_async で行う (共有ストアならSQLiteの書き込みを別スレッドで待つ)
+async def run_pipeline_async(pipeline, schedule=None):
+    schedule = schedule or RetrySchedule()
+    try:
+        call = next(pipeline)
+        while True:
+            if "claim" in call:
+                call = pipeline.send(await call["store"].claim_async(call["claim"]))
+                continue
+            step = call.pop("step", "other")
+            attempt = call.pop("attempt", None)
+            keyword = call.pop("keyword", None)
+            call.setdefault("model", model_router.choose(step))
+            wait = schedule.next_wait()
+            if wait is None:
+                result = (None, DEADLINE_ERROR)
+                metrics.inc("gacha_upstream_errors_total", step=step, kind="deadline")
+                log_event("upstream_call", level="warning", step=step, attempt=attempt, kw=keyword_hash(keyword), outcome="deadline")
+            else:
+                if wait:
+                    await asyncio.sleep(wait)
+                started = time.monotonic()
+                result = await call_openrouter_api_async(**call, timeout=schedule.remaining())
+                record_upstream_call(step, result[1], time.monotonic() - started, attempt, keyword, call["model"])
+                schedule.record(result[1])
+            token = routed_call.set((step, call["model"]))
+            try:
+                call = pipeline.send(result)
+            finally:
+                routed_call.reset(token)
+    except StopIteration as stop:
+        return stop.value
+
+# 生成結果をテーマバンクに蓄える。回路が開いている・締め切りに間に合わない・送信待ちが溢れたために
+# 生成できなかった場合はテーマバンクから返す
+def settle_generated_theme(theme, keyword=None, schedule=None):
+    if theme["theme"] == "ハズレ" and (circuit_breaker.rejecting() or (schedule is not None and schedule.gave_up())):
+        return draw_offline_theme(keyword)
+    theme_bank.add(theme, keyword)
+    return theme
+
+# テーマ生成関数 (同期版: WSGIの /spin から呼ばれる)
+# schedule を渡すと呼び出し元の締め切りを引き継ぐ (省略時はここからスピン1回分の締め切りを数える)
+def generate_theme(keyword=None, specific=False, schedule=None):
+    if circuit_breaker.rejecting():
+        return draw_offline_theme(keyword)
+    schedule = schedule or RetrySchedule(SPIN_DEADLINE_SECONDS)
+    return settle_generated_theme(run_pipeline(theme_pipeline(keyword, specific), schedule), keyword, schedule)
+
+# テーマ生成関数 (非同期版)
+async def generate_theme_async(keyword=None, specific=False, schedule=None):
+    if circuit_breaker.rejecting():
+        return draw_offline_theme(keyword)
+    schedule = schedule or RetrySchedule(SPIN_DEADLINE_SECONDS)
+    return settle_generated_theme(await run_pipeline_async(theme_pipeline(keyword, specific), schedule), keyword, schedule)
+
+# 複数テーマ生成関数 (使えるテーマのリストを返す。0件の場合もある)
+# プールの補充用なので、回路が開いている間はテーマバンクでは埋めずに空で返す
+def generate_themes_batch(keyword=None, specific=False, count=THEME_BATCH_SIZE, schedule=None):
+    if circuit_breaker.rejecting():
+        return []
+    themes = run_pipeline(theme_batch_pipeline(keyword, specific, count), schedule)
+    for theme in themes:
+        theme_bank.add(theme, keyword)
+    return themes
+
+async def generate_themes_batch_async(keyword=None, specific=False, count=THEME_BATCH_SIZE, schedule=None):
+    if circuit_breaker.rejecting():
+        return []
+    themes = await run_pipeline_async(theme_batch_pipeline(keyword, specific, count), schedule)
+    for theme in themes:
+        theme_bank.add(theme, keyword)
+    return themes
+
+# --- ストリーミング生成 (SSE) ---
+# ストリーミング専用の生成手順は持たず、generate_theme と同じパイプラインを同じ呼び出し層 (ブレーカー・
+# 流量制御・ヘッジ・締め切り・カセット) で実行する。stream_listener を設定しておくと、ストリーミングで
+# 受信する送信関数が "theme" / "hint" が閉じた時点で通知するので、それをクライアントへ流す。
+# 再試行やヘッジでテーマが複数回届くことがあるため、ヒントは最後にテーマを通知した受信のものだけを流し、
+# 最後の done イベントで表示を確定する。
+
+# 送信関数からの通知のうちクライアントへ流すものを選び、最後に足りないイベントを補う (同期版・非同期版で共有する)
+class StreamRelay:
+    def __init__(self):
+        self.source = None
+        self.shown = {}
+
+    def accept(self, source, event, data):
+        if event == "theme":
+            self.source = source
+        elif source is not self.source:
+            return False
+        self.shown.update(data)
+        return True
+
+    # 通知されなかった結果 (テーマバンク・カセットの再生・バッチ生成など) は theme と hint を補ってから done を送る
+    def finish(self, theme):
+        events = []
+        if self.shown.get("theme") != theme["theme"]:
+            events.append(("theme", {"theme": theme["theme"]}))
+            events.append(("hint", {"hint": theme["hint"]}))
+        elif self.shown.get("hint") != theme["hint"]:
+            events.append(("hint", {"hint": theme["hint"]}))
+        events.append(("done", theme))
+        return events
+
+# テーマ生成をストリーミングで行い、("theme" | "hint" | "done", データ) をyieldする
+# 生成は別スレッドで行う (クライアントが途中で切断しても、そのスピンの締め切りまでには終わる)
+def stream_theme_events(keyword=None, specific=False):
+    events = queue.Queue()
+
+    def generate():
+        stream_listener.set(lambda source, event, data: events.put((source, event, data)))
+        theme = {"theme": "ハズレ", "hint": "空のカプセルが出てきちゃった！もう一度回そう"}
+        try:
+            theme = generate_theme(keyword, specific=specific)
+        finally:
+            events.put((None, "done", theme))
+
+    threading.Thread(target=generate, name="stream-spin", daemon=True).start()
+    relay = StreamRelay()
+    while True:
+        source, event, data = events.get()
+        if event == "done":
+            yield from relay.finish(data)
+            return
+        if relay.accept(source, event, data):
+            yield event, data
+
+# テーマ生成をストリーミングで行う (非同期版: ASGIの /spin/stream から呼ばれる)
+# クライアントが切断してこのジェネレーターが閉じられたら、生成のタスクもキャンセルする
+async def stream_theme_events_async(keyword=None, specific=False):
+    events = asyncio.Queue()
+
+    async def generate():
+        stream_listener.set(lambda source, event, data: events.put_nowait((source, event, data)))
+        theme = {"theme": "ハズレ", "hint": "空のカプセルが出てきちゃった！もう一度回そう"}
+        try:
+            theme = await generate_theme_async(keyword, specific=specific)
+        finally:
+            events.put_nowait((None, "done", theme))
+
+    task = asyncio.ensure_future(generate())
+    relay = StreamRelay()
+    try:
+        while True:
+            source, event, data = await events.get()
+            if event == "done":
+                for item in relay.finish(data):
+                    yield item
+                return
+            if relay.accept(source, event, data):
+                yield event, data
+    finally:
+        task.cancel()
+
+def format_sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# プールにあればそのまま、なければストリーミング生成で (イベント, データ) をyieldする
+def spin_stream_events(keyword=None, specific=False):
+    started = time.monotonic()
+    pooled = take_pooled_theme(keyword, specific)
+    if pooled:
+        stream = iter([("theme", {"theme": pooled["theme"]}), ("hint", {"hint": pooled["hint"]}), ("done", pooled)])
+    else:
+        stream = stream_theme_events(keyword, specific=specific)
+    for event, data in stream:
+        if event == "done":
+            record_spin("stream", data, started, pooled=bool(pooled))
+        yield event, data
+
+async def spin_stream_events_async(keyword=None, specific=False):
+    started = time.monotonic()
+    pooled = take_pooled_theme(keyword, specific)
+    if pooled:
+        yield "theme", {"theme": pooled["theme"]}
+        yield "hint", {"hint": pooled["hint"]}
+        record_spin("stream", pooled, started, pooled=True)
+        yield "done", pooled
+        return
+    async with aclosing(stream_theme_events_async(keyword, specific=specific)) as stream:
+        async for event, data in stream:
+            if event == "done":
+                record_spin("stream", data, started)
+            yield event, data
+
+# --- 生成済みカプセルのプール ---
+# キーワードなしのスピンは事前に生成・重複排除済みのテーマを取り出すだけにし、
+# 補充はバックグラウンドスレッドが行う。残量が下限 (low) を切ると上限 (high) まで補充する。
+CAPSULE_POOL_ENABLED = os.environ.get("CAPSULE_POOL_ENABLED", "1") != "0"
+CAPSULE_POOL_LOW = int(os.environ.get("CAPSULE_POOL_LOW", "5"))
+CAPSULE_POOL_HIGH = int(os.environ.get("CAPSULE_POOL_HIGH", "20"))
+CAPSULE_POOL_WORKERS = int(os.environ.get("CAPSULE_POOL_WORKERS", "2"))
+# 生成に失敗した (ハズレ) 場合に補充スレッドが待機する秒数
+CAPSULE_POOL_ERROR_BACKOFF = float(os.environ.get("CAPSULE_POOL_ERROR_BACKOFF", "5"))
+
+class CapsulePool:
+    _start_lock = threading.Lock()
+
+    def __init__(self, generate, low=CAPSULE_POOL_LOW, high=CAPSULE_POOL_HIGH, workers=CAPSULE_POOL_WORKERS):
+        self.generate = generate # generate(count) -> テーマ(dict)のリスト (1回のAPI呼び出しでまとめて生成)
+        self.low = low
+        self.high = max(high, low + 1)
+        self.workers = workers
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._refilling = False
+        self._in_flight = 0
+        self._pid = None
+        self.hits = 0
+        self.misses = 0
+
+    # バックグラウンドの補充スレッドはforkを越えて引き継がれないため、プロセスごとに起動する
+    def _ensure_workers(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with CapsulePool._start_lock:
+            if self._pid == pid:
+                return
+            self._cond = threading.Condition()
+            self._pid = pid
+            self._in_flight = 0
+            self._refilling = len(self._items) < self.low
+            for i in range(self.workers):
+                threading.Thread(target=self._refill_loop, name=f"capsule-refill-{i}", daemon=True).start()
+
+    # カプセルを1つ取り出す (O(1))。空なら None を返し、呼び出し側がその場で生成する
+    def pop(self):
+        self._ensure_workers()
+        with self._cond:
+            theme = self._items.popleft() if self._items else None
+            if theme is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            if not self._refilling and len(self._items) < self.low:
+                self._refilling = True
+                self._cond.notify_all()
+        return theme
+
+    def _refill_loop(self):
+        background_work.set(True)
+        while True:
+            with self._cond:
+                while not self._refilling or len(self._items) + self._in_flight >= self.high:
+                    if len(self._items) >= self.high:
+                        self._refilling = False
+                    self._cond.wait()
+                count = min(THEME_BATCH_SIZE, self.high - len(self._items) - self._in_flight)
+                self._in_flight += count
+            themes = []
+            try:
+                themes = self.generate(count)
+            except Exception as e:
+                log_event("refill_error", level="error", detail=str(e))
+            with self._cond:
+                self._in_flight -= count
+                ok = bool(themes)
+                self._items.extend(themes)
+                if len(self._items) >= self.high:
+                    self._refilling = False
+                self._cond.notify_all()
+            if not ok:
+                time.sleep(CAPSULE_POOL_ERROR_BACKOFF)
+
+    def stats(self):
+        return {
+            "size": len(self._items),
+            "low": self.low,
+            "high": self.high,
+            "in_flight": self._in_flight,
+            "refilling": self._refilling,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+# fork時に親で保持されていたロックを子プロセスに持ち込まない
+def _reset_capsule_pool_lock_after_fork():
+    CapsulePool._start_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_capsule_pool_lock_after_fork)
+
+# キーワードなしのスピン用プール
+default_capsule_pool = CapsulePool(lambda count: generate_themes_batch(count=count))
+
+# --- キーワード別の需要駆動プール ---
+# (keyword, specific) ごとに小さなプールを持ち、直近のスピン頻度 (指数減衰平均, EWMA) が
+# 一定以上のキーワードだけを先読みする。全体の保持数には上限があり、超えた分は
+# 最も長く使われていないキーワードから捨てる (LRU)。
+# EWMAの時定数 (秒)
+KEYWORD_POOL_RATE_WINDOW = float(os.environ.get("KEYWORD_POOL_RATE_WINDOW", "120"))
+# 先読みを始める最低頻度 (1分あたりのスピン数)
+KEYWORD_POOL_MIN_SPINS_PER_MIN = float(os.environ.get("KEYWORD_POOL_MIN_SPINS_PER_MIN", "1"))
+# 何秒分の需要を先に用意しておくか
+KEYWORD_POOL_LEAD_SECONDS = float(os.environ.get("KEYWORD_POOL_LEAD_SECONDS", "60"))
+# 1キーワードあたりの最大保持数 / 全キーワード合計の最大保持数 / 追跡するキーワード数の上限
+KEYWORD_POOL_MAX_PER_KEY = int(os.environ.get("KEYWORD_POOL_MAX_PER_KEY", "5"))
+KEYWORD_POOL_MAX_CAPSULES = int(os.environ.get("KEYWORD_POOL_MAX_CAPSULES", "500"))
+KEYWORD_POOL_MAX_KEYS = int(os.environ.get("KEYWORD_POOL_MAX_KEYS", "1000"))
+KEYWORD_POOL_WORKERS = int(os.environ.get("KEYWORD_POOL_WORKERS", "2"))
+
+class KeywordCapsulePools:
+    def __init__(self, generate):
+        self.generate = generate # generate(keyword, specific, count) -> テーマ(dict)のリスト
+        self._entries = OrderedDict() # key -> {"items", "count", "last", "in_flight"} (末尾が最近使用)
+        self._lock = threading.Lock()
+        self._queue = None
+        self._queued = set()
+        self._pid = None
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _ensure_workers(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with CapsulePool._start_lock:
+            if self._pid == pid:
+                return
+            self._lock = threading.Lock()
+            self._queue = queue.Queue()
+            self._queued = set()
+            for entry in self._entries.values():
+                entry["in_flight"] = 0
+            self._pid = pid
+            for i in range(KEYWORD_POOL_WORKERS):
+                threading.Thread(target=self._refill_loop, name=f"keyword-refill-{i}", daemon=True).start()
+
+    # 減衰済みの需要カウントから1秒あたりのスピン数を求める
+    @staticmethod
+    def _rate(entry, now):
+        return entry["count"] * math.exp(-(now - entry["last"]) / KEYWORD_POOL_RATE_WINDOW) / KEYWORD_POOL_RATE_WINDOW
+
+    # 現在の需要に見合うプールの目標サイズ
+    @staticmethod
+    def _target(rate):
+        if rate * 60 < KEYWORD_POOL_MIN_SPINS_PER_MIN:
+            return 0
+        return min(KEYWORD_POOL_MAX_PER_KEY, max(1, math.ceil(rate * KEYWORD_POOL_LEAD_SECONDS)))
+
+    # 上限を超えている間、最も長く使われていないキーワードを捨てる (keepは対象外)
+    def _evict(self, keep=None):
+        while self._total > KEYWORD_POOL_MAX_CAPSULES or len(self._entries) > KEYWORD_POOL_MAX_KEYS:
+            victim = next((key for key in self._entries if key != keep), None)
+            if victim is None:
+                break
+            entry = self._entries.pop(victim)
+            self._total -= len(entry["items"])
+            self.evictions += 1
+
+    def _schedule(self, key, entry, now):
+        if key in self._queued:
+            return
+        if len(entry["items"]) + entry["in_flight"] < self._target(self._rate(entry, now)):
+            self._queued.add(key)
+            self._queue.put(key)
+
+    # スピン1回分の需要を記録し、プールにカプセルがあれば取り出す
+    def take(self, keyword, specific=False):
+        themes = self.take_many(keyword, specific, 1)
+        return themes[0] if themes else None
+
+    # 1回のリクエストで最大 count 件を取り出す。まとめて取り出しても需要は1スピン分として記録する
+    # (パーティーモードの20件を20スピンと数えると、そのキーワードを過剰に先読みしてしまう)
+    def take_many(self, keyword, specific=False, count=1):
+        self._ensure_workers()
+        key = (keyword.strip(), bool(specific))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"items": deque(), "count": 0.0, "last": now, "in_flight": 0}
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            entry["count"] = entry["count"] * math.exp(-(now - entry["last"]) / KEYWORD_POOL_RATE_WINDOW) + 1
+            entry["last"] = now
+            themes = [entry["items"].popleft() for _ in range(min(count, len(entry["items"])))]
+            if len(themes) < count:
+                self.misses += 1
+            self.hits += len(themes)
+            self._total -= len(themes)
+            self._evict(keep=key)
+            self._schedule(key, entry, now)
+        return themes
+
+    def _refill_loop(self):
+        background_work.set(True)
+        while True:
+            key = self._queue.get()
+            with self._lock:
+                self._queued.discard(key)
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                count = min(THEME_BATCH_SIZE, self._target(self._rate(entry, time.monotonic())) - len(entry["items"]) - entry["in_flight"])
+                if count <= 0:
+                    continue
+                entry["in_flight"] += count
+            themes = []
+            try:
+                themes = self.generate(*key, count)
+            except Exception as e:
+                log_event("refill_error", level="error", kw=keyword_hash(key[0]), detail=str(e))
+            ok = bool(themes)
+            with self._lock:
+                entry["in_flight"] -= count
+                # 生成中に追い出されたキーワードの結果は捨てる
+                if ok and self._entries.get(key) is entry:
+                    entry["items"].extend(themes)
+                    self._total += len(themes)
+                    self._evict(keep=key)
+                    self._schedule(key, entry, time.monotonic())
+            if not ok:
+                time.sleep(CAPSULE_POOL_ERROR_BACKOFF)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            hot = sorted(self._entries.items(), key=lambda kv: self._rate(kv[1], now), reverse=True)[:10]
+            return {
+                "keys": len(self._entries),
+                "capsules": self._total,
+                "max_capsules": KEYWORD_POOL_MAX_CAPSULES,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hot": [
+                    {
+                        "keyword": key[0],
+                        "specific": key[1],
+                        "spins_per_min": round(self._rate(entry, now) * 60, 2),
+                        "size": len(entry["items"]),
+                    }
+                    for key, entry in hot
+                ],
+            }
+
+# キーワードあり (specific含む) のスピン用プール
+keyword_capsule_pools = KeywordCapsulePools(
+    lambda keyword, specific, count: generate_themes_batch(keyword, specific=specific, count=count)
+)
+
+# プールから取り出せるテーマがあれば返す (なければ None)
+def take_pooled_theme(keyword=None, specific=False):
+    if not CAPSULE_POOL_ENABLED:
+        return None
+    if not keyword:
+        return default_capsule_pool.pop()
+    return keyword_capsule_pools.take(keyword, specific)
+
+# --- 同時スピンの相乗り (シングルフライト) ---
+# 流行りのキーワードでは同じ keyword/specific のスピンが同時に大量に届き、それぞれが同じ生成を始めてしまう。
+# 最初のスピン (リーダー) が短い時間だけ相乗りを待ち、その間に届いた同じキーのスピンと合わせて
+# 人数分のテーマを1回のバッチ生成でまとめて作り、1人1つずつ別のテーマを配る。
+# 1人だけなら従来どおり generate_theme で生成する。
+SPIN_COALESCE_ENABLED = os.environ.get("SPIN_COALESCE_ENABLED", "1") != "0"
+SPIN_COALESCE_WINDOW = float(os.environ.get("SPIN_COALESCE_WINDOW", "0.05")) # 相乗りを待つ秒数
+SPIN_COALESCE_MAX_BATCH = int(os.environ.get("SPIN_COALESCE_MAX_BATCH", str(THEME_BATCH_SIZE * 2))) # 1便の最大人数
+
+class SpinCoalescer:
+    def __init__(self, window=SPIN_COALESCE_WINDOW, max_batch=SPIN_COALESCE_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self._flights = {} # (keyword, specific) -> 相乗りを受け付け中の便
+        self._lock = threading.Lock()
+        self.flights = 0
+        self.coalesced = 0 # 他のスピンの便に相乗りした数
+        self.shortfall = 0 # バッチの件数が足りず個別に生成した数
+
+    # 便に乗る。(便, 自分の番号, リーダーか) を返す
+    def _join(self, key):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None or flight["members"] >= self.max_batch:
+                # 同期・非同期のどちらの呼び出し側からも待てるよう concurrent.futures.Future を使う
+                flight = {"members": 0, "future": Future()}
+                self._flights[key] = flight
+                self.flights += 1
+            else:
+                self.coalesced += 1
+            slot = flight["members"]
+            flight["members"] += 1
+            return flight, slot, slot == 0
+
+    # 相乗りの受付を締め切り、乗った人数を返す
+    def _depart(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            return flight["members"]
+
+    # 便の結果から自分の分を取り出す (足りなければ None を返し、呼び出し側が個別に生成する)
+    # 締め切りはリーダーの便と共有する。もう時間がなければ生成し直さずにテーマバンクから返す
+    def _settle(self, themes, slot, schedule, keyword):
+        if slot < len(themes):
+            return themes[slot]
+        self.shortfall += 1
+        if circuit_breaker.rejecting() or schedule.gave_up():
+            return draw_offline_theme(keyword)
+        return None
+
+    # 個別に生成し直すときの締め切り (便の残り時間。再試行の回数などは乗客ごとに数える)
+    @staticmethod
+    def _rest_of(schedule):
+        return RetrySchedule(schedule.remaining())
+
+    def spin(self, keyword=None, specific=False):
+        key = (keyword, specific)
+        flight, slot, leader = self._join(key)
+        if leader:
+            schedule = RetrySchedule(SPIN_DEADLINE_SECONDS)
+            themes = []
+            try:
+                time.sleep(self.window)
+                members = self._depart(key, flight)
+                if members == 1:
+                    themes = [generate_theme(keyword, specific=specific, schedule=schedule)]
+                else:
+                    log_event("coalesced", kw=keyword_hash(keyword), members=members)
+                    themes = generate_themes_batch(keyword, specific, members, schedule)
+            finally:
+                # 失敗した場合も他の乗客を待たせたままにしない (各自で生成し直す)
+                self._depart(key, flight)
+                flight["future"].set_result((themes, schedule))
+        themes, schedule = flight["future"].result()
+        return self._settle(themes, slot, schedule, keyword) or generate_theme(keyword, specific=specific, schedule=self._rest_of(schedule))
+
+    async def spin_async(self, keyword=None, specific=False):
+        key = (keyword, specific)
+        flight, slot, leader = self._join(key)
+        if leader:
+            schedule = RetrySchedule(SPIN_DEADLINE_SECONDS)
+            themes = []
+            try:
+                await asyncio.sleep(self.window)
+                members = self._depart(key, flight)
+                if members == 1:
+                    themes = [await generate_theme_async(keyword, specific=specific, schedule=schedule)]
+                else:
+                    log_event("coalesced", kw=keyword_hash(keyword), members=members)
+                    themes = await generate_themes_batch_async(keyword, specific, members, schedule)
+            finally:
+                self._depart(key, flight)
+                flight["future"].set_result((themes, schedule))
+        # 自分がキャンセルされても、同じ便を待つ他の乗客の Future は取り消さない
+        themes, schedule = await asyncio.shield(asyncio.wrap_future(flight["future"]))
+        return self._settle(themes, slot, schedule, keyword) or await generate_theme_async(keyword, specific=specific, schedule=self._rest_of(schedule))
+
+    def stats(self):
+        return {
+            "enabled": SPIN_COALESCE_ENABLED,
+            "window": self.window,
+            "flights": self.flights,
+            "coalesced": self.coalesced,
+            "shortfall": self.shortfall,
+        }
+
+spin_coalescer = SpinCoalescer()
+
+# プールになければ生成する (同時に届いた同じキーのスピンとは相乗りする)
+def spin_theme(keyword=None, specific=False):
+    started = time.monotonic()
+    theme = take_pooled_theme(keyword, specific)
+    if theme:
+        record_spin("spin", theme, started, pooled=True)
+        return theme
+    if SPIN_COALESCE_ENABLED:
+        theme = spin_coalescer.spin(keyword, specific)
+    else:
+        theme = generate_theme(keyword, specific=specific)
+    record_spin("spin", theme, started)
+    return theme
+
+async def spin_theme_async(keyword=None, specific=False):
+    started = time.monotonic()
+    theme = take_pooled_theme(keyword, specific)
+    if theme:
+        record_spin("spin", theme, started, pooled=True)
+        return theme
+    if SPIN_COALESCE_ENABLED:
+        theme = await spin_coalescer.spin_async(keyword, specific)
+    else:
+        theme = await generate_theme_async(keyword, specific=specific)
+    record_spin("spin", theme, started)
+    return theme
+
+# --- まとめてスピン (パーティーモード) ---
+# 続けて何度も回す代わりに、1回のリクエストで重複しないテーマをN件返す。
+# プールにあるものを先に使い、足りない分だけ generate_themes_batch で1回 (不足なら数回) の呼び出しにまとめて生成する。
+# バッチ生成は generated_themes に対してまとめて重複排除するので、セット内・過去のスピンとも被らない。
+SPIN_BATCH_DEFAULT = int(os.environ.get("SPIN_BATCH_DEFAULT", str(THEME_BATCH_SIZE)))
+
+def parse_batch_count(value):
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        count = SPIN_BATCH_DEFAULT
+    return max(1, min(count, THEME_BATCH_MAX_SIZE))
+
+def take_pooled_themes(keyword, specific, count):
+    if not CAPSULE_POOL_ENABLED:
+        return []
+    if keyword:
+        return keyword_capsule_pools.take_many(keyword, specific, count)
+    themes = []
+    while len(themes) < count:
+        theme = default_capsule_pool.pop()
+        if not theme:
+            break
+        themes.append(theme)
+    return themes
+
+# 生成しきれなかった分は、回路が開いている・締め切りに間に合わない場合に限りテーマバンクで補う
+# (バンクのテーマも生成したものと同じく generated_themes で重複を除き、出したものは登録する)
+def settle_theme_set(themes, keyword, count, schedule):
+    if len(themes) < count and (circuit_breaker.rejecting() or schedule.gave_up()):
+        seen = {theme["theme"] for theme in themes}
+        for _ in range(4 * (count - len(themes))): # 既出のテーマを読み飛ばす分だけ多めに引く
+            theme = draw_offline_theme(keyword)
+            if theme["theme"] == "ハズレ":
+                break
+            if theme["theme"] not in seen and generated_themes.claim(theme["theme"]):
+                seen.add(theme["theme"])
+                themes.append(theme)
+            if len(themes) >= count:
+                break
+    if not themes:
+        themes = [{"theme": "ハズレ", "hint": "空のカプセルが出てきちゃった！もう一度回そう"}]
+    return themes
+
+def spin_theme_set(keyword=None, specific=False, count=SPIN_BATCH_DEFAULT):
+    started = time.monotonic()
+    themes = take_pooled_themes(keyword, specific, count)
+    schedule = RetrySchedule(SPIN_DEADLINE_SECONDS)
+    pooled = len(themes) >= count
+    if not pooled:
+        themes += generate_themes_batch(keyword, specific, count - len(themes), schedule)
+    themes = settle_theme_set(themes, keyword, count, schedule)
+    record_spin("batch", themes[0], started, pooled=pooled)
+    return themes
+
+async def spin_theme_set_async(keyword=None, specific=False, count=SPIN_BATCH_DEFAULT):
+    started = time.monotonic()
+    themes = take_pooled_themes(keyword, specific, count)
+    schedule = RetrySchedule(SPIN_DEADLINE_SECONDS)
+    pooled = len(themes) >= count
+    if not pooled:
+        themes += await generate_themes_batch_async(keyword, specific, count - len(themes), schedule)
+    if len(themes) < count:
+        # テーマバンクで補う分の登録は共有ストアへの書き込みになるのでイベントループの外で行う
+        themes = await asyncio.to_thread(settle_theme_set, themes, keyword, count, schedule)
+    else:
+        themes = settle_theme_set(themes, keyword, count, schedule)
+    record_spin("batch", themes[0], started, pooled=pooled)
+    return themes
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -271,5 +3804,157 @@ def index():
 def spin():
     keyword     = request.args.get("keyword")
     is_specific = request.args.get("specific") == "true"
-    theme       = generate_theme(keyword, specific=is_specific)
+    theme       = spin_theme(keyword, specific=is_specific)
     return jsonify(theme)
+
+# 重複しないテーマをまとめて返すスピン (count件、上限 THEME_BATCH_MAX_SIZE)
+@app.route('/spin/batch')
+def spin_batch():
+    keyword     = request.args.get("keyword")
+    is_specific = request.args.get("specific") == "true"
+    count       = parse_batch_count(request.args.get("count"))
+    themes      = spin_theme_set(keyword, specific=is_specific, count=count)
+    return jsonify({"themes": themes})
+
+# テーマをSSEで段階的に返すスピン (theme → hint → done の順にイベントを送る)
+@app.route('/spin/stream')
+def spin_stream():
+    keyword     = request.args.get("keyword")
+    is_specific = request.args.get("specific") == "true"
+    events      = spin_stream_events(keyword, specific=is_specific)
+    return Response(
+        stream_with_context(format_sse_event(event, data) for event, data in events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ワーカー単位の内部統計 (接続プールの再利用状況など)
+@app.route('/stats')
+def stats():
+    return jsonify({
+        "http_pool": get_http_pool_stats(),
+        "capsule_pool": default_capsule_pool.stats(),
+        "keyword_pools": keyword_capsule_pools.stats(),
+        "hedge": hedge_policy.stats(),
+        "specific_mode": get_specific_mode_stats(),
+        "dedup": generated_themes.stats(),
+        "early_abort": stream_abort_stats.stats(),
+        "circuit_breaker": circuit_breaker.stats(),
+        "retry": get_retry_stats(),
+        "outbound_limiter": outbound_limiter.stats(),
+        "coalescing": spin_coalescer.stats(),
+        "parsing": get_parse_stats(),
+        "prompts": prompts.stats(),
+        "theme_bank": theme_bank.stats(),
+        "logging": event_log.stats(),
+        "cassette": cassette.stats(),
+        "model_routing": model_router.stats(),
+    })
+
+# Prometheus形式のメトリクス (SHARED_STATE_DB か PROMETHEUS_MULTIPROC_DIR の指定時は全ワーカーの合計、
+# 未指定なら worker ラベル付きのワーカー単位の値)
+@app.route('/metrics')
+def metrics_endpoint():
+    gauges = {
+        "gacha_dedup_store_size": [({}, len(generated_themes))],
+        "gacha_capsule_pool_size": [({}, default_capsule_pool.stats()["size"])],
+        "gacha_circuit_open": [({}, 0 if circuit_breaker.stats()["state"] == "closed" else 1)],
+    }
+    return Response(metrics.render(gauges), mimetype="text/plain; version=0.0.4")
+
+# --- ASGIエントリポイント ---
+# gunicorn の非同期ワーカー (uvicorn) で起動する場合は app:asgi_app を指定する。
+# /spin, /spin/batch, /spin/stream はイベントループ上で直接処理し、それ以外のルートは従来のFlaskアプリに委譲する。
+async def spin_asgi(scope, receive, send):
+    query = parse_qs(scope.get("query_string", b"").decode("utf-8"))
+    keyword     = query.get("keyword", [None])[0]
+    is_specific = query.get("specific", [None])[0] == "true"
+    theme       = await spin_theme_async(keyword, specific=is_specific)
+    await send_json_asgi(send, theme)
+
+async def spin_batch_asgi(scope, receive, send):
+    query = parse_qs(scope.get("query_string", b"").decode("utf-8"))
+    keyword     = query.get("keyword", [None])[0]
+    is_specific = query.get("specific", [None])[0] == "true"
+    count       = parse_batch_count(query.get("count", [None])[0])
+    themes      = await spin_theme_set_async(keyword, specific=is_specific, count=count)
+    await send_json_asgi(send, {"themes": themes})
+
+# SSEを送りながら切断を監視し、クライアントが離れたら生成を止める (上流の接続と送信枠はその場で返す)
+async def spin_stream_asgi(scope, receive, send):
+    query = parse_qs(scope.get("query_string", b"").decode("utf-8"))
+    keyword     = query.get("keyword", [None])[0]
+    is_specific = query.get("specific", [None])[0] == "true"
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+    async def pump():
+        async with aclosing(spin_stream_events_async(keyword, specific=is_specific)) as events:
+            async for event, data in events:
+                body = format_sse_event(event, data).encode("utf-8")
+                await send({"type": "http.response.body", "body": body, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def wait_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    pumping = asyncio.ensure_future(pump())
+    watching = asyncio.ensure_future(wait_disconnect())
+    try:
+        await asyncio.wait({pumping, watching}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in (pumping, watching):
+            task.cancel()
+        await asyncio.gather(pumping, watching, return_exceptions=True)
+    if pumping.done() and not pumping.cancelled() and pumping.exception():
+        raise pumping.exception()
+
+async def send_json_asgi(send, data):
+    # jsonify と同じ形式 (キー順・エスケープ) で返す
+    body = (app.json.dumps(data, separators=(",", ":")) + "\n").encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("ascii")),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+# ASGIで直接処理するルート (GETのみ)
+asgi_routes = {
+    "/spin": spin_asgi,
+    "/spin/batch": spin_batch_asgi,
+    "/spin/stream": spin_stream_asgi,
+}
+
+_flask_asgi = WsgiToAsgi(app)
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await close_async_http_client()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    handler = asgi_routes.get(scope.get("path"))
+    if scope["type"] == "http" and handler and scope.get("method") == "GET":
+        await handler(scope, receive, send)
+    else:
+        # keep-alive接続では前のリクエストで設定されたcontextvars (asgirefの実行スレッド情報) が
+        # 次のリクエストに漏れて500になるため、委譲は毎回新しいコンテキストで実行する
+        await asyncio.get_running_loop().create_task(
+            _flask_asgi(scope, receive, send), context=contextvars.Context()
+        )
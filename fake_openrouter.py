@@ -0,0 +1,216 @@
+# OpenRouter (OpenAI互換 chat/completions) の代わりに応答するローカルサーバー
+# 本物のAPIを呼ばずに /spin の処理能力と遅延を測るためのもの。標準ライブラリだけで動く。
+#
+#   python fake_openrouter.py --port 8765 --latency lognormal:0.8,0.5 --error-rate 0.02 --rate-limit-rate 0.01
+#   OPENROUTER_API_KEY=dummy OPENROUTER_API_URL=http://127.0.0.1:8765/api/v1/chat/completions gunicorn app:asgi_app ...
+#
+# 遅延の分布 (--latency):
+#   const:0.3            常に0.3秒
+#   uniform:0.1,1.0      0.1〜1.0秒の一様分布
+#   exp:0.5              平均0.5秒の指数分布
+#   lognormal:0.8,0.5    中央値0.8秒・σ=0.5の対数正規分布 (実際のAPIに近い裾の長い分布)
+# プロンプトの文面から応答の形 (テーマ1件 / 配列 / 具体名 / 候補リスト) を判断して返す。
+# stream: true の場合はSSEで少しずつ返す (最初の断片までに遅延の3割、残りを断片に振り分ける)。
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワガギグゲゴザジズゼゾダヂヅデドバビブベボパピプペポ"
+TOPIC_SUFFIXES = ["の思い出", "の楽しみ方", "にまつわる話", "の好きなところ", "あるある", "に挑戦するなら"]
+DUPLICATE_THEME = "何度も出てくるテーマ"
+
+def parse_latency(spec):
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "const":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "exp":
+        return lambda rng: rng.expovariate(1 / values[0])
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise argparse.ArgumentTypeError(f"unknown latency distribution: {spec}")
+
+class FakeOpenRouter:
+    def __init__(self, args):
+        self.args = args
+        self.latency = parse_latency(args.latency)
+        self.rng = random.Random(args.seed)
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "errors": 0, "rate_limited": 0, "duplicates": 0, "malformed": 0}
+
+    def roll(self, rate):
+        with self._lock:
+            return self.rng.random() < rate
+
+    def sample_latency(self):
+        with self._lock:
+            return max(self.latency(self.rng), 0.0)
+
+    def count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    # 近似重複判定に引っかからないよう、文字の並びがばらばらの名前を作る
+    def word(self):
+        with self._lock:
+            return "".join(self.rng.choice(KATAKANA) for _ in range(self.rng.randint(3, 5)))
+
+    def theme(self):
+        with self._lock:
+            suffix = self.rng.choice(TOPIC_SUFFIXES)
+        return {"theme": f"{self.word()}{self.word()}{suffix}", "hint": f"{self.word()}について話してみよう"}
+
+    # プロンプトの文面から、アプリが期待している応答の形を作る
+    def content_for(self, prompt):
+        match = re.search(r"(\d+)個", prompt)
+        count = int(match.group(1)) if match else 1
+        wants_item = '"item"' in prompt
+        if "文字列だけ" in prompt:
+            return json.dumps([self.word() for _ in range(count)], ensure_ascii=False)
+        if "JSON配列" in prompt:
+            items = []
+            for _ in range(count):
+                item = self.theme()
+                if wants_item:
+                    item = {"item": self.word(), **item}
+                items.append(item)
+            return json.dumps(items, ensure_ascii=False)
+        if wants_item:
+            return json.dumps({"item": self.word(), **self.theme()}, ensure_ascii=False)
+        if "単語" in prompt:
+            return self.word()
+        return json.dumps(self.theme(), ensure_ascii=False)
+
+    def malformed(self, content):
+        with self._lock:
+            truncate = self.rng.random() < 0.5
+        if truncate:
+            return content[: max(len(content) // 2, 1)]
+        return "すみません、今回はうまく考えられませんでした。別のお題をお試しください。"
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts)
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, status, body, headers=()):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self.send_json(200, fake.stats())
+            else:
+                self.send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            fake.count("requests")
+            latency = fake.sample_latency()
+
+            if fake.roll(fake.args.rate_limit_rate):
+                fake.count("rate_limited")
+                time.sleep(min(latency, 0.05))
+                self.send_json(429, {"error": {"code": 429, "message": "Rate limit exceeded"}},
+                               [("Retry-After", str(fake.args.retry_after))])
+                return
+            if fake.roll(fake.args.error_rate):
+                fake.count("errors")
+                time.sleep(latency)
+                self.send_json(500, {"error": {"code": 500, "message": "Internal error"}})
+                return
+
+            prompt = body.get("messages", [{}])[-1].get("content", "")
+            content = fake.content_for(prompt)
+            if fake.roll(fake.args.duplicate_rate):
+                fake.count("duplicates")
+                content = re.sub(r'"theme": "[^"]*"', f'"theme": "{DUPLICATE_THEME}"', content)
+            if fake.roll(fake.args.malformed_rate):
+                fake.count("malformed")
+                content = fake.malformed(content)
+
+            if body.get("stream"):
+                self.stream(content, latency)
+                return
+            time.sleep(latency)
+            self.send_json(200, {
+                "id": "fake-completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(prompt), "completion_tokens": len(content)},
+            })
+
+        def stream(self, content, latency):
+            chunks = [content[i:i + 4] for i in range(0, len(content), 4)] or [""]
+            time.sleep(latency * 0.3)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def write(data):
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+
+            try:
+                write(b": OPENROUTER PROCESSING\n\n")
+                for chunk in chunks:
+                    event = {"choices": [{"index": 0, "delta": {"content": chunk}}]}
+                    write(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+                    time.sleep(latency * 0.7 / len(chunks))
+                write(b"data: [DONE]\n\n")
+                write(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                # 重複テーマの早期打ち切りでアプリ側が接続を閉じた
+                pass
+
+    return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenRouter互換のローカル偽サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", default="lognormal:0.8,0.5", help="遅延の分布 (const / uniform / exp / lognormal)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500エラーを返す割合")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="429を返す割合")
+    parser.add_argument("--retry-after", type=int, default=1, help="429に付ける Retry-After (秒)")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="毎回同じテーマを返す割合")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="途中で切れたJSONや文章だけを返す割合")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    parse_latency(args.latency)
+
+    fake = FakeOpenRouter(args)
+    server = FakeServer((args.host, args.port), make_handler(fake))
+    print(f"fake OpenRouter: http://{args.host}:{args.port}/api/v1/chat/completions (latency {args.latency})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(fake.stats()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# /spin の負荷試験 (処理能力と p50 / p95 / p99 の遅延を測る)
+# fake_openrouter.py と組み合わせれば本物のAPIを呼ばずに、generate_theme まわりの変更による
+# 性能の劣化を手元やCIで確認できる。
+#
+#   python fake_openrouter.py --latency lognormal:0.8,0.5 &
+#   OPENROUTER_API_KEY=dummy OPENROUTER_API_URL=http://127.0.0.1:8765/api/v1/chat/completions \
+#       gunicorn app:asgi_app -k uvicorn_worker.UvicornWorker -b 127.0.0.1:8000 &
+#   python loadtest.py --url http://127.0.0.1:8000 --concurrency 16 --requests 500 --max-p95 3
+#
+# スピンの種類 (--mix): plain (キーワードなし) / keyword (キーワードあり) / specific (キーワード + 具体的に)
+# 結果は種類別と全体で表示する。--json で機械可読な結果を出力し、--max-p95 / --max-error-rate を
+# 超えた場合は終了コード1で終わる。
+# /spin/stream (SSE) を測る場合は --sse (パスが /stream で終わる場合は自動) でイベントを読みながら、
+# theme イベントまでの時間 (画面にテーマが出るまで) と done イベントまでの時間を別々に記録する。
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SPIN_KINDS = ("plain", "keyword", "specific")
+DEFAULT_KEYWORDS = "猫,戦国武将,アニメ,ラーメン,映画,旅行"
+
+def parse_mix(spec):
+    weights = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in SPIN_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown spin kind: {kind}")
+        weights[kind] = float(weight or 1)
+    return weights
+
+# 最近傍順位法のパーセンタイル
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    rank = max(int(-(-p * len(sorted_values) // 100)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(samples, elapsed):
+    latencies = sorted(s["latency"] for s in samples if s["outcome"] != "error")
+    theme_latencies = sorted(s["theme_latency"] for s in samples if s.get("theme_latency") is not None)
+    count = len(samples)
+    errors = sum(1 for s in samples if s["outcome"] == "error")
+    hazure = sum(1 for s in samples if s["outcome"] == "hazure")
+    summary = {
+        "requests": count,
+        "throughput": round(count / elapsed, 2) if elapsed else 0.0,
+        "errors": errors,
+        "error_rate": round(errors / count, 4) if count else 0.0,
+        "hazure": hazure,
+        "hazure_rate": round(hazure / count, 4) if count else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else None,
+    }
+    if theme_latencies:
+        summary.update({
+            "theme_p50": percentile(theme_latencies, 50),
+            "theme_p95": percentile(theme_latencies, 95),
+            "theme_p99": percentile(theme_latencies, 99),
+        })
+    return summary
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.keywords = [k for k in args.keywords.split(",") if k]
+        self.mix = parse_mix(args.mix)
+        self.rng = random.Random(args.seed)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.samples = []
+        self.remaining = args.requests
+
+    def _session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    # 残りの件数または時間がある限り次のスピンの種類とパラメータを返す
+    def _next(self, deadline):
+        with self._lock:
+            if self.remaining is not None:
+                if self.remaining <= 0:
+                    return None
+                self.remaining -= 1
+            elif time.monotonic() >= deadline:
+                return None
+            kind = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+            keyword = self.rng.choice(self.keywords)
+        if kind == "plain":
+            return kind, {}
+        if kind == "keyword":
+            return kind, {"keyword": keyword}
+        return kind, {"keyword": keyword, "specific": "true"}
+
+    def spin(self, kind, params):
+        if self.args.sse:
+            return self.spin_sse(kind, params)
+        started = time.monotonic()
+        try:
+            response = self._session().get(self.args.url.rstrip("/") + self.args.path, params=params, timeout=self.args.timeout)
+            latency = time.monotonic() - started
+            if response.status_code != 200:
+                return {"kind": kind, "latency": latency, "outcome": "error", "status": response.status_code}
+            outcome = "hazure" if response.json().get("theme") == "ハズレ" else "ok"
+            return {"kind": kind, "latency": latency, "outcome": outcome, "status": 200}
+        except (requests.RequestException, ValueError) as e:
+            return {"kind": kind, "latency": time.monotonic() - started, "outcome": "error", "status": None, "error": str(e)}
+
+    # SSEを読み、theme イベントまでと done イベントまでの時間を測る (latency は done まで)
+    def spin_sse(self, kind, params):
+        started = time.monotonic()
+        theme_latency = None
+        event = None
+        try:
+            with self._session().get(self.args.url.rstrip("/") + self.args.path, params=params,
+                                     timeout=self.args.timeout, stream=True) as response:
+                if response.status_code != 200:
+                    return {"kind": kind, "latency": time.monotonic() - started, "outcome": "error", "status": response.status_code}
+                for line in response.iter_lines(decode_unicode=True):
+                    if line.startswith("event:"):
+                        event = line[6:].strip()
+                    elif line.startswith("data:"):
+                        if event == "theme" and theme_latency is None:
+                            theme_latency = time.monotonic() - started
+                        elif event == "done":
+                            latency = time.monotonic() - started
+                            outcome = "hazure" if json.loads(line[5:]).get("theme") == "ハズレ" else "ok"
+                            return {"kind": kind, "latency": latency, "theme_latency": theme_latency, "outcome": outcome, "status": 200}
+            return {"kind": kind, "latency": time.monotonic() - started, "outcome": "error", "status": 200, "error": "stream ended without done"}
+        except (requests.RequestException, ValueError) as e:
+            return {"kind": kind, "latency": time.monotonic() - started, "outcome": "error", "status": None, "error": str(e)}
+
+    def worker(self, deadline):
+        while True:
+            job = self._next(deadline)
+            if job is None:
+                return
+            sample = self.spin(*job)
+            with self._lock:
+                self.samples.append(sample)
+
+    def run(self):
+        deadline = time.monotonic() + self.args.duration
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            for _ in range(self.args.concurrency):
+                pool.submit(self.worker, deadline)
+        elapsed = time.monotonic() - started
+        report = {
+            "url": self.args.url + self.args.path,
+            "concurrency": self.args.concurrency,
+            "sse": self.args.sse,
+            "elapsed": round(elapsed, 3),
+            "overall": summarize(self.samples, elapsed),
+            "by_kind": {
+                kind: summarize([s for s in self.samples if s["kind"] == kind], elapsed)
+                for kind in SPIN_KINDS if kind in self.mix
+            },
+        }
+        return report
+
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.0f}ms"
+
+def print_report(report):
+    print(f"{report['url']}  concurrency={report['concurrency']}  elapsed={report['elapsed']}s")
+    sse = report.get("sse")
+    header = f"{'kind':<10}{'requests':>9}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'errors':>8}{'hazure':>8}"
+    if sse:
+        header += f"{'theme p50':>11}{'theme p95':>11}{'theme p99':>11}"
+    print(header)
+    rows = list(report["by_kind"].items()) + [("overall", report["overall"])]
+    for kind, s in rows:
+        row = (
+            f"{kind:<10}{s['requests']:>9}{s['throughput']:>8}{format_seconds(s['p50']):>9}{format_seconds(s['p95']):>9}"
+            f"{format_seconds(s['p99']):>9}{format_seconds(s['max']):>9}{s['errors']:>8}{s['hazure']:>8}"
+        )
+        if sse:
+            row += f"{format_seconds(s.get('theme_p50')):>11}{format_seconds(s.get('theme_p95')):>11}{format_seconds(s.get('theme_p99')):>11}"
+        print(row)
+
+def main():
+    parser = argparse.ArgumentParser(description="/spin の負荷試験")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="アプリのベースURL")
+    parser.add_argument("--path", default="/spin")
+    parser.add_argument("--sse", action="store_true", help="応答をSSEとして読む (パスが /stream で終わる場合は自動)")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に送るスピンの数")
+    parser.add_argument("--requests", type=int, default=None, help="送るスピンの総数 (省略時は --duration 秒間)")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--mix", default="plain=1,keyword=1,specific=1", help="スピンの種類と比率")
+    parser.add_argument("--keywords", default=DEFAULT_KEYWORDS, help="カンマ区切りのキーワード")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    parser.add_argument("--max-p95", type=float, default=None, help="全体のp95 (秒) がこれを超えたら失敗")
+    parser.add_argument("--max-error-rate", type=float, default=None, help="エラー率がこれを超えたら失敗")
+    args = parser.parse_args()
+    args.sse = args.sse or args.path.rstrip("/").endswith("/stream")
+
+    report = LoadTest(args).run()
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    overall = report["overall"]
+    failed = []
+    if args.max_p95 is not None and (overall["p95"] is None or overall["p95"] > args.max_p95):
+        failed.append(f"p95 {format_seconds(overall['p95'])} > {args.max_p95}s")
+    if args.max_error_rate is not None and overall["error_rate"] > args.max_error_rate:
+        failed.append(f"error rate {overall['error_rate']} > {args.max_error_rate}")
+    if failed:
+        print("FAILED: " + ", ".join(failed), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
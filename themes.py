@@ -0,0 +1,66 @@
+conversation_themes = [
+    {"theme": "AIの未来", "hint": "ChatGPTが仕事を奪う？倫理的な議論も面白いかも"},
+    {"theme": "宇宙旅行", "hint": "民間宇宙旅行が現実に！行くならどこがいい？"},
+    {"theme": "未来の食生活", "hint": "昆虫食や培養肉が主流になる？"},
+    {"theme": "バーチャルリアリティ", "hint": "完全没入型VRでどこまで現実と区別がつかなくなる？"},
+    {"theme": "働き方革命", "hint": "週休3日制は本当に実現する？生産性との関係は？"},
+    {"theme": "環境問題", "hint": "個人でできる地球温暖化対策って何がある？"},
+    {"theme": "ペットロボット", "hint": "将来的に本物のペットより人気が出る可能性は？"},
+    {"theme": "自動運転車", "hint": "完全自動運転が普及したら運転免許は必要なくなる？"},
+    {"theme": "ディープフェイク", "hint": "技術の悪用をどう防ぐ？規制のあり方は？"},
+    {"theme": "宇宙人", "hint": "もし宇宙人がいたら、最初に何を聞きたい？"},
+    {"theme": "最後の晩餐", "hint": "人生最後に食べたい食べ物は？理由も聞いてみよう"},
+    {"theme": "コンビニの推し商品", "hint": "つい買ってしまうコンビニの食べ物やスイーツは？"},
+    {"theme": "ご当地グルメ", "hint": "旅行先で食べて感動した名物料理は？"},
+    {"theme": "朝ごはん派閥", "hint": "パン派？ご飯派？それとも食べない派？"},
+    {"theme": "ラーメンの好み", "hint": "醤油・味噌・豚骨…一番好きな味とお気に入りの店は？"},
+    {"theme": "カレーの隠し味", "hint": "家のカレーに入れている意外な隠し味は？"},
+    {"theme": "行ってみたい国", "hint": "一度は旅行してみたい国とやりたいことは？"},
+    {"theme": "旅行の持ち物", "hint": "旅行に絶対持っていくこだわりのアイテムは？"},
+    {"theme": "温泉旅行", "hint": "行ってよかった温泉地や理想の温泉宿の条件は？"},
+    {"theme": "修学旅行の思い出", "hint": "行き先や夜の部屋での出来事、覚えてる？"},
+    {"theme": "猫派か犬派か", "hint": "どっち派？それぞれの魅力を語ってみよう"},
+    {"theme": "飼ってみたい動物", "hint": "現実的じゃなくてもOK！一緒に暮らしてみたい動物は？"},
+    {"theme": "動物園の推し", "hint": "動物園や水族館で一番長く見てしまう動物は？"},
+    {"theme": "最近ハマっている趣味", "hint": "始めたきっかけや楽しさを聞いてみよう"},
+    {"theme": "休日の過ごし方", "hint": "理想の休日と実際の休日、どれくらい違う？"},
+    {"theme": "子どもの頃の夢", "hint": "小さい頃になりたかった職業は？今とつながってる？"},
+    {"theme": "学生時代の部活", "hint": "何部だった？一番の思い出や厳しかった練習は？"},
+    {"theme": "給食の人気メニュー", "hint": "好きだった給食のメニューや地域限定の献立は？"},
+    {"theme": "テスト前の過ごし方", "hint": "一夜漬け派？コツコツ派？つい掃除しちゃう人も"},
+    {"theme": "初めてのアルバイト", "hint": "どんな仕事だった？忘れられない失敗談は？"},
+    {"theme": "理想の職場", "hint": "リモートワーク、フレックス…あったら嬉しい制度は？"},
+    {"theme": "仕事の息抜き", "hint": "忙しい日の気分転換の方法は？"},
+    {"theme": "好きな映画", "hint": "何度も見返してしまう映画とその理由は？"},
+    {"theme": "映画館の楽しみ方", "hint": "ポップコーンは塩派？キャラメル派？座る席のこだわりも"},
+    {"theme": "泣けるアニメ", "hint": "思わず泣いてしまったアニメのシーンは？"},
+    {"theme": "人生で一番ハマったゲーム", "hint": "寝る間も惜しんで遊んだゲームは？"},
+    {"theme": "カラオケの十八番", "hint": "必ず歌う曲や盛り上がる定番曲は？"},
+    {"theme": "よく聴く音楽", "hint": "最近のプレイリストに入っている曲やアーティストは？"},
+    {"theme": "好きな漫画", "hint": "人に勧めたい漫画とハマったきっかけは？"},
+    {"theme": "最近読んだ本", "hint": "印象に残った一冊や読書のスタイルは？"},
+    {"theme": "推し活", "hint": "推しているアイドルやキャラクター、応援の仕方は？"},
+    {"theme": "スポーツ観戦", "hint": "好きなチームや現地で観戦した思い出は？"},
+    {"theme": "やってみたいスポーツ", "hint": "サーフィン、ボルダリング…挑戦してみたい競技は？"},
+    {"theme": "健康習慣", "hint": "続けている運動や健康のためのこだわりは？"},
+    {"theme": "睡眠のこだわり", "hint": "寝る前のルーティンや枕へのこだわりは？"},
+    {"theme": "春の楽しみ", "hint": "お花見や新生活、春になるとやりたいことは？"},
+    {"theme": "夏の思い出", "hint": "夏祭り、花火、海…忘れられない夏の出来事は？"},
+    {"theme": "秋の味覚", "hint": "さつまいも、栗、さんま…秋に食べたいものは？"},
+    {"theme": "冬の過ごし方", "hint": "こたつ派？それともウィンタースポーツ派？"},
+    {"theme": "年末年始の過ごし方", "hint": "毎年の恒例行事やお正月の思い出は？"},
+    {"theme": "スマホのホーム画面", "hint": "一番よく使うアプリや最近入れたアプリは？"},
+    {"theme": "SNSとの付き合い方", "hint": "見る専門？発信する派？疲れたときの距離の取り方は？"},
+    {"theme": "便利な家電", "hint": "買ってよかった家電や欲しい最新ガジェットは？"},
+    {"theme": "タイムマシン", "hint": "過去と未来、行けるならどっち？何をする？"},
+    {"theme": "もしも宝くじが当たったら", "hint": "10億円当たったら最初に何に使う？"},
+    {"theme": "一日だけ透明人間", "hint": "誰にも見えないとしたらどこへ行く？"},
+    {"theme": "無人島に持っていくもの", "hint": "3つだけ持っていけるとしたら何を選ぶ？"},
+    {"theme": "生まれ変わったら", "hint": "次の人生でなりたいものややりたいことは？"},
+    {"theme": "最近うれしかったこと", "hint": "小さなことでもOK！最近の幸せエピソードは？"},
+    {"theme": "地元自慢", "hint": "出身地の名物や地元の人しか知らないスポットは？"},
+    {"theme": "おすすめの散歩コース", "hint": "近所のお気に入りの道やカフェは？"},
+    {"theme": "料理の得意メニュー", "hint": "自信のある手料理や失敗したレシピは？"},
+    {"theme": "お弁当のおかず", "hint": "入っていると嬉しいお弁当のおかずは？"},
+    {"theme": "甘いものの誘惑", "hint": "我慢できない好きなスイーツやお菓子は？"},
+]